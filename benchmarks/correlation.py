@@ -0,0 +1,69 @@
+import argparse
+import numpy as np
+from time import perf_counter
+from no_wander.features import get_correlation_matrices
+
+
+def correlation_matrix_lagged_cov(X, lag_size=4, num_lags=16):
+    # Previous per-epoch implementation: NaN padding makes every lagged
+    # covariance NaN, so only lag 0 survives nan_to_num
+    num_lags = num_lags // 2 + 1
+    X_lagged = np.full((*X.shape, num_lags), np.nan)
+    X_lagged[:, :, 0] = X - X.mean(axis=-1, keepdims=True)
+    for i in range(1, num_lags):
+        lag = lag_size * i
+        X_lagged[:, :-lag, i] = X_lagged[:, lag:, 0]
+    X_lagged = X_lagged.swapaxes(2, 1).reshape(-1, X.shape[1])
+    weights = np.logical_not(np.isnan(X_lagged)).sum(axis=-1)
+    weights = X.shape[1] / np.minimum(weights[:, np.newaxis], weights[np.newaxis, :])
+    cov = np.nan_to_num(np.cov(X_lagged, rowvar=True) * weights, nan=0)
+    cov = cov.reshape(X.shape[0], num_lags, X.shape[0], num_lags)
+
+    channels = np.arange(X.shape[0])
+    var = cov[channels, 0, channels, 0].reshape(channels.size, 1)
+    denom = np.sqrt(np.matmul(var, var.T))
+    return np.abs(cov).max(axis=(-1, 1)) / np.where(denom == 0, np.inf, denom)
+
+
+def time_call(func, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func(*args)
+        best = min(best, perf_counter() - start)
+    return best, result
+
+
+def run_benchmark(num_epochs, num_channels, num_readings, repeat):
+    X = np.random.RandomState(0).randn(num_epochs, num_channels, num_readings)
+    lag_size = 4
+    num_lags = 2 ** int(np.log2(0.5 * num_readings / lag_size))
+
+    loop_time, expected = time_call(
+        lambda X: np.array(
+            [correlation_matrix_lagged_cov(x, lag_size, num_lags) for x in X]
+        ),
+        X,
+        repeat=repeat,
+    )
+    batched_time, corr = time_call(get_correlation_matrices, X, repeat=repeat)
+    return loop_time, batched_time, np.abs(corr - expected).max()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare per-epoch and batched channel correlation matrices"
+    )
+    parser.add_argument("-e", "--epochs", type=int, default=2000)
+    parser.add_argument("-c", "--channels", type=int, default=4)
+    parser.add_argument("-s", "--sample-size", type=int, default=256)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    loop_time, batched_time, max_diff = run_benchmark(
+        args.epochs, args.channels, args.sample_size, args.repeat
+    )
+    print("per-epoch (s)\tbatched (s)\tspeedup\tmax abs diff")
+    print(
+        f"{loop_time:.3f}\t{batched_time:.3f}\t{loop_time / batched_time:.1f}x\t{max_diff:.2e}"
+    )
@@ -0,0 +1,147 @@
+import argparse
+import logging
+import tempfile
+from itertools import product
+from pathlib import Path
+from time import perf_counter
+from no_wander.constants import (
+    COMPRESSION_BLOSC_LZ4,
+    COMPRESSION_GZIP,
+    COMPRESSION_LZF,
+    COMPRESSION_NONE,
+    COMPRESSION_ZSTD,
+    DATASET_VAL,
+)
+from no_wander.datasets import (
+    convert_epochs,
+    FORMAT_V1,
+    FORMAT_V2,
+    load_filter_plugins,
+    parse_dataset,
+    read_dataset,
+)
+
+SETTINGS_DEFAULT = [
+    (COMPRESSION_NONE, None),
+    (COMPRESSION_LZF, None),
+    (COMPRESSION_GZIP, 1),
+    (COMPRESSION_GZIP, 4),
+    (COMPRESSION_GZIP, 9),
+    (COMPRESSION_BLOSC_LZ4, None),
+    (COMPRESSION_ZSTD, None),
+]
+
+logger = logging.getLogger(__name__)
+
+
+def time_call(func, *args, repeat=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args, **kwargs)
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def run_benchmark(
+    epoch_file, sample_size, pre_window, post_window, chunk_shapes, repeat
+):
+    has_plugins = load_filter_plugins() is not None
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for format_version, (compression, level), shuffle, chunk_shape in product(
+            [FORMAT_V1, FORMAT_V2], SETTINGS_DEFAULT, [False, True], chunk_shapes
+        ):
+            if compression in [COMPRESSION_BLOSC_LZ4, COMPRESSION_ZSTD]:
+                if not has_plugins:
+                    continue
+            if compression == COMPRESSION_NONE and shuffle:
+                continue
+
+            out_file = Path(tmp_dir) / "epochs.h5"
+            write_time = time_call(
+                convert_epochs,
+                epoch_file,
+                out_file,
+                format_version,
+                compression=compression,
+                compression_level=level,
+                shuffle=shuffle,
+                chunk_shape=chunk_shape,
+                repeat=repeat,
+            )
+            parse_time = time_call(
+                parse_dataset, out_file, test_set=DATASET_VAL, repeat=repeat
+            )
+            read_time = time_call(
+                read_dataset,
+                out_file,
+                sample_size,
+                1,
+                pre_window,
+                post_window,
+                repeat=repeat,
+            )
+            results.append(
+                (
+                    f"v{format_version}",
+                    compression if level is None else f"{compression}-{level}",
+                    "shuffle" if shuffle else "-",
+                    "auto" if chunk_shape is None else "x".join(map(str, chunk_shape)),
+                    out_file.stat().st_size / 1024 ** 2,
+                    write_time,
+                    parse_time,
+                    read_time,
+                )
+            )
+            out_file.unlink()
+
+    return results
+
+
+def print_results(results):
+    header = (
+        "format",
+        "codec",
+        "shuffle",
+        "chunks",
+        "size (MB)",
+        "write (s)",
+        "parse (s)",
+        "read_dataset (s)",
+    )
+    print("\t".join(header))
+    for row in sorted(results, key=lambda x: x[-1]):
+        print("\t".join(f"{v:.3f}" if type(v) is float else v for v in row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare write time, read time and size of epoch file storage settings"
+    )
+    parser.add_argument("EPOCH_FILE", help="Sample train epoch file made by process")
+    parser.add_argument("-s", "--sample-size", type=int, default=16)
+    parser.add_argument("--pre-window", type=float, nargs=2, default=(-7, -1))
+    parser.add_argument("--post-window", type=float, nargs=2, default=(0, 3))
+    parser.add_argument(
+        "--chunk-shape",
+        type=int,
+        nargs=2,
+        action="append",
+        metavar=("ROWS", "COLUMNS"),
+        help="Chunk shape to try. Can be repeated. Default is the writer's default",
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    print_results(
+        run_benchmark(
+            Path(args.EPOCH_FILE),
+            args.sample_size,
+            args.pre_window,
+            args.post_window,
+            args.chunk_shape or [None],
+            args.repeat,
+        )
+    )
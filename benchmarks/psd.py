@@ -0,0 +1,91 @@
+import argparse
+import numpy as np
+from time import perf_counter
+from no_wander.constants import (
+    PSD_MULTITAPER,
+    PSD_PERIODOGRAM,
+    PSD_WELCH,
+    SAMPLE_RATE,
+)
+from no_wander.features import FREQ_BANDS, extract_bandpower_features
+
+PSD_METHODS = [PSD_MULTITAPER, PSD_WELCH, PSD_PERIODOGRAM]
+
+
+def time_call(func, *args, repeat=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, perf_counter() - start)
+    return best, result
+
+
+def get_signals(num_epochs, num_channels, num_readings, seed=0):
+    # Brown noise plus a random rhythm in each band, roughly like EEG
+    rng = np.random.RandomState(seed)
+    X = np.cumsum(rng.randn(num_epochs, num_channels, num_readings), axis=-1)
+    X -= X.mean(axis=-1, keepdims=True)
+    t = np.arange(num_readings) / SAMPLE_RATE
+    for i, (_, fmin) in enumerate(FREQ_BANDS):
+        fmax = FREQ_BANDS[i + 1][1] if i + 1 < len(FREQ_BANDS) else 100
+        freq = rng.uniform(fmin, fmax, size=(num_epochs, num_channels, 1))
+        amplitude = rng.uniform(0, 5, size=(num_epochs, num_channels, 1))
+        X += amplitude * np.sin(2 * np.pi * freq * t)
+    return X
+
+
+def run_benchmark(num_epochs, num_channels, num_readings, reference, repeat):
+    X = get_signals(num_epochs, num_channels, num_readings)
+    num_bands = len(FREQ_BANDS)
+    results = {}
+    for psd in PSD_METHODS:
+        try:
+            elapsed, (features, _, _) = time_call(
+                extract_bandpower_features, X, psd=psd, repeat=repeat
+            )
+        except ImportError as error:
+            print(f"Skipping {psd}: {error}")
+            continue
+        # Relative band powers only, energy depends on each method's scaling
+        results[psd] = (elapsed, features[:, : num_bands * num_channels])
+
+    if reference not in results:
+        raise ValueError(f"Reference method {reference} could not be run")
+    reference_time, expected = results[reference]
+    rows = []
+    for psd, (elapsed, bands) in results.items():
+        diff = np.abs(bands - expected)
+        # Bands too narrow for the frequency resolution are constant, so skipped
+        with np.errstate(invalid="ignore", divide="ignore"):
+            corr = np.nanmean(
+                [
+                    np.corrcoef(bands[:, i], expected[:, i])[0, 1]
+                    for i in range(bands.shape[1])
+                ]
+            )
+        rows.append(
+            (psd, elapsed, reference_time / elapsed, diff.mean(), diff.max(), corr)
+        )
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare speed and band power agreement of PSD methods"
+    )
+    parser.add_argument("-e", "--epochs", type=int, default=2000)
+    parser.add_argument("-c", "--channels", type=int, default=4)
+    parser.add_argument("-s", "--sample-size", type=int, default=256)
+    parser.add_argument("--reference", choices=PSD_METHODS, default=PSD_MULTITAPER)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = run_benchmark(
+        args.epochs, args.channels, args.sample_size, args.reference, args.repeat
+    )
+    print("method\ttime (s)\tspeedup\tmean abs diff\tmax abs diff\tmean corr")
+    for psd, elapsed, speedup, mean_diff, max_diff, corr in rows:
+        print(
+            f"{psd}\t{elapsed:.3f}\t{speedup:.1f}x\t{mean_diff:.4f}\t{max_diff:.4f}\t{corr:.3f}"
+        )
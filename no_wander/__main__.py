@@ -2,10 +2,14 @@ import argparse
 import logging
 import sys
 from .cli import (
+    convert_run,
+    convert_setup_parser,
     process_run,
     process_setup_parser,
     record_run,
     record_setup_parser,
+    sweep_run,
+    sweep_setup_parser,
     train_run,
     train_setup_parser,
 )
@@ -70,7 +74,19 @@ commands = [
         process_setup_parser,
         process_run,
     ),
+    (
+        "convert",
+        "Convert epoch files between layouts",
+        convert_setup_parser,
+        convert_run,
+    ),
     ("train", "Build and train model", train_setup_parser, train_run),
+    (
+        "sweep",
+        "Train many configurations, loading each data variant once",
+        sweep_setup_parser,
+        sweep_run,
+    ),
 ]
 for command, help, setup_parser, handler in commands:
     parser_command = subparsers.add_parser(command, help=help)
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+CACHE_SIZE_DEFAULT = 10 * 1024 ** 3
+HASHES_FILENAME = ".hashes.json"
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache_key(*parts):
+    key = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def get_file_key(filepath):
+    filepath = Path(filepath).resolve()
+    stat = filepath.stat()
+    return get_cache_key(str(filepath), stat.st_mtime_ns, stat.st_size)
+
+
+def get_file_hash(filepath):
+    file_hash = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 ** 2), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_content_hash(filepath, cache_dir):
+    # Content hashes are remembered by file key, so unchanged files are hashed once
+    hashes_file = Path(cache_dir) / HASHES_FILENAME
+    try:
+        with open(hashes_file, "r") as f:
+            hashes = json.load(f)
+    except (FileNotFoundError, ValueError):
+        hashes = {}
+
+    file_key = get_file_key(filepath)
+    if file_key not in hashes:
+        logger.debug(f"Hashing {filepath}...")
+        hashes[file_key] = get_file_hash(filepath)
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_file = hashes_file.with_name(f"{hashes_file.name}.{os.getpid()}")
+        with open(tmp_file, "w") as f:
+            json.dump(hashes, f)
+        os.replace(tmp_file, hashes_file)
+    return hashes[file_key]
+
+
+def get_entry_size(entry):
+    if not entry.is_dir():
+        return entry.stat().st_size
+    return sum(f.stat().st_size for f in entry.rglob("*") if f.is_file())
+
+
+def touch_entry(entry):
+    # Entry mtime doubles as the last-used time for LRU eviction
+    try:
+        os.utime(entry)
+    except FileNotFoundError:
+        pass
+
+
+def remove_entry(entry):
+    try:
+        if entry.is_dir():
+            shutil.rmtree(entry)
+        else:
+            entry.unlink()
+    except FileNotFoundError:
+        # Already evicted by another process
+        pass
+
+
+def evict_entries(cache_dir, max_size, keep=None):
+    entries = []
+    total_size = 0
+    for entry in Path(cache_dir).iterdir():
+        if entry.name.startswith("."):
+            continue
+        try:
+            size = get_entry_size(entry)
+            entries.append((entry.stat().st_mtime, size, entry))
+        except FileNotFoundError:
+            continue
+        total_size += size
+
+    entries.sort(key=lambda x: x[0])
+    for _, size, entry in entries:
+        if total_size <= max_size:
+            break
+        if keep is not None and entry.name == keep:
+            continue
+        logger.debug(f"Evicting {entry} from cache...")
+        remove_entry(entry)
+        total_size -= size
+
+    return total_size
+
+
+def clear_cache(cache_dir):
+    cache_dir = Path(cache_dir)
+    if not cache_dir.exists():
+        return
+    logger.info(f"Clearing cache {cache_dir}...")
+    for entry in cache_dir.iterdir():
+        remove_entry(entry)
@@ -3,13 +3,31 @@ import logging
 from pathlib import Path
 from time import gmtime, strftime
 from .constants import (
+    COMPRESSION_BLOSC_LZ4,
+    COMPRESSION_GZIP,
+    COMPRESSION_LZF,
+    COMPRESSION_NONE,
+    COMPRESSION_ZSTD,
     DIR_DATA_DEFAULT,
     DIR_INPUT,
     DIR_SUBJECT_PREFIX,
     DIR_TEST,
+    DTYPE_FLOAT16,
+    DTYPE_FLOAT32,
+    DTYPE_FLOAT64,
+    EXTRACTOR_BANDPOWER,
+    EXTRACTOR_CORRELATION,
+    EXTRACTOR_GRAPH,
+    EXTRACTOR_TIME,
+    EXTRACTOR_WAVELET,
     PREPROCESS_EXTRACT_EEG,
     PREPROCESS_NONE,
     PREPROCESS_NORMALIZE,
+    PSD_MULTITAPER,
+    PSD_PERIODOGRAM,
+    PSD_WELCH,
+    SCALER_ROBUST,
+    SCALER_STREAMING,
     SOURCE_ACC,
     SOURCE_EEG,
     SOURCE_GYRO,
@@ -17,6 +35,14 @@ from .constants import (
 )
 
 
+EXTRACTORS = [
+    EXTRACTOR_TIME,
+    EXTRACTOR_BANDPOWER,
+    EXTRACTOR_WAVELET,
+    EXTRACTOR_CORRELATION,
+    EXTRACTOR_GRAPH,
+]
+
 logger = logging.getLogger(__name__)
 
 
@@ -24,6 +50,44 @@ def type_json(json_str):
     return json.loads(json_str)
 
 
+def type_extractors(extractors_str):
+    extractors = [name.strip() for name in extractors_str.split(",")]
+    if not set(extractors) <= set(EXTRACTORS):
+        raise ValueError(f"Unknown feature extractors in {extractors_str}")
+    return extractors
+
+
+def add_storage_args(parser):
+    parser.add_argument(
+        "--compression",
+        choices=[
+            COMPRESSION_BLOSC_LZ4,
+            COMPRESSION_GZIP,
+            COMPRESSION_LZF,
+            COMPRESSION_NONE,
+            COMPRESSION_ZSTD,
+        ],
+        help="Compression codec for epoch data. blosc-lz4 and zstd require hdf5plugin",
+    )
+    parser.add_argument(
+        "--compression-level", type=int, help="Compression level for the codec",
+    )
+    parser.add_argument(
+        "--no-shuffle",
+        action="store_false",
+        default=None,
+        dest="shuffle",
+        help="Disable the byte shuffle filter before compression",
+    )
+    parser.add_argument(
+        "--chunk-shape",
+        type=int,
+        nargs=2,
+        metavar=("ROWS", "COLUMNS"),
+        help="HDF5 chunk shape of epoch data",
+    )
+
+
 def record_setup_parser(parser):
     parser.add_argument(
         "DURATION", type=int, help="Length of the meditation session in minutes",
@@ -137,21 +201,59 @@ def process_setup_parser(parser):
         default=DIR_DATA_DEFAULT / DIR_INPUT,
         help="Directory containing data files",
     )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="format_version",
+        type=int,
+        choices=[1, 2],
+        help="Layout of new epoch files. 1 is one dataset per epoch, 2 is one contiguous array per set with an index table",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        default=None,
+        help="Only process session chunks missing from the epochs manifest and append their epochs to the existing epoch files",
+    )
     parser.add_argument(
         "-l", "--limit", type=int, help="Limit the number of processed files",
     )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        default=None,
+        help="Cache parsed data files in binary form to speed up repeat runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        help="Maximum size of the parsed data file cache in MB. Least recently used files are evicted first.",
+    )
     parser.add_argument(
         "-s",
         "--val-split",
         type=float,
         help="Percentage of data to reserve for validation",
     )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Random seed for assigning epochs to train/validation/test sets",
+    )
     parser.add_argument(
         "-t",
         "--test-split",
         type=float,
         help="Percentage of data to reserve for final testing",
     )
+    add_storage_args(parser)
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of worker processes used to process session chunks in parallel",
+    )
     parser.add_argument(
         "-x",
         "--aux-channel",
@@ -170,11 +272,36 @@ def process_run(args):
 
     kwargs = {k: v for k, v in vars(args).items() if v is not None}
     data_dir = kwargs.pop("DATA_DIR")
+    if "cache_size" in kwargs:
+        kwargs["cache_size"] *= 1024 ** 2
 
     raw_files = get_files_by_session(data_dir)
     process_session_data(raw_files, data_dir.parent, **kwargs)
 
 
+def convert_setup_parser(parser):
+    parser.add_argument("SOURCE", help="Path to h5 file with epochs to convert")
+    parser.add_argument("DEST", help="Path of converted h5 file")
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="format_version",
+        type=int,
+        choices=[1, 2],
+        default=2,
+        help="Layout of converted epoch file",
+    )
+    add_storage_args(parser)
+
+
+def convert_run(args):
+    from .datasets import convert_epochs
+
+    logger.debug(f"Starting command convert with args {args}")
+    kwargs = {k: v for k, v in vars(args).items() if v is not None}
+    convert_epochs(Path(kwargs.pop("SOURCE")), Path(kwargs.pop("DEST")), **kwargs)
+
+
 def train_setup_parser(parser):
     parser.set_defaults(allow_unknown_args=True)
     parser.add_argument("DATA_FILE", help="Path to h5 file with labeled epochs")
@@ -188,6 +315,11 @@ def train_setup_parser(parser):
         required=True,
         help="Number of readings/timesteps per sample",
     )
+    parser.add_argument(
+        "--stride",
+        type=int,
+        help="Number of readings between the starts of consecutive samples. Default is --sample-size. Smaller values give overlapping samples",
+    )
     parser.add_argument(
         "-q",
         "--sequence-size",
@@ -239,6 +371,39 @@ def train_setup_parser(parser):
         choices=[PREPROCESS_EXTRACT_EEG, PREPROCESS_NONE, PREPROCESS_NORMALIZE],
         help="Type of preprocessing to perform on input data",
     )
+    parser.add_argument(
+        "--features",
+        type=type_extractors,
+        dest="extractors",
+        help=f"Comma-separated feature extractors to use with --preprocess extract-eeg. Options are {', '.join(EXTRACTORS)}. Default is all",
+    )
+    parser.add_argument(
+        "--psd",
+        choices=[PSD_MULTITAPER, PSD_PERIODOGRAM, PSD_WELCH],
+        help="Power spectral density method for band power features. Default is multitaper",
+    )
+    parser.add_argument(
+        "--scaler",
+        choices=[SCALER_ROBUST, SCALER_STREAMING],
+        help="Scaler used with --preprocess normalize. streaming fits from chunks of samples, without loading them all. Default is robust",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of worker processes used to extract graph features with --preprocess extract-eeg",
+    )
+    parser.add_argument(
+        "--extract-chunk-size",
+        type=int,
+        help="Number of samples to extract features from or normalize at a time with --preprocess extract-eeg or --scaler streaming, to bound memory use",
+    )
+    parser.add_argument(
+        "--feature-store",
+        action="store_true",
+        default=None,
+        help="Reuse features extracted with --preprocess extract-eeg from a store next to DATA_FILE",
+    )
     parser.add_argument(
         "--encode-position",
         action="store_true",
@@ -264,6 +429,60 @@ def train_setup_parser(parser):
         default=None,
         help="Shuffle samples before constructing LSTM sequences",
     )
+    parser.add_argument(
+        "--balance-classes",
+        action="store_true",
+        default=None,
+        help="Oversample sequences of the minority class so both classes are seen equally often in training",
+    )
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        default=None,
+        help="Keep samples in a memory-mapped store instead of in memory",
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=[DTYPE_FLOAT16, DTYPE_FLOAT32, DTYPE_FLOAT64],
+        help="Precision in which samples are read and preprocessed. Default is float64. float16 is only used for storage",
+    )
+    parser.add_argument(
+        "--store-dir",
+        type=Path,
+        help="Directory for the memory-mapped sample store. Default is a temporary directory",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        default=None,
+        help="Cache prepared samples and preprocessor next to DATA_FILE, keyed by its contents and data prep params",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        help="Maximum size of the prepared data cache in MB. Least recently used entries are evicted first.",
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="Remove all cached prepared data for DATA_FILE before training",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=None,
+        help="Stream samples from the data file with tf.data instead of loading them all",
+    )
+    parser.add_argument(
+        "--shuffle-buffer",
+        type=int,
+        help="Number of samples/sequences in the shuffle buffer when streaming",
+    )
+    parser.add_argument(
+        "--fit-samples",
+        type=int,
+        help="Number of training samples used to fit the preprocessor when streaming",
+    )
     parser.add_argument(
         "-e", "--epochs", type=int, default=1, help="Number of training epochs"
     )
@@ -293,12 +512,26 @@ def train_setup_parser(parser):
         default=None,
         help="Print metrics in Gradient chart format every epoch",
     )
+    parser.add_argument(
+        "--performance-metrics",
+        action="store_true",
+        default=None,
+        help="Save step time, input time, throughput and peak memory of every batch",
+    )
 
 
 def train_run(args, **kwargs):
-    from .train import build_and_train_model
+    from .cache import clear_cache
+    from .train import build_and_train_model, get_tensor_cache_dir
 
     kwargs.update({k: v for k, v in vars(args).items() if v is not None})
+    if kwargs.pop("clear_cache"):
+        clear_cache(get_tensor_cache_dir(kwargs["DATA_FILE"]))
+    if "cache_size" in kwargs:
+        kwargs["cache_size"] *= 1024 ** 2
+    kwargs["stream_kwargs"] = {
+        k: kwargs.pop(k) for k in ["fit_samples", "shuffle_buffer"] if k in kwargs
+    }
     build_and_train_model(
         kwargs.pop("DATA_FILE"),
         kwargs.pop("MODEL_DIR"),
@@ -307,3 +540,37 @@ def train_run(args, **kwargs):
         kwargs.pop("layers"),
         **kwargs,
     )
+
+
+def sweep_setup_parser(parser):
+    parser.add_argument(
+        "SPEC_FILE",
+        type=Path,
+        help="JSON file with the search type, base train params and swept params",
+    )
+    parser.add_argument("DATA_FILE", help="Path to h5 file with labeled epochs")
+    parser.add_argument(
+        "SWEEP_DIR", help="Directory in which to save each model and the summary"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of configs to train at the same time, each in its own process",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="Number of TensorFlow threads per job. Default is the number of CPUs divided by --jobs",
+    )
+
+
+def sweep_run(args):
+    from .sweep import run_sweep
+
+    with open(args.SPEC_FILE, "r") as f:
+        spec = json.load(f)
+    run_sweep(
+        args.DATA_FILE, args.SWEEP_DIR, spec, jobs=args.jobs, threads=args.threads
+    )
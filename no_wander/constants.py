@@ -4,11 +4,22 @@ COL_MARKER_PREFIX = "Marker"
 COL_MARKER_DEFAULT = f"{COL_MARKER_PREFIX}0"
 COL_RIGHT_AUX = "Right AUX"
 
+COMPRESSION_BLOSC_LZ4 = "blosc-lz4"
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_LZF = "lzf"
+COMPRESSION_NONE = "none"
+COMPRESSION_ZSTD = "zstd"
+
 DATASET_TEST = "test"
 DATASET_TRAIN = "train"
 DATASET_VAL = "val"
 
+DTYPE_FLOAT16 = "float16"
+DTYPE_FLOAT32 = "float32"
+DTYPE_FLOAT64 = "float64"
+
 DIR_ASSETS = (Path(__file__).parent / "assets").resolve()
+DIR_CACHE = "cache"
 DIR_DATA_DEFAULT = Path.cwd() / "data"
 DIR_EPOCHS = "epochs"
 DIR_FAILED = "failed"
@@ -17,6 +28,12 @@ DIR_PROCESSED = "processed"
 DIR_SUBJECT_PREFIX = "subject_"
 DIR_TEST = "test"
 
+EXTRACTOR_BANDPOWER = "bandpower"
+EXTRACTOR_CORRELATION = "correlation"
+EXTRACTOR_GRAPH = "graph"
+EXTRACTOR_TIME = "time"
+EXTRACTOR_WAVELET = "wavelet"
+
 EVENT_RECORD_CHUNK_START = "EVENT_RECORD_CHUNK_START"
 EVENT_SESSION_END = "EVENT_SESSION_END"
 EVENT_STREAMING_ERROR = "EVENT_STREAMING_ERROR"
@@ -31,8 +48,15 @@ PREPROCESS_EXTRACT_EEG = "extract-eeg"
 PREPROCESS_NONE = "none"
 PREPROCESS_NORMALIZE = "normalize"
 
+PSD_MULTITAPER = "multitaper"
+PSD_PERIODOGRAM = "periodogram"
+PSD_WELCH = "welch"
+
 SAMPLE_RATE = 256
 
+SCALER_ROBUST = "robust"
+SCALER_STREAMING = "streaming"
+
 SOURCE_ACC = "ACC"
 SOURCE_EEG = "EEG"
 SOURCE_GYRO = "GYRO"
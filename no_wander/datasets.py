@@ -1,99 +1,496 @@
+import atexit
 import h5py
 import logging
 import numpy as np
+import os
+import shutil
+import tempfile
+from pathlib import Path
 from .constants import (
     COL_MARKER_DEFAULT,
+    COMPRESSION_BLOSC_LZ4,
+    COMPRESSION_GZIP,
+    COMPRESSION_LZF,
+    COMPRESSION_NONE,
+    COMPRESSION_ZSTD,
     DATASET_TEST,
     DATASET_TRAIN,
     DATASET_VAL,
+    DTYPE_FLOAT64,
     SAMPLE_RATE,
 )
 
+ATTR_FORMAT_VERSION = "format_version"
+COMPRESSION_DEFAULT = COMPRESSION_GZIP
+COMPRESSION_LEVEL_DEFAULT = 4
+DTYPE_DEFAULT = DTYPE_FLOAT64
+FORMAT_V1 = 1
+FORMAT_V2 = 2
+FORMAT_DEFAULT = FORMAT_V2
+TABLE_BUFFER_ROWS = 65536
+TABLE_CHUNK_SHAPE = (4096, 1)
+TABLE_COLUMN_SETS = "column_sets"
+TABLE_COLUMNS = "columns"
+TABLE_DATA = "data"
+TABLE_INDEX = "index"
+TABLE_INDEX_FIELDS = [
+    ("name", str),
+    ("offset", np.int64),
+    ("length", np.int64),
+    ("recovery", np.int64),
+    ("column_set", np.int64),
+    ("subject", str),
+    ("date", str),
+    ("chunk", str),
+]
+
 logger = logging.getLogger(__name__)
 
 
+def load_filter_plugins():
+    # Blosc and Zstd files can only be read or written once hdf5plugin registers them
+    try:
+        import hdf5plugin
+
+        return hdf5plugin
+    except ImportError:
+        return None
+
+
+def get_compression_kwargs(
+    compression=COMPRESSION_DEFAULT, compression_level=None, shuffle=True
+):
+    if compression == COMPRESSION_NONE:
+        return {}
+    elif compression == COMPRESSION_GZIP:
+        level = (
+            COMPRESSION_LEVEL_DEFAULT
+            if compression_level is None
+            else compression_level
+        )
+        return {"compression": "gzip", "compression_opts": level, "shuffle": shuffle}
+    elif compression == COMPRESSION_LZF:
+        return {"compression": "lzf", "shuffle": shuffle}
+    elif compression not in [COMPRESSION_BLOSC_LZ4, COMPRESSION_ZSTD]:
+        raise ValueError(f"Unknown compression {compression}")
+
+    hdf5plugin = load_filter_plugins()
+    if hdf5plugin is None:
+        raise ValueError(f"hdf5plugin must be installed to use {compression}")
+    level_kwargs = {} if compression_level is None else {"clevel": compression_level}
+    if compression == COMPRESSION_BLOSC_LZ4:
+        # Blosc applies its own byte shuffle
+        blosc_shuffle = (
+            hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+        )
+        return dict(
+            hdf5plugin.Blosc(cname="lz4", shuffle=blosc_shuffle, **level_kwargs)
+        )
+    return {**hdf5plugin.Zstd(**level_kwargs), "shuffle": shuffle}
+
+
+def get_format_version(hf):
+    return int(hf.attrs.get(ATTR_FORMAT_VERSION, FORMAT_V1))
+
+
+def to_str(values):
+    # h5py>=3 reads variable-length strings back as bytes
+    return [v.decode("utf-8") if type(v) is bytes else str(v) for v in values]
+
+
+def iter_epochs_v1(grp, epochs=None):
+    names = [name for name, dset in grp.items() if isinstance(dset, h5py.Dataset)]
+    if epochs is not None:
+        names = np.array(names)[epochs].tolist()
+    for name in names:
+        dset = grp[name]
+        attrs = dset.attrs
+        session = ".".join(to_str([attrs["subject"], attrs["date"], attrs["chunk"]]))
+        yield name, dset[:], to_str(attrs["columns"]), attrs["recovery"], session
+
+
+def iter_epochs_v2(grp, contiguous=True, epochs=None):
+    if TABLE_INDEX not in grp:
+        return
+    index = {field: grp[TABLE_INDEX][field][:] for field, _ in TABLE_INDEX_FIELDS}
+    if epochs is not None:
+        index = {field: values[epochs] for field, values in index.items()}
+    columns = np.array(to_str(grp[TABLE_COLUMNS][:]))
+    column_sets = grp[TABLE_COLUMN_SETS][:].astype(bool)
+    # One contiguous read instead of one read per epoch, unless memory is a concern
+    data = grp[TABLE_DATA][:] if contiguous else grp[TABLE_DATA]
+    for name, offset, length, recovery, column_set, subject, date, chunk in zip(
+        *index.values()
+    ):
+        mask = column_sets[column_set]
+        yield (
+            to_str([name])[0],
+            data[offset : offset + length][:, mask],
+            columns[mask].tolist(),
+            recovery,
+            ".".join(to_str([subject, date, chunk])),
+        )
+
+
+def iter_epochs(grp, format_version, contiguous=True, epochs=None):
+    # epochs optionally selects epochs by position, as a slice or index array
+    if format_version == FORMAT_V1:
+        return iter_epochs_v1(grp, epochs=epochs)
+    return iter_epochs_v2(grp, contiguous=contiguous, epochs=epochs)
+
+
+def iter_epoch_metadata(grp, format_version):
+    if format_version == FORMAT_V1:
+        for dset in grp.values():
+            if isinstance(dset, h5py.Dataset):
+                yield dset.shape[0], dset.attrs["recovery"], to_str(
+                    dset.attrs["columns"]
+                )
+        return
+
+    if TABLE_INDEX not in grp:
+        return
+    columns = np.array(to_str(grp[TABLE_COLUMNS][:]))
+    column_sets = grp[TABLE_COLUMN_SETS][:].astype(bool)
+    for length, recovery, column_set in zip(
+        grp[TABLE_INDEX]["length"][:],
+        grp[TABLE_INDEX]["recovery"][:],
+        grp[TABLE_INDEX]["column_set"][:],
+    ):
+        yield length, recovery, columns[column_sets[column_set]].tolist()
+
+
+def get_epoch_groups(hf):
+    # Sets are either subgroups (train/val) or the file root (test)
+    format_version = get_format_version(hf)
+    groups = {}
+    if format_version == FORMAT_V1:
+        if any(isinstance(item, h5py.Dataset) for item in hf.values()):
+            groups[None] = hf
+    elif TABLE_INDEX in hf:
+        groups[None] = hf
+    for name, item in hf.items():
+        if isinstance(item, h5py.Group) and name != TABLE_INDEX:
+            groups[name] = item
+    return groups, format_version
+
+
 def parse_dataset(filepath, train_set=DATASET_TRAIN, test_set=DATASET_TEST):
     datasets = {}
     features = {}
 
+    load_filter_plugins()
     with h5py.File(filepath, "r") as hf:
+        format_version = get_format_version(hf)
         for set_type in [train_set, test_set]:
             if set_type is None:
                 continue
 
-            set_group = hf[set_type]
-            data = [None] * len(set_group)
-            for i, dset in enumerate(set_group.values()):
-                columns = dset.attrs["columns"]
+            data = []
+            for _, epoch, columns, recovery, _ in iter_epochs(
+                hf[set_type], format_version
+            ):
                 for col in columns:
                     if col not in features:
                         features[col] = len(features)
                 column_numbers = [features[col] for col in columns]
 
-                data[i] = dset[:], dset.attrs["recovery"], column_numbers
+                data.append((epoch, recovery, column_numbers))
             datasets[set_type] = data
 
     features = [feat for (feat, _) in sorted(features.items(), key=lambda x: x[1])]
     return datasets, features
 
 
-def get_window_samples(data, sample_size, consecutive_samples, window):
+def get_num_samples(num_readings, sample_size, consecutive_samples, stride=None):
+    stride = stride or sample_size
+    if num_readings < sample_size:
+        return 0
+    num_samples = (num_readings - sample_size) // stride + 1
+    return num_samples // consecutive_samples * consecutive_samples
+
+
+def get_window_starts(
+    recovery_ix, num_readings, sample_size, consecutive_samples, window, stride=None
+):
+    # Start rows of the samples in a window, relative to the epoch
+    stride = stride or sample_size
     start, stop = window
-    is_flip = stop <= 0
-    if is_flip:
-        start, stop = -stop, -start
-        data = data[::-1]
-
-    data = data[start:stop]
-    drop = len(data) % (sample_size * consecutive_samples)
-    if drop > 0:
-        data = data[:-drop]
-
-    samples = data.reshape(-1, sample_size, data.shape[1])
-    if is_flip:
-        samples = samples[::-1, ::-1]
-    return list(samples), drop
-
-
-def get_samples(data, sample_size, consecutive_samples, pre_window, post_window):
-    parsed = [None] * len(data)
-    num_samples = 0
-
-    for i, (dset, recovery_ix, features) in enumerate(data):
-        parsed[i] = [[], [], features]
-        for j, window_data, window, window_name in [
-            (0, dset[:recovery_ix], pre_window, "pre"),
-            (1, dset[recovery_ix:], post_window, "post"),
+    if stop <= 0:
+        rows = range(recovery_ix)[::-1][-stop:-start]
+    else:
+        rows = range(recovery_ix, num_readings)[start:stop]
+
+    num_samples = get_num_samples(len(rows), sample_size, consecutive_samples, stride)
+    offsets = stride * np.arange(num_samples)
+    if num_samples == 0:
+        return offsets, len(rows)
+    if stop <= 0:
+        # Pre-recovery windows keep the readings closest to the recovery
+        starts = rows[0] - sample_size + 1 - offsets[::-1]
+    else:
+        starts = rows[0] + offsets
+    return starts, len(rows) - (offsets[-1] + sample_size)
+
+
+def get_samples(
+    data,
+    num_features,
+    sample_size,
+    consecutive_samples,
+    pre_window,
+    post_window,
+    stride=None,
+    dtype=DTYPE_DEFAULT,
+):
+    # Windows of all epochs are packed into one (rows, features) array, copied
+    # once per distinct column set. Samples are windows into it.
+    blocks = []
+    for i, (epoch, recovery_ix, columns) in enumerate(data):
+        for window, label, window_name in [
+            (pre_window, 0, "pre"),
+            (post_window, 1, "post"),
         ]:
-            window_samples, dropped = get_window_samples(
-                window_data, sample_size, consecutive_samples, window
+            starts, dropped = get_window_starts(
+                recovery_ix,
+                len(epoch),
+                sample_size,
+                consecutive_samples,
+                window,
+                stride,
             )
-            parsed[i][j] = window_samples
             if dropped > 0:
                 logger.debug(f"Dropped {dropped} readings from {window_name} window")
-            num_samples += len(window_samples)
+            if len(starts) == 0:
+                continue
+            first, last = starts[0], starts[-1] + sample_size
+            blocks.append((i, first, last, starts - first, label))
+
+    num_block_rows = np.array([last - first for _, first, last, _, _ in blocks])
+    offsets = np.concatenate([[0], np.cumsum(num_block_rows, dtype=np.int64)])
+    if len(blocks) == 0:
+        rows = np.empty((0, num_features), dtype=dtype)
+        return rows, np.zeros(0, dtype=np.int64), np.zeros((0, 1))
+
+    # Column permutations are worked out once per distinct column set. Sets with
+    # every feature in order are copied as plain slices.
+    column_sets = {}
+    for i, _, _, _, _ in blocks:
+        columns = tuple(data[i][2])
+        if columns not in column_sets:
+            is_ordered = columns == tuple(range(num_features))
+            column_sets[columns] = slice(None) if is_ordered else list(columns)
+    is_complete = all(type(cols) is slice for cols in column_sets.values())
+    rows = np.empty((offsets[-1], num_features), dtype=dtype)
+    if not is_complete:
+        rows[:] = np.nan
+
+    for (i, first, last, _, _), offset in zip(blocks, offsets):
+        columns = column_sets[tuple(data[i][2])]
+        rows[offset : offset + last - first, columns] = data[i][0][first:last]
+
+    num_samples = np.array([len(rel) for _, _, _, rel, _ in blocks])
+    starts = np.concatenate([rel for _, _, _, rel, _ in blocks]) + np.repeat(
+        offsets[:-1], num_samples
+    )
+    labels = np.array([label for _, _, _, _, label in blocks], dtype=float)
+    Y = np.repeat(labels, num_samples)[:, np.newaxis]
+    return rows, starts, Y
+
+
+class WindowedSamples:
+    # Samples as sample_size-row windows into a (rows, features) array.
+    # Indexing one sample returns a view, indexing many gathers a copy.
+    def __init__(self, data, starts, sample_size):
+        self.data = data
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.sample_size = sample_size
+        self.shape = (len(self.starts), sample_size, self.data.shape[1])
+        self.dtype = self.data.dtype
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            key, *rest = key
+            return self[key][(slice(None), *rest) if np.ndim(key) else tuple(rest)]
+        if np.ndim(key) == 0 and not isinstance(key, slice):
+            start = self.starts[key]
+            return self.data[start : start + self.sample_size]
 
-    return parsed, num_samples
+        starts = self.starts[key]
+        rows = starts[:, np.newaxis] + np.arange(self.sample_size)
+        return self.data[rows]
 
+    def __array__(self, dtype=None):
+        X = self[:]
+        return X if dtype is None else X.astype(dtype, copy=False)
+
+    def memory_footprint(self):
+        return {"mapped": 0, "resident": self.data.nbytes + self.starts.nbytes}
+
+
+class LazySamples(WindowedSamples):
+    # Windows into a memory-mapped store
+    def __init__(self, store_path, starts, sample_size):
+        self.store_path = str(store_path)
+        super().__init__(np.load(self.store_path, mmap_mode="r"), starts, sample_size)
+
+    def __getstate__(self):
+        # Workers reopen the memory map instead of pickling its contents
+        return {k: v for k, v in self.__dict__.items() if k != "data"}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.load(self.store_path, mmap_mode="r")
+
+    def memory_footprint(self):
+        return {"mapped": self.data.nbytes, "resident": self.starts.nbytes}
+
+
+def plan_samples(
+    hf,
+    set_types,
+    sample_size,
+    consecutive_samples,
+    pre_window,
+    post_window,
+    stride=None,
+):
+    # Sample starts and labels of each epoch window, from metadata alone
+    format_version = get_format_version(hf)
+    features = {}
+    windows = {}
+    for set_type in set_types:
+        set_windows = []
+        for length, recovery, columns in iter_epoch_metadata(
+            hf[set_type], format_version
+        ):
+            for col in columns:
+                if col not in features:
+                    features[col] = len(features)
+            epoch_windows = []
+            for window, label in [(pre_window, 0), (post_window, 1)]:
+                starts, dropped = get_window_starts(
+                    recovery, length, sample_size, consecutive_samples, window, stride
+                )
+                if dropped > 0:
+                    logger.debug(f"Dropped {dropped} readings from window")
+                epoch_windows.append((starts, label))
+            set_windows.append(epoch_windows)
+        windows[set_type] = set_windows
 
-def samples_to_tensors(samples, data_shape):
-    X = np.full(data_shape, np.nan)
-    Y = np.zeros((X.shape[0], 1))
+    return windows, features
+
+
+def get_epoch_samples(
+    epoch, columns, epoch_windows, features, sample_size, dtype=DTYPE_DEFAULT
+):
+    num_samples = sum(len(starts) for starts, _ in epoch_windows)
+    X = np.full((num_samples, sample_size, len(features)), np.nan, dtype=dtype)
+    Y = np.zeros((num_samples, 1))
+    column_numbers = [features[col] for col in columns]
 
     i = 0
-    for pre, post, features in samples:
-        for window, label in [(pre, 0), (post, 1)]:
-            window_size = len(window)
-            if window_size == 0:
-                continue
-            i_next = i + window_size
-            X[i:i_next, :, features] = window
-            Y[i:i_next] = label
-            i = i_next
+    for starts, label in epoch_windows:
+        i_next = i + len(starts)
+        rows = starts[:, np.newaxis] + np.arange(sample_size)
+        X[i:i_next, :, column_numbers] = epoch[rows]
+        Y[i:i_next] = label
+        i = i_next
 
     return X, Y
 
 
+def build_sample_store(
+    filepath,
+    set_types,
+    sample_size,
+    consecutive_samples,
+    pre_window,
+    post_window,
+    store_dir,
+    stride=None,
+    dtype=DTYPE_DEFAULT,
+):
+    load_filter_plugins()
+    with h5py.File(filepath, "r") as hf:
+        format_version = get_format_version(hf)
+        # First pass only reads metadata, to size the stores and order the features
+        windows, features = plan_samples(
+            hf,
+            set_types,
+            sample_size,
+            consecutive_samples,
+            pre_window,
+            post_window,
+            stride=stride,
+        )
+
+        datasets = {}
+        for set_type in set_types:
+            window_starts = [
+                starts for epoch in windows[set_type] for starts, _ in epoch
+            ]
+            num_samples = sum(len(starts) for starts in window_starts)
+            num_rows = sum(
+                int(starts[-1] + sample_size - starts[0])
+                for starts in window_starts
+                if len(starts) > 0
+            )
+            store_path = Path(store_dir) / f"{set_type}.npy"
+            logger.debug(f"Writing {num_samples} {set_type} samples to {store_path}")
+            # Written under a temporary name so stores that are still mapped keep their data
+            tmp_path = store_path.with_name(f".{store_path.name}")
+            store = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=dtype, shape=(num_rows, len(features)),
+            )
+            store[:] = np.nan
+            sample_starts = np.zeros(num_samples, dtype=np.int64)
+            Y = np.zeros((num_samples, 1))
+
+            # Only the rows covered by the samples of each window are stored
+            i = 0
+            row = 0
+            for (_, epoch, columns, _, _), epoch_windows in zip(
+                iter_epochs(hf[set_type], format_version, contiguous=False),
+                windows[set_type],
+            ):
+                column_numbers = [features[col] for col in columns]
+                for starts, label in epoch_windows:
+                    num_window = len(starts)
+                    if num_window == 0:
+                        continue
+                    first, last = starts[0], starts[-1] + sample_size
+                    store[row : row + last - first, column_numbers] = epoch[first:last]
+                    sample_starts[i : i + num_window] = row + starts - first
+                    Y[i : i + num_window] = label
+                    i += num_window
+                    row += last - first
+
+            store.flush()
+            del store
+            os.replace(tmp_path, store_path)
+            datasets[set_type] = (
+                LazySamples(store_path, sample_starts, sample_size),
+                Y,
+            )
+
+    features = [feat for (feat, _) in sorted(features.items(), key=lambda x: x[1])]
+    return datasets, features
+
+
+def get_store_dir(store_dir=None):
+    if store_dir is None:
+        store_dir = tempfile.mkdtemp(prefix="no_wander-")
+        atexit.register(shutil.rmtree, store_dir, ignore_errors=True)
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    return store_dir
+
+
 def read_dataset(
     filepath,
     sample_size,
@@ -101,48 +498,319 @@ def read_dataset(
     pre_window,
     post_window,
     sample_rate=SAMPLE_RATE,
+    lazy=False,
+    store_dir=None,
+    stride=None,
+    dtype=DTYPE_DEFAULT,
 ):
     logger.info(f"Reading datasets from {filepath}...")
     pre_window = tuple(int(ix * sample_rate) for ix in pre_window)
     post_window = tuple(int(ix * sample_rate) for ix in post_window)
 
-    data, features = parse_dataset(filepath, test_set=DATASET_VAL)
-    datasets = {}
-    for set_type in [DATASET_TRAIN, DATASET_VAL]:
-        samples, num_samples = get_samples(
-            data[set_type], sample_size, consecutive_samples, pre_window, post_window
+    if lazy:
+        store_dir = get_store_dir(store_dir)
+        logger.info(f"Storing memory-mapped samples in {store_dir}...")
+        datasets, features = build_sample_store(
+            filepath,
+            [DATASET_TRAIN, DATASET_VAL],
+            sample_size,
+            consecutive_samples,
+            pre_window,
+            post_window,
+            store_dir,
+            stride=stride,
+            dtype=dtype,
+        )
+    else:
+        data, features = parse_dataset(filepath, test_set=DATASET_VAL)
+        datasets = {}
+        for set_type in [DATASET_TRAIN, DATASET_VAL]:
+            rows, starts, Y = get_samples(
+                data[set_type],
+                len(features),
+                sample_size,
+                consecutive_samples,
+                pre_window,
+                post_window,
+                stride=stride,
+                dtype=dtype,
+            )
+            if np.array_equal(starts, np.arange(0, len(rows), sample_size)):
+                # Samples tile the rows exactly, so a reshape is enough
+                X = rows.reshape(-1, sample_size, len(features))
+            else:
+                X = WindowedSamples(rows, starts, sample_size)
+            datasets[set_type] = (X, Y)
+
+    for set_type, (X, _) in datasets.items():
+        if isinstance(X, WindowedSamples):
+            footprint = X.memory_footprint()
+        else:
+            footprint = {"mapped": 0, "resident": X.nbytes}
+        logger.info(
+            f"{set_type} data shape {X.shape}: {footprint['mapped'] / 1024 ** 2:.1f} MB"
+            f" mapped, {footprint['resident'] / 1024 ** 2:.1f} MB in memory"
         )
-        X, Y = samples_to_tensors(samples, (num_samples, sample_size, len(features)))
-        logger.debug(f"{set_type} data shape {X.shape}")
-        datasets[set_type] = (X, Y)
     return datasets, features
 
 
-def save_epochs(filepath, epochs):
+def get_epoch_name(timestamps):
+    return "-".join([str(int(ts)) for ts in timestamps[[0, -1]]])
+
+
+class EpochDatasets:
+    # v1 layout: one compressed dataset per epoch, metadata in attrs
+    def __init__(self, grp, filters, chunk_shape=None):
+        self.grp = grp
+        self.filters = filters
+        self.chunk_rows = None if chunk_shape is None else chunk_shape[0]
+
+    def __contains__(self, name):
+        return name in self.grp
+
+    def append(self, data, columns, name, recovery_ix, session):
+        subject, date, chunk = session.split(".")
+        chunks = None
+        if self.chunk_rows is not None:
+            # Chunks can't be bigger than a fixed-size dataset
+            chunks = (min(self.chunk_rows, data.shape[0]), data.shape[1])
+        dset = self.grp.create_dataset(name, data=data, chunks=chunks, **self.filters)
+        dset.attrs["chunk"] = chunk
+        dset.attrs["columns"] = tuple(str(col) for col in columns)
+        dset.attrs["date"] = date
+        dset.attrs["recovery"] = recovery_ix
+        dset.attrs["subject"] = subject
+
+    def flush(self):
+        pass
+
+
+class EpochTable:
+    # v2 layout: all epochs of a set are rows of one chunked 2-D array. An index
+    # table holds each epoch's offset, length and metadata, and a column set
+    # table records which of the shared columns each epoch has. Missing
+    # columns are NaN. Appended epochs are buffered and written in batches, so
+    # the datasets are resized once per batch rather than once per epoch.
+    def __init__(self, grp, filters, chunk_shape=None, buffer_rows=None):
+        self.grp = grp
+        if TABLE_INDEX not in grp:
+            self.create(filters, chunk_shape or TABLE_CHUNK_SHAPE)
+        self.data = grp[TABLE_DATA]
+        self.index = {field: grp[TABLE_INDEX][field] for field, _ in TABLE_INDEX_FIELDS}
+        self.columns_dset = grp[TABLE_COLUMNS]
+        self.column_sets_dset = grp[TABLE_COLUMN_SETS]
+        self.columns = to_str(self.columns_dset[:])
+        self.positions = {col: i for i, col in enumerate(self.columns)}
+        self.column_sets = {
+            tuple(column_set): i
+            for i, column_set in enumerate(self.column_sets_dset[:].tolist())
+        }
+        self.names = set(to_str(self.index["name"][:]))
+        self.num_rows = self.data.shape[0]
+        self.buffer_rows = buffer_rows or TABLE_BUFFER_ROWS
+        self.pending = []
+        self.pending_index = {field: [] for field, _ in TABLE_INDEX_FIELDS}
+        self.pending_rows = 0
+
+    def create(self, filters, chunk_shape):
+        str_dtype = h5py.special_dtype(vlen=str)
+        self.grp.create_dataset(
+            TABLE_DATA,
+            shape=(0, 0),
+            maxshape=(None, None),
+            chunks=tuple(chunk_shape),
+            dtype=np.float64,
+            fillvalue=np.nan,
+            **filters,
+        )
+        self.grp.create_dataset(
+            TABLE_COLUMNS, shape=(0,), maxshape=(None,), dtype=str_dtype
+        )
+        self.grp.create_dataset(
+            TABLE_COLUMN_SETS,
+            shape=(0, 0),
+            maxshape=(None, None),
+            chunks=(64, 64),
+            dtype=np.uint8,
+        )
+        index = self.grp.create_group(TABLE_INDEX)
+        for field, dtype in TABLE_INDEX_FIELDS:
+            index.create_dataset(
+                field,
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(1024,),
+                dtype=str_dtype if dtype is str else dtype,
+            )
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def get_column_set(self, columns):
+        new_columns = [col for col in columns if col not in self.positions]
+        if len(new_columns):
+            for col in new_columns:
+                self.positions[col] = len(self.columns)
+                self.columns.append(col)
+            num_columns = len(self.columns)
+            self.columns_dset.resize((num_columns,))
+            self.columns_dset[-len(new_columns) :] = new_columns
+            self.data.resize(num_columns, axis=1)
+            self.column_sets_dset.resize(num_columns, axis=1)
+            self.column_sets = {
+                column_set + (0,) * len(new_columns): i
+                for column_set, i in self.column_sets.items()
+            }
+
+        column_set = tuple(int(col in columns) for col in self.columns)
+        if column_set not in self.column_sets:
+            self.column_sets[column_set] = len(self.column_sets)
+            self.column_sets_dset.resize(len(self.column_sets), axis=0)
+            self.column_sets_dset[-1] = column_set
+        return self.column_sets[column_set]
+
+    def append(self, data, columns, name, recovery_ix, session):
+        column_set = self.get_column_set(columns)
+        positions = [self.positions[col] for col in columns]
+        length = data.shape[0]
+        self.pending.append((data, positions))
+
+        subject, date, chunk = session.split(".")
+        values = {
+            "name": name,
+            "offset": self.num_rows + self.pending_rows,
+            "length": length,
+            "recovery": recovery_ix,
+            "column_set": column_set,
+            "subject": subject,
+            "date": date,
+            "chunk": chunk,
+        }
+        for field, value in values.items():
+            self.pending_index[field].append(value)
+        self.names.add(name)
+        self.pending_rows += length
+        if self.pending_rows >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        # Columns may have been added since an epoch was buffered, so rows are
+        # only laid out now
+        rows = np.full((self.pending_rows, len(self.columns)), np.nan)
+        start = 0
+        for data, positions in self.pending:
+            rows[start : start + data.shape[0], positions] = data
+            start += data.shape[0]
+        self.data.resize(self.num_rows + self.pending_rows, axis=0)
+        self.data[self.num_rows :] = rows
+
+        num_epochs = self.index["name"].shape[0] + len(self.pending)
+        for field, dtype in TABLE_INDEX_FIELDS:
+            dset = self.index[field]
+            dset.resize((num_epochs,))
+            dset[-len(self.pending) :] = np.array(
+                self.pending_index[field], dtype=object if dtype is str else dtype
+            )
+
+        self.num_rows += self.pending_rows
+        self.pending = []
+        self.pending_index = {field: [] for field, _ in TABLE_INDEX_FIELDS}
+        self.pending_rows = 0
+
+
+class EpochWriter:
+    # splits maps each split name to a (filepath, group name) pair. Several splits
+    # can share a file, and a group name of None writes to the file root.
+    def __init__(
+        self,
+        splits,
+        mode="w",
+        format_version=FORMAT_DEFAULT,
+        compression=COMPRESSION_DEFAULT,
+        compression_level=None,
+        shuffle=True,
+        chunk_shape=None,
+    ):
+        self.splits = splits
+        self.mode = mode
+        self.format_version = format_version
+        self.filters = get_compression_kwargs(compression, compression_level, shuffle)
+        self.chunk_shape = chunk_shape
+        self.files = {}
+        self.groups = {}
+        self.counts = {split: 0 for split in splits}
+
+    def __enter__(self):
+        for split, (filepath, group_name) in self.splits.items():
+            if filepath not in self.files:
+                logger.info(f"Opening {filepath} for writing epochs...")
+                hf = h5py.File(filepath, self.mode)
+                if len(hf):
+                    # Appending keeps the layout of the existing file
+                    format_version = get_format_version(hf)
+                else:
+                    format_version = self.format_version
+                    hf.attrs[ATTR_FORMAT_VERSION] = format_version
+                self.files[filepath] = hf, format_version
+            hf, format_version = self.files[filepath]
+            grp = hf if not group_name else hf.require_group(group_name)
+            EpochGroup = EpochDatasets if format_version == FORMAT_V1 else EpochTable
+            self.groups[split] = EpochGroup(grp, self.filters, self.chunk_shape)
+        return self
+
+    def __exit__(self, *exc_info):
+        for group in self.groups.values():
+            group.flush()
+        for hf, _ in self.files.values():
+            hf.close()
+        self.files = {}
+        self.groups = {}
+
+    def write(self, split, data, columns, name, recovery_ix, session):
+        group = self.groups[split]
+        if name in group:
+            logger.warning(f"Epoch {name} already saved. Skipping...")
+            return
+        logger.debug(f"Saving epoch {name} from session {session} to {split}...")
+        group.append(data, columns, name, recovery_ix, session)
+        self.counts[split] += 1
+
+
+def save_epochs(filepath, epochs, mode="w", **writer_kwargs):
     logger.info(f"Saving epochs to {filepath}...")
     if type(epochs) is not dict:
         epochs = {None: epochs}
 
-    with h5py.File(filepath, "w") as hf:
+    splits = {group_name: (filepath, group_name) for group_name in epochs}
+    with EpochWriter(splits, mode=mode, **writer_kwargs) as writer:
         for group_name, group_epochs in epochs.items():
-            grp = hf if not group_name else hf.create_group(group_name)
             for epoch, recovery_ix, session in group_epochs:
                 data = epoch.drop(columns=[COL_MARKER_DEFAULT])
-                dset_name = "-".join([str(int(ts)) for ts in data.index[[0, -1]]])
-                subject, date, chunk = session.split(".")
-                logger.debug(
-                    f"Saving epoch {dset_name}: subject {subject}, date {date}, chunk {chunk}..."
+                writer.write(
+                    group_name,
+                    data.to_numpy(),
+                    data.columns,
+                    get_epoch_name(data.index.to_numpy()),
+                    recovery_ix,
+                    session,
                 )
-
-                dset = grp.create_dataset(
-                    dset_name,
-                    data=data.to_numpy(),
-                    compression="gzip",
-                    compression_opts=9,
-                )
-                dset.attrs["chunk"] = chunk
-                dset.attrs["columns"] = tuple(data.columns)
-                dset.attrs["date"] = date
-                dset.attrs["recovery"] = recovery_ix
-                dset.attrs["subject"] = subject
     logger.info("Epochs saved!")
+
+
+def convert_epochs(src_path, dst_path, format_version=FORMAT_DEFAULT, **writer_kwargs):
+    logger.info(f"Converting {src_path} to format v{format_version} at {dst_path}...")
+    load_filter_plugins()
+    with h5py.File(src_path, "r") as src:
+        groups, src_version = get_epoch_groups(src)
+        splits = {group_name: (dst_path, group_name) for group_name in groups}
+        with EpochWriter(
+            splits, format_version=format_version, **writer_kwargs
+        ) as writer:
+            for group_name, grp in groups.items():
+                for name, data, columns, recovery, session in iter_epochs(
+                    grp, src_version
+                ):
+                    writer.write(group_name, data, columns, name, recovery, session)
+    logger.info(f"Converted {sum(writer.counts.values())} epochs!")
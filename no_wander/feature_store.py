@@ -0,0 +1,60 @@
+import hashlib
+import json
+import numpy as np
+from pathlib import Path
+
+FEATURE_STORE_SUFFIX = ".features.h5"
+KEY_DTYPE = "S40"
+
+
+def get_feature_store_path(data_file):
+    data_file = Path(data_file).resolve()
+    return data_file.with_name(f"{data_file.stem}{FEATURE_STORE_SUFFIX}")
+
+
+def get_sample_keys(X):
+    return np.array([hashlib.sha1(x.tobytes()).hexdigest() for x in X], dtype=KEY_DTYPE)
+
+
+def update_key_index(grp, key_index):
+    # Rows are only ever appended, so only keys added since the last call are read
+    num_indexed = len(key_index)
+    if "keys" in grp and grp["keys"].shape[0] > num_indexed:
+        new_keys = grp["keys"][num_indexed:].tolist()
+        key_index.update(zip(new_keys, range(num_indexed, num_indexed + len(new_keys))))
+    return key_index
+
+
+def read_stored_features(grp, keys, key_index=None):
+    # key_index maps stored keys to rows, and is kept up to date across calls
+    key_index = update_key_index(grp, {} if key_index is None else key_index)
+    positions = np.array(
+        [key_index.get(key, -1) for key in keys.tolist()], dtype=np.int64
+    )
+    found = positions >= 0
+    if not found.any():
+        return None, found
+
+    # h5py reads increasing, unique rows, without reading the rest of the store
+    rows, inverse = np.unique(positions[found], return_inverse=True)
+    return grp["features"][rows][inverse.ravel()], found
+
+
+def read_stored_metadata(grp):
+    return json.loads(grp.attrs["extractor"]), json.loads(grp.attrs["features"])
+
+
+def write_stored_features(grp, keys, X, extractor, features):
+    if "keys" not in grp:
+        grp.create_dataset("keys", data=keys, maxshape=(None,), chunks=True)
+        grp.create_dataset(
+            "features", data=X, maxshape=(None, X.shape[-1]), chunks=True
+        )
+        grp.attrs["extractor"] = json.dumps(extractor)
+        grp.attrs["features"] = json.dumps(features)
+        return
+
+    num_stored = grp["keys"].shape[0]
+    for name, data in [("keys", keys), ("features", X)]:
+        grp[name].resize(num_stored + len(data), axis=0)
+        grp[name][num_stored:] = data
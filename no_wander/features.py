@@ -1,11 +1,42 @@
+import h5py
+import logging
 import numpy as np
+import os
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+from .cache import get_cache_key
 from .constants import (
+    EXTRACTOR_BANDPOWER,
+    EXTRACTOR_CORRELATION,
+    EXTRACTOR_GRAPH,
+    EXTRACTOR_TIME,
+    EXTRACTOR_WAVELET,
     PREPROCESS_EXTRACT_EEG,
     PREPROCESS_NONE,
     PREPROCESS_NORMALIZE,
+    PSD_MULTITAPER,
+    PSD_PERIODOGRAM,
+    PSD_WELCH,
     SAMPLE_RATE,
+    SCALER_ROBUST,
+    SCALER_STREAMING,
 )
-
+from .feature_store import (
+    get_sample_keys,
+    read_stored_features,
+    read_stored_metadata,
+    write_stored_features,
+)
+from .scaling import StreamingRobustScaler
+
+CHUNK_SIZE_DEFAULT = 1024
+# Bump whenever extracted feature values or layout change, so stored rows are not reused
+EXTRACTOR_VERSION = 2
+GRAPH_CHUNK_SIZE = 32
+PSD_FMAX = 110
+TIME_CHUNK_SIZE = 1024
+WELCH_SEGMENT_SIZE = SAMPLE_RATE // 2
 FREQ_BANDS = [
     ["delta", 0],
     ["theta", 4],
@@ -15,85 +46,146 @@ FREQ_BANDS = [
     ["gamma2", 65],
 ]
 
+logger = logging.getLogger(__name__)
+
+
+def get_compute_dtype(X):
+    # float16 is only meant for storage, so compute in at least float32
+    return np.promote_types(X.dtype, np.float32)
+
 
 def get_eeg_data(X_raw, features):
     features_eeg = [col for col in features if "EEG_" in col]
-    X_eeg = np.nan_to_num(X_raw[:, :, np.isin(features, features_eeg)], 0)
+    # Indexing already makes a copy, so NaNs can be replaced in place
+    X_eeg = np.nan_to_num(
+        X_raw[:, :, np.isin(features, features_eeg)].astype(
+            get_compute_dtype(X_raw), copy=False
+        ),
+        copy=False,
+    )
     # For most of our EEG feature extractors, it's easier to reason about the computation
     # if the array is (epochs, channels, time)
     X_eeg = X_eeg.swapaxes(2, 1)
     return X_eeg, [col.replace("EEG_", "") for col in features_eeg]
 
 
-def get_zero_crossings(data):
-    is_2d = len(data.shape) == 2
-    if is_2d:
-        data = np.array([data])
-    positive = data > 0
-    crossings = np.bitwise_xor(positive[:, :, 1:], positive[:, :, :-1])
-    return crossings[0] if is_2d else crossings
-
-
-def extract_time_features(X):
-    from scipy import stats
-
-    enrichers = [
-        ("mean", np.mean, {}),
-        ("var", np.var, {}),
-        ("stddev", np.std, {}),
-        ("skew", stats.skew, {}),
-        ("kurtosis", stats.kurtosis, {}),
-        (
-            "zero_xings",
-            lambda x, **kwargs: np.count_nonzero(get_zero_crossings(x), **kwargs),
-            {},
-        ),
-        ("p2p", lambda x, **kwargs: x.max(**kwargs) - x.min(**kwargs), {}),
-        (
-            "aauc",
-            lambda x, **kwargs: np.trapz(np.abs(x), **kwargs),
-            {"dx": 1 / SAMPLE_RATE},
-        ),
+def get_time_features(X, out):
+    # All time features of (epochs, channels, time) in one pass over shared
+    # intermediates, written to out as (epochs, feature, channels)
+    num_readings = X.shape[-1]
+    mean = X.mean(axis=-1, keepdims=True)
+    centered = X - mean
+    squared = np.square(centered)
+    m2 = squared.mean(axis=-1)
+    m3 = np.einsum("...i,...i->...", squared, centered) / num_readings
+    m4 = np.einsum("...i,...i->...", squared, squared) / num_readings
+    # Matches scipy.stats skew and kurtosis for (nearly) constant channels
+    is_constant = m2 <= (np.finfo(X.dtype).resolution * mean[..., 0]) ** 2
+    m2_nonzero = np.where(is_constant, 1, m2)
+
+    out[:, 0] = mean[..., 0]
+    out[:, 1] = m2
+    out[:, 2] = np.sqrt(m2)
+    out[:, 3] = np.where(is_constant, 0, m3 / m2_nonzero ** 1.5)
+    out[:, 4] = np.where(is_constant, 0, m4 / m2_nonzero ** 2) - 3
+
+    positive = X > 0
+    out[:, 5] = np.count_nonzero(positive[..., 1:] != positive[..., :-1], axis=-1)
+    out[:, 6] = X.max(axis=-1) - X.min(axis=-1)
+    # Trapezoidal area under |x|, reusing the centered buffer
+    abs_x = np.abs(X, out=centered)
+    out[:, 7] = (
+        abs_x.sum(axis=-1) - (abs_x[..., 0] + abs_x[..., -1]) / 2
+    ) / SAMPLE_RATE
+
+
+def extract_time_features(X, chunk_size=TIME_CHUNK_SIZE):
+    features = [
+        "mean",
+        "var",
+        "stddev",
+        "skew",
+        "kurtosis",
+        "zero_xings",
+        "p2p",
+        "aauc",
     ]
-    X_enriched = np.concatenate(
-        [enrich(X, axis=-1, **kwargs) for (_, enrich, kwargs) in enrichers], axis=-1,
-    )
+    num_epochs, num_channels = X.shape[:2]
+    X_enriched = np.empty((num_epochs, len(features), num_channels), dtype=X.dtype)
+    # Chunks bound the size of temporaries for large datasets
+    chunk_size = chunk_size or max(num_epochs, 1)
+    for start in range(0, num_epochs, chunk_size):
+        stop = start + chunk_size
+        get_time_features(X[start:stop], X_enriched[start:stop])
 
-    return X_enriched, None, [feat for (feat, _, _) in enrichers]
+    return X_enriched.reshape(num_epochs, -1), None, features
 
 
-def extract_frequency_features(X):
-    from mne.time_frequency import psd_array_multitaper
-    from pywt import wavedec
+def get_psd(X, psd=PSD_MULTITAPER):
+    # One-sided power spectral densities of (epochs, channels, time) up to PSD_FMAX
+    if psd == PSD_MULTITAPER:
+        from mne.time_frequency import psd_array_multitaper
+
+        psds, freqs = psd_array_multitaper(X, SAMPLE_RATE, fmax=PSD_FMAX)
+    elif psd == PSD_WELCH:
+        from scipy.signal import welch
+
+        nperseg = min(X.shape[-1], WELCH_SEGMENT_SIZE)
+        freqs, psds = welch(X, SAMPLE_RATE, nperseg=nperseg, axis=-1)
+    elif psd == PSD_PERIODOGRAM:
+        from scipy.signal import periodogram
+
+        freqs, psds = periodogram(X, SAMPLE_RATE, axis=-1)
+    else:
+        raise ValueError(f"Unknown PSD method {psd}")
+
+    is_kept = freqs <= PSD_FMAX
+    return psds[..., is_kept], freqs[is_kept]
 
-    psds, freqs = psd_array_multitaper(X, SAMPLE_RATE, fmax=110)
-    bands = [(name, 0) for (name, _) in FREQ_BANDS]
-    num_bands = len(bands)
 
-    total = psds.sum(axis=-1)
+def get_band_bounds(freqs):
+    # Bands are contiguous ranges of the sorted frequencies, as [start, stop) indices
+    fmins = [fmin for (_, fmin) in FREQ_BANDS]
+    starts = np.searchsorted(freqs, fmins, side="left")
+    return starts, np.append(starts[1:], len(freqs))
+
+
+def extract_bandpower_features(X, psd=PSD_MULTITAPER):
+    psds, freqs = get_psd(X, psd=psd)
+    starts, stops = get_band_bounds(freqs)
+
+    # Band powers of every epoch and channel at once, from cumulative sums
+    cumulative = np.zeros((*psds.shape[:-1], psds.shape[-1] + 1), dtype=psds.dtype)
+    np.cumsum(psds, axis=-1, out=cumulative[..., 1:])
+    total = cumulative[..., -1]
     total_no_zeros = np.where(total > 0, total, 1)
-    for i in range(num_bands):
-        fmin = FREQ_BANDS[i][1]
-        fmax = (freqs[-1] + 1) if i == (num_bands - 1) else FREQ_BANDS[i + 1][1]
-        bands[i][1] = (
-            psds[:, :, (freqs >= fmin) & (freqs < fmax)].sum() / total_no_zeros
-        )
-    bands.append(["energy", total])
+    power = (cumulative[..., stops] - cumulative[..., starts]) / total_no_zeros[
+        ..., np.newaxis
+    ]
+
+    # (epochs, channels, bands) -> (epochs, bands * channels), bands first
+    X_enriched = np.concatenate(
+        [power.swapaxes(2, 1).reshape(X.shape[0], -1), total], axis=-1
+    )
+    features = [name for (name, _) in FREQ_BANDS] + ["energy"]
+    return X_enriched.astype(X.dtype, copy=False), {"psd": psd}, features
+
+
+def extract_wavelet_features(X):
+    from pywt import wavedec
 
     dwt_level = 7
     wavelet = "db4"
     coeff_approx, coeff_detail = wavedec(X, wavelet, level=dwt_level)[:2]
     X_enriched = np.concatenate(
-        [band for (_, band) in bands]
-        + [
+        [
             coeff_approx.swapaxes(2, 1).reshape(X.shape[0], -1),
             coeff_detail.swapaxes(2, 1).reshape(X.shape[0], -1),
         ],
         axis=-1,
-    )
+    ).astype(X.dtype, copy=False)
 
-    features = [band for (band, _) in bands]
-    features += [f"cA{dwt_level}_{i}" for i in range(coeff_approx.shape[-1])]
+    features = [f"cA{dwt_level}_{i}" for i in range(coeff_approx.shape[-1])]
     features += [f"cD{dwt_level}_{i}" for i in range(coeff_detail.shape[-1])]
 
     extractor = {"wavedec": {"wavelet": wavelet, "level": dwt_level}}
@@ -118,58 +210,41 @@ def extract_epoch_graph_features(W):
     ]
 
 
-def extract_epoch_correlation_features(X, lag_size, num_lags):
-    # Since correlation is symmetric, we only need half the lags
-    # C_xy(-t) = C_yx(t)
-    num_lags = num_lags // 2 + 1
-
-    X_lagged = np.full((*X.shape, num_lags), np.nan)
-    X_lagged[:, :, 0] = X - X.mean(axis=-1, keepdims=True)
-
-    for i in range(1, num_lags):
-        lag = lag_size * i
-        X_lagged[:, :-lag, i] = X_lagged[:, lag:, 0]
-
-    X_lagged = X_lagged.swapaxes(2, 1).reshape(-1, X.shape[1])
-    # Time-lagged signals have different lengths
-    weights = np.logical_not(np.isnan(X_lagged)).sum(axis=-1)
-    weights = X.shape[1] / np.minimum(weights[:, np.newaxis], weights[np.newaxis, :])
-
-    cov = np.nan_to_num(np.cov(X_lagged, rowvar=True) * weights, 0)
-    # cov[i, t1, j, t2] represents covariance of channel i lagged by t1 with channel j lagged by t2
-    cov = cov.reshape(X.shape[0], num_lags, X.shape[0], num_lags)
+def get_epoch_graph_features(W):
+    return np.concatenate([np.ravel(feat) for feat in extract_epoch_graph_features(W)])
 
-    channels = np.arange(X.shape[0])
-    autocorr = cov[channels, 0, channels].reshape(channels.size, -1)
-    decorr_t = np.argmax(get_zero_crossings(autocorr), axis=-1).astype(np.float)
-    decorr_t *= lag_size / SAMPLE_RATE
 
-    var = cov[channels, 0, channels, 0].reshape(channels.size, 1)
-    denom = np.sqrt(np.matmul(var, var.T))
+def extract_graph_features(corr, pool=None):
+    if pool is None or len(corr) <= GRAPH_CHUNK_SIZE:
+        return [get_epoch_graph_features(W) for W in corr]
 
-    corr = np.abs(cov).max(axis=(-1, 1)) / np.where(denom == 0, np.inf, denom)
-    graph = extract_epoch_graph_features(corr)
-    corr = corr[np.tril_indices(corr.shape[0], -1)]
+    # imap keeps epochs in order, chunks amortize sending matrices to workers
+    return list(pool.imap(get_epoch_graph_features, corr, chunksize=GRAPH_CHUNK_SIZE))
 
-    return np.concatenate([corr, decorr_t, *graph])
 
+def get_correlation_matrices(X):
+    # Absolute Pearson correlation between the channels of every epoch at once,
+    # (epochs, channels, time) -> (epochs, channels, channels)
+    X = X - X.mean(axis=-1, keepdims=True)
+    cov = np.matmul(X, X.swapaxes(-1, -2))
+    var = np.diagonal(cov, axis1=-2, axis2=-1)
+    denom = np.sqrt(var[:, :, np.newaxis] * var[:, np.newaxis, :])
+    return np.abs(cov) / np.where(denom == 0, np.inf, denom)
 
-def extract_correlation_features(X, channels):
-    lag_size = 4
-    num_lags = 2 ** int(np.log2(0.5 * X.shape[2] / lag_size))
 
+def extract_correlation_features(X, channels, corr, pool=None):
     num_epochs = X.shape[0]
     num_channels = len(channels)
-    num_features = (
-        +(num_channels * (num_channels - 1)) // 2  # cross-correlation
-        + num_channels  # decorrelation-time
-        + 4 * num_channels  # graph (local)
-        + 4  # graph (global)
-    )
-    X_corr = np.zeros((num_epochs, num_features))
 
-    for i in range(num_epochs):
-        X_corr[i] = extract_epoch_correlation_features(X[i], lag_size, num_lags)
+    X_corr = np.concatenate(
+        [
+            corr[(slice(None), *np.tril_indices(num_channels, -1))],
+            # Lagged covariances used to be NaN-padded to zero, so decorrelation
+            # time was always 0. Kept so the feature layout doesn't change.
+            np.zeros((num_epochs, num_channels)),
+        ],
+        axis=-1,
+    ).astype(X.dtype, copy=False)
 
     features_corr = [
         f"{channels[i]}_{col2}_corr"
@@ -177,65 +252,343 @@ def extract_correlation_features(X, channels):
         for col2 in channels[i + 1 :]
     ]
     features_corr += [f"{col}_decor_t" for col in channels]
-    features_corr += [
+    return X_corr, None, features_corr
+
+
+def extract_network_features(X, channels, corr, pool=None):
+    num_channels = len(channels)
+    graph = extract_graph_features(corr, pool=pool)
+    X_graph = np.reshape(graph, (X.shape[0], 4 * num_channels + 4)).astype(
+        X.dtype, copy=False
+    )
+
+    features_graph = [
         f"{col}_{feat}"
         for feat in ["clust_coef", "eff", "centrality", "ecc"]
         for col in channels
     ]
-    features_corr += ["charpath", "eff", "radius", "diameter"]
+    features_graph += ["charpath", "eff", "radius", "diameter"]
+    return X_graph, None, features_graph
+
+
+# Extractors run in this order. Per-channel extractors only see the EEG data and
+# their features are named per channel. The others also get the channel
+# correlation matrices, computed once for all of them, and the worker pool, if
+# any. Costs are rough estimates per epoch,
+# relative to time features, with the default options.
+FEATURE_EXTRACTORS = {
+    EXTRACTOR_TIME: {"extract": extract_time_features, "per_channel": True, "cost": 1},
+    EXTRACTOR_BANDPOWER: {
+        "extract": extract_bandpower_features,
+        "per_channel": True,
+        "cost": 40,
+        "options": ["psd"],
+    },
+    EXTRACTOR_WAVELET: {
+        "extract": extract_wavelet_features,
+        "per_channel": True,
+        "cost": 2,
+    },
+    EXTRACTOR_CORRELATION: {
+        "extract": extract_correlation_features,
+        "per_channel": False,
+        "cost": 1,
+    },
+    EXTRACTOR_GRAPH: {
+        "extract": extract_network_features,
+        "per_channel": False,
+        "cost": 100,
+    },
+}
+EXTRACTORS_DEFAULT = list(FEATURE_EXTRACTORS)
+
+
+def get_extractors(extractors=None):
+    if extractors is None:
+        return list(EXTRACTORS_DEFAULT)
+    unknown = set(extractors) - set(FEATURE_EXTRACTORS)
+    if unknown:
+        raise ValueError(f"Unknown feature extractors {', '.join(sorted(unknown))}")
+    return [name for name in FEATURE_EXTRACTORS if name in extractors]
+
+
+def compute_eeg_features(X_eeg, channels, extractors=None, pool=None, **options):
+    extractors = get_extractors(extractors)
+    cost = sum(FEATURE_EXTRACTORS[name]["cost"] for name in extractors)
+    logger.info(
+        f"Extracting {', '.join(extractors)} features"
+        f" (estimated cost {cost} per epoch, relative to time features)..."
+    )
 
-    return X_corr, None, features_corr
+    X_enriched = []
+    extractor = {}
+    features = []
+    corr = None
+    for name in extractors:
+        params = FEATURE_EXTRACTORS[name]
+        kwargs = {
+            key: options[key] for key in params.get("options", []) if key in options
+        }
+        if params["per_channel"]:
+            X, extractor[name], enriched = params["extract"](X_eeg, **kwargs)
+            enriched = [f"{ch}_{enrich}" for enrich in enriched for ch in channels]
+        else:
+            if corr is None:
+                corr = get_correlation_matrices(X_eeg)
+            X, extractor[name], enriched = params["extract"](
+                X_eeg, channels, corr, pool=pool, **kwargs
+            )
+        X_enriched.append(X)
+        features += enriched
+
+    return np.concatenate(X_enriched, axis=-1), extractor, features
+
+
+def get_stored_eeg_features(
+    X_eeg,
+    channels,
+    store_path,
+    extractors=None,
+    pool=None,
+    key_indexes=None,
+    **options,
+):
+    extractors = get_extractors(extractors)
+    keys = get_sample_keys(X_eeg)
+    try:
+        hf = h5py.File(store_path, "a")
+    except OSError as error:
+        logger.warning(f"Could not open feature store {store_path}: {error}")
+        return compute_eeg_features(
+            X_eeg, channels, extractors=extractors, pool=pool, **options
+        )
 
+    with hf:
+        grp = hf.require_group(
+            get_cache_key(
+                EXTRACTOR_VERSION, extractors, options, channels, X_eeg.dtype.name
+            )
+        )
+        key_index = (
+            None if key_indexes is None else key_indexes.setdefault(grp.name, {})
+        )
+        X_stored, found = read_stored_features(grp, keys, key_index)
+        logger.info(f"{found.sum()} of {len(keys)} samples found in feature store")
+        if found.all():
+            extractor, features = read_stored_metadata(grp)
+            return X_stored.astype(X_eeg.dtype, copy=False), extractor, features
+
+        # Duplicate samples are only extracted once
+        missing = np.logical_not(found)
+        keys_new, ix_new, inverse = np.unique(
+            keys[missing], return_index=True, return_inverse=True
+        )
+        X_new, extractor, features = compute_eeg_features(
+            X_eeg[missing][ix_new],
+            channels,
+            extractors=extractors,
+            pool=pool,
+            **options,
+        )
+        write_stored_features(grp, keys_new, X_new, extractor, features)
+
+    X = np.empty((len(keys), X_new.shape[-1]), dtype=X_new.dtype)
+    X[missing] = X_new[inverse.ravel()]
+    if X_stored is not None:
+        X[found] = X_stored
+    return X, extractor, features
 
-def extract_eeg_features(X_raw, features):
-    X_eeg, channels = get_eeg_data(X_raw, features)
 
-    X_time, extractor_time, features_time = extract_time_features(X_eeg)
-    X_freq, extractor_freq, features_freq = extract_frequency_features(X_eeg)
-    X_corr, extractor_corr, features_corr = extract_correlation_features(
-        X_eeg, channels
+def extract_eeg_chunk(X_raw, features, store_path=None, key_indexes=None, **kwargs):
+    X_eeg, channels = get_eeg_data(X_raw, features)
+    if store_path is None or len(X_eeg) == 0:
+        return compute_eeg_features(X_eeg, channels, **kwargs)
+    return get_stored_eeg_features(
+        X_eeg, channels, store_path, key_indexes=key_indexes, **kwargs
     )
 
-    X_enriched = np.concatenate([X_time, X_freq, X_corr], axis=-1)
-    features = features_time + features_freq
-    features = [f"{channel}_{enrich}" for enrich in features for channel in channels]
-    features += features_corr
 
-    extractor = {"time": extractor_time, "freq": extractor_freq, "corr": extractor_corr}
-    return X_enriched, extractor, features
+def map_chunks(func, X_raw, chunk_size=None, out_file=None, dtype=None):
+    # func maps materialized samples to a tuple of (output samples, *details).
+    # Only one chunk of samples and its output are in memory at a time, on top
+    # of the preallocated output.
+    num_samples = len(X_raw)
+    is_lazy = not isinstance(X_raw, np.ndarray) or isinstance(X_raw, np.memmap)
+    if (chunk_size is None and out_file is None and not is_lazy) or num_samples == 0:
+        return func(np.asarray(X_raw, dtype=dtype))
+
+    # Lazy samples and outputs to a file are never materialized all at once
+    chunk_size = chunk_size or CHUNK_SIZE_DEFAULT
+    if out_file is not None:
+        out_file = Path(out_file)
+        tmp_file = out_file.with_name(f".{out_file.name}")
+    X = None
+    for start in range(0, num_samples, chunk_size):
+        stop = min(start + chunk_size, num_samples)
+        logger.debug(f"Preprocessing samples {start} to {stop}...")
+        X_chunk, *details = func(np.asarray(X_raw[start:stop], dtype=dtype))
+        if X is None:
+            shape = (num_samples, *X_chunk.shape[1:])
+            if out_file is None:
+                X = np.empty(shape, dtype=X_chunk.dtype)
+            else:
+                X = np.lib.format.open_memmap(
+                    tmp_file, mode="w+", dtype=X_chunk.dtype, shape=shape
+                )
+        X[start:stop] = X_chunk
+
+    if out_file is not None:
+        X.flush()
+        # Replaced at the end, so files that are still mapped keep their data
+        os.replace(tmp_file, out_file)
+    return (X, *details)
+
+
+def extract_eeg_features(
+    X_raw,
+    features,
+    extractors=None,
+    workers=1,
+    store_path=None,
+    chunk_size=None,
+    out_file=None,
+    dtype=None,
+    **options,
+):
+    pool = None
+    if workers > 1 and EXTRACTOR_GRAPH in get_extractors(extractors):
+        # One pool for every chunk, instead of forking workers per chunk
+        logger.info(f"Extracting graph features with {workers} workers...")
+        pool = Pool(workers)
+    try:
+        return map_chunks(
+            partial(
+                extract_eeg_chunk,
+                features=features,
+                extractors=extractors,
+                pool=pool,
+                store_path=store_path,
+                # Stored keys are indexed once per run instead of once per chunk
+                key_indexes={},
+                **options,
+            ),
+            X_raw,
+            chunk_size=chunk_size,
+            out_file=out_file,
+            dtype=dtype,
+        )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
-def normalize_data(X_raw):
-    from sklearn.preprocessing import RobustScaler
+def scale_samples(scaler, X_raw):
+    X_raw = X_raw.astype(get_compute_dtype(X_raw), copy=False)
+    X = scaler.transform(X_raw.reshape(-1, X_raw.shape[-1])).reshape(X_raw.shape)
+    return (X,)
 
-    scaler = RobustScaler()
-    X = scaler.fit_transform(X_raw.reshape(-1, X_raw.shape[-1])).reshape(X_raw.shape)
-    return X, {"scaler": scaler}
 
+def normalize_data(X_raw, scaler=SCALER_ROBUST, chunk_size=None, out_file=None):
+    if scaler == SCALER_ROBUST:
+        from sklearn.preprocessing import RobustScaler
+
+        # Lazy datasets are only materialized in full for an exact RobustScaler
+        X_raw = np.asarray(X_raw)
+        X_raw = X_raw.astype(get_compute_dtype(X_raw), copy=False)
+        scaler = RobustScaler()
+        X = scaler.fit_transform(X_raw.reshape(-1, X_raw.shape[-1])).reshape(
+            X_raw.shape
+        )
+        return X, {"scaler": scaler}
+    elif scaler != SCALER_STREAMING:
+        raise ValueError(f"Unknown scaler {scaler}")
+
+    # Quantiles are estimated in one pass over chunks of samples
+    scaler = StreamingRobustScaler()
+    chunk_size = chunk_size or CHUNK_SIZE_DEFAULT
+    for start in range(0, len(X_raw), chunk_size):
+        X_chunk = np.asarray(X_raw[start : start + chunk_size])
+        X_chunk = X_chunk.astype(get_compute_dtype(X_chunk), copy=False)
+        scaler.partial_fit(X_chunk.reshape(-1, X_chunk.shape[-1]))
+    (X,) = map_chunks(
+        partial(scale_samples, scaler), X_raw, chunk_size=chunk_size, out_file=out_file
+    )
+    return X, {"scaler": scaler}
 
-def preprocess_data_train(X_raw, preprocess, features_raw):
-    preprocessor = {"preprocess": preprocess, "features_raw": features_raw}
 
+def preprocess_data_train(
+    X_raw,
+    preprocess,
+    features_raw,
+    extractors=None,
+    psd=PSD_MULTITAPER,
+    scaler=SCALER_ROBUST,
+    workers=1,
+    feature_store=None,
+    chunk_size=None,
+    out_file=None,
+):
+    preprocessor = {
+        "preprocess": preprocess,
+        "features_raw": features_raw,
+        "dtype": np.dtype(X_raw.dtype).name,
+    }
     if preprocess == PREPROCESS_EXTRACT_EEG:
-        X, extractor, features = extract_eeg_features(X_raw, features_raw)
+        extractors = get_extractors(extractors)
+        X, extractor, features = extract_eeg_features(
+            X_raw,
+            features_raw,
+            extractors=extractors,
+            workers=workers,
+            store_path=feature_store,
+            chunk_size=chunk_size,
+            out_file=out_file,
+            psd=psd,
+        )
+        preprocessor["extractors"] = extractors
+        preprocessor["psd"] = psd
         return X, {**preprocessor, **extractor}, features, True
     elif preprocess == PREPROCESS_NONE:
         return X_raw, preprocessor, features_raw, False
     elif preprocess == PREPROCESS_NORMALIZE:
-        X, scaler = normalize_data(X_raw)
+        X, scaler = normalize_data(
+            X_raw, scaler=scaler, chunk_size=chunk_size, out_file=out_file
+        )
         return X, {**preprocessor, **scaler}, features_raw, False
     raise ValueError(f"Unknown preprocessing type {preprocess}")
 
 
-def preprocess_data_test(X_raw, preprocessor):
+def preprocess_data_test(
+    X_raw, preprocessor, workers=1, feature_store=None, chunk_size=None, out_file=None
+):
     preprocess = preprocessor["preprocess"]
+    # Test data is transformed in the same precision as training data
+    dtype = preprocessor.get("dtype", None)
 
     if preprocess == PREPROCESS_EXTRACT_EEG:
-        X, _, _ = extract_eeg_features(X_raw, preprocessor["features_raw"])
+        X, _, _ = extract_eeg_features(
+            X_raw,
+            preprocessor["features_raw"],
+            # Preprocessors saved before extractors could be selected used all of them
+            extractors=preprocessor.get("extractors", None),
+            workers=workers,
+            store_path=feature_store,
+            chunk_size=chunk_size,
+            out_file=out_file,
+            dtype=dtype,
+            psd=preprocessor.get("psd", PSD_MULTITAPER),
+        )
         return X
     elif preprocess == PREPROCESS_NONE:
         return X_raw
     elif preprocess == PREPROCESS_NORMALIZE:
-        scaler = preprocessor["scaler"]
-        return scaler.transform(X_raw.reshape(-1, X_raw.shape[-1])).reshape(X_raw.shape)
+        (X,) = map_chunks(
+            partial(scale_samples, preprocessor["scaler"]),
+            X_raw,
+            chunk_size=chunk_size,
+            out_file=out_file,
+            dtype=dtype,
+        )
+        return X
     raise ValueError(f"Unknown preprocessing type {preprocess}")
@@ -14,6 +14,7 @@ from tensorflow.keras.layers import (
 from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.utils import plot_model
+from ..performance import PerformanceRecorder
 from .layers import add_layer
 from .constants import (
     LAYER_POSITION_ENCODING,
@@ -25,18 +26,48 @@ from .constants import (
 logger = logging.getLogger(__name__)
 
 
+def print_gradient_metrics(metrics, epoch, is_chart_created):
+    print("")
+    for metric, value in metrics.items():
+        if metric not in is_chart_created:
+            print(json.dumps({"chart": metric, "axis": "epoch"}))
+            is_chart_created[metric] = True
+        print(json.dumps({"chart": metric, "x": epoch, "y": float(value)}))
+    print("")
+
+
 class GradientMetricsCallback(Callback):
     def on_epoch_end(self, epoch, logs):
         if not hasattr(self, "is_chart_created"):
             self.is_chart_created = {}
+        print_gradient_metrics(logs, epoch, self.is_chart_created)
+
+
+class PerformanceCallback(Callback):
+    def __init__(
+        self, output_dir, batch_size, input_timer=None, gradient_metrics=False
+    ):
+        super().__init__()
+        self.recorder = PerformanceRecorder(output_dir, batch_size, input_timer)
+        self.gradient_metrics = gradient_metrics
+        self.is_chart_created = {}
+
+    def on_train_begin(self, logs=None):
+        self.recorder.train_begin()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.recorder.epoch_begin()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.recorder.batch_begin()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.recorder.batch_end(batch)
 
-        print("")
-        for metric, value in logs.items():
-            if metric not in self.is_chart_created:
-                print(json.dumps({"chart": metric, "axis": "epoch"}))
-                self.is_chart_created[metric] = True
-            print(json.dumps({"chart": metric, "x": epoch, "y": float(value)}))
-        print("")
+    def on_epoch_end(self, epoch, logs=None):
+        metrics = self.recorder.epoch_end(epoch)
+        if metrics is not None and self.gradient_metrics:
+            print_gradient_metrics(metrics, epoch, self.is_chart_created)
 
 
 def count_layers(layers):
@@ -120,9 +151,10 @@ def fit_model(
     checkpoint_path=None,
     tensorboard_path=None,
     gradient_metrics=False,
+    callbacks=(),
     **kwargs,
 ):
-    callbacks = []
+    callbacks = list(callbacks)
     if checkpoint_path is not None:
         checkpoint_path = str(checkpoint_path)
         logger.debug(f"Model with best val_loss will be saved to {checkpoint_path}")
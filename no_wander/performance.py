@@ -0,0 +1,99 @@
+import csv
+import json
+import logging
+import sys
+from pathlib import Path
+from time import perf_counter, time
+
+PERFORMANCE_BATCHES_FILENAME = "performance.csv"
+PERFORMANCE_EPOCHS_FILENAME = "performance.json"
+# A step waiting on input most of its time means the run is input-bound
+INPUT_BOUND_FRACTION = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+def get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak_rss / 1024 ** (2 if sys.platform == "darwin" else 1)
+
+
+class InputTimer:
+    # A step waits on input from when it starts until its batch leaves the input
+    # queue, at the wall clock time read by get_ready_time
+    def __init__(self, get_ready_time):
+        self.get_ready_time = get_ready_time
+
+    def step_begin(self):
+        self.step_start = time()
+
+    def step_end(self):
+        return max(0.0, self.get_ready_time() - self.step_start)
+
+
+class PerformanceRecorder:
+    def __init__(self, output_dir, batch_size, input_timer=None):
+        self.output_dir = Path(output_dir)
+        self.batch_size = batch_size
+        self.input_timer = input_timer
+        self.epochs = []
+
+    def train_begin(self):
+        with open(self.output_dir / PERFORMANCE_BATCHES_FILENAME, "w") as f:
+            csv.writer(f).writerow(
+                ["epoch", "batch", "step_seconds", "input_wait_seconds", "peak_rss_mb"]
+            )
+
+    def epoch_begin(self):
+        self.batches = []
+        self.epoch_start = self.last_batch_end = perf_counter()
+
+    def batch_begin(self):
+        if self.input_timer is not None:
+            self.input_timer.step_begin()
+        self.batch_start = perf_counter()
+
+    def batch_end(self, batch):
+        self.last_batch_end = perf_counter()
+        step_seconds = self.last_batch_end - self.batch_start
+        wait_seconds = None
+        if self.input_timer is not None:
+            wait_seconds = self.input_timer.step_end()
+        self.batches.append((batch, step_seconds, wait_seconds, get_peak_rss_mb()))
+
+    def epoch_end(self, epoch):
+        if not self.batches:
+            return None
+        # Appended every epoch, so an interrupted run keeps its measurements
+        with open(self.output_dir / PERFORMANCE_BATCHES_FILENAME, "a") as f:
+            csv.writer(f).writerows([(epoch, *batch) for batch in self.batches])
+
+        _, step_seconds, wait_seconds, peak_rss_mb = zip(*self.batches)
+        train_seconds = self.last_batch_end - self.epoch_start
+        metrics = {
+            "step_seconds": sum(step_seconds) / len(step_seconds),
+            "steps_per_second": len(step_seconds) / train_seconds,
+            # The last batch may be smaller, so this is an upper bound
+            "samples_per_second": len(step_seconds) * self.batch_size / train_seconds,
+        }
+        if wait_seconds[0] is not None:
+            metrics["input_wait_seconds"] = sum(wait_seconds) / len(wait_seconds)
+            metrics["input_fraction"] = sum(wait_seconds) / train_seconds
+        if peak_rss_mb[-1] is not None:
+            metrics["peak_rss_mb"] = peak_rss_mb[-1]
+        metrics["epoch_seconds"] = perf_counter() - self.epoch_start
+
+        self.epochs.append({"epoch": epoch, **metrics})
+        with open(self.output_dir / PERFORMANCE_EPOCHS_FILENAME, "w") as f:
+            json.dump(self.epochs, f, indent=2)
+        if metrics.get("input_fraction", 0) > INPUT_BOUND_FRACTION:
+            logger.warning(
+                f"Epoch {epoch} is input-bound: training waited on input for "
+                f"{metrics['input_fraction']:.0%} of the time"
+            )
+        return metrics
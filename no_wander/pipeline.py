@@ -0,0 +1,333 @@
+import h5py
+import logging
+import numpy as np
+import tensorflow as tf
+from functools import partial
+from .constants import (
+    DATASET_TRAIN,
+    DATASET_VAL,
+    PSD_MULTITAPER,
+    SAMPLE_RATE,
+    SCALER_ROBUST,
+)
+from .datasets import (
+    DTYPE_DEFAULT,
+    get_epoch_samples,
+    get_format_version,
+    iter_epochs,
+    load_filter_plugins,
+    plan_samples,
+)
+from .features import get_compute_dtype, preprocess_data_test, preprocess_data_train
+from .performance import InputTimer
+from .train import gather_sequences
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+BATCH_SIZE_DEFAULT = 32
+EPOCHS_PER_SHARD = 16
+FIT_SAMPLES_DEFAULT = 10000
+SHUFFLE_BUFFER_DEFAULT = 10000
+
+logger = logging.getLogger(__name__)
+
+
+class SequenceBatches(tf.keras.utils.Sequence):
+    # Batches of sequences are gathered from the samples when requested, so the
+    # samples are held once instead of as shuffled, split and padded copies
+    def __init__(
+        self,
+        samples,
+        index,
+        labels,
+        input_shape,
+        batch_size=BATCH_SIZE_DEFAULT,
+        shuffle=False,
+        dtype=None,
+        seed=None,
+    ):
+        self.samples = samples
+        self.index = index
+        self.labels = labels
+        self.input_shape = input_shape
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.dtype = dtype
+        self.rng = np.random.RandomState(seed)
+        self.order = np.arange(len(index))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return -(-len(self.index) // self.batch_size)
+
+    def __getitem__(self, i):
+        batch = self.order[i * self.batch_size : (i + 1) * self.batch_size]
+        X = gather_sequences(
+            self.samples, self.index[batch], self.input_shape, self.dtype
+        )
+        Y = self.labels[batch].astype(X.dtype)
+        return X, Y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+
+def get_sequence_dataset(batches):
+    def generate():
+        for i in range(len(batches)):
+            yield batches[i]
+        batches.on_epoch_end()
+
+    dtype = tf.as_dtype(batches.dtype or batches.samples.dtype)
+    return tf.data.Dataset.from_generator(
+        generate,
+        output_types=(dtype, dtype),
+        output_shapes=((None, *batches.input_shape), (None, 1)),
+    ).prefetch(AUTOTUNE)
+
+
+def time_input(data):
+    # The map after the prefetch runs as the train step takes each batch, so it
+    # stamps when the step stopped waiting, without leaving the graph
+    if isinstance(data, SequenceBatches):
+        data = get_sequence_dataset(data)
+    ready_time = tf.Variable(0.0, dtype=tf.float64, trainable=False)
+
+    def record_ready_time(*batch):
+        ready_time.assign(tf.timestamp())
+        return batch
+
+    dataset = data.map(record_ready_time)
+    return dataset, InputTimer(lambda: float(ready_time.numpy()))
+
+
+def read_fit_samples(
+    filepath, set_type, windows, features, sample_size, max_samples, seed, dtype
+):
+    # Preprocessors are fit on a random subset of samples, read epoch by epoch
+    counts = [sum(len(starts) for starts, _ in epoch) for epoch in windows]
+    offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+    num_samples = offsets[-1]
+    rng = np.random.RandomState(seed)
+    selected = np.sort(
+        rng.choice(num_samples, min(num_samples, max_samples), replace=False)
+    )
+    sample_epochs = np.searchsorted(offsets, selected, side="right") - 1
+    epochs = np.unique(sample_epochs)
+    logger.info(f"Fitting preprocessor on {len(selected)} of {num_samples} samples...")
+
+    X = np.full((len(selected), sample_size, len(features)), np.nan, dtype=dtype)
+    with h5py.File(filepath, "r") as hf:
+        format_version = get_format_version(hf)
+        for i, (_, epoch, columns, _, _) in zip(
+            epochs,
+            iter_epochs(hf[set_type], format_version, contiguous=False, epochs=epochs),
+        ):
+            X_epoch, _ = get_epoch_samples(
+                epoch, columns, windows[i], features, sample_size, dtype=dtype
+            )
+            is_epoch = sample_epochs == i
+            X[is_epoch] = X_epoch[selected[is_epoch] - offsets[i]]
+    return X
+
+
+def iter_shard_sequences(
+    shard,
+    filepath,
+    set_type,
+    windows,
+    features,
+    preprocessor,
+    input_shape,
+    sample_size,
+    shuffle_samples,
+    dtype,
+):
+    start, stop = shard
+    with h5py.File(filepath, "r") as hf:
+        format_version = get_format_version(hf)
+        for i, (_, epoch, columns, _, _) in zip(
+            range(start, stop),
+            iter_epochs(
+                hf[set_type],
+                format_version,
+                contiguous=False,
+                epochs=slice(start, stop),
+            ),
+        ):
+            X, Y = get_epoch_samples(
+                epoch, columns, windows[i], features, sample_size, dtype=dtype
+            )
+            if len(X) == 0:
+                continue
+            X = preprocess_data_test(X, preprocessor)
+            X = np.nan_to_num(X.astype(get_compute_dtype(X), copy=False), copy=False)
+            Y = Y.astype(X.dtype)
+            if shuffle_samples:
+                # Sequences of random samples are formed downstream
+                yield from zip(X, Y)
+                continue
+
+            # Windows were cut into whole sequences of consecutive samples
+            for label in [0, 1]:
+                X_label = X[(Y == label).flatten()]
+                for x in X_label.reshape((-1, *input_shape)):
+                    yield x, np.full(1, label, dtype=X.dtype)
+
+
+def make_dataset(
+    filepath,
+    set_type,
+    windows,
+    features,
+    preprocessor,
+    input_shape,
+    sample_size,
+    shuffle_samples=False,
+    batch_size=BATCH_SIZE_DEFAULT,
+    shuffle_buffer=SHUFFLE_BUFFER_DEFAULT,
+    training=True,
+    dtype=DTYPE_DEFAULT,
+):
+    num_epochs = len(windows)
+    shards = np.array(
+        [
+            (start, min(start + EPOCHS_PER_SHARD, num_epochs))
+            for start in range(0, num_epochs, EPOCHS_PER_SHARD)
+        ],
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    output_dtype = tf.as_dtype(np.promote_types(dtype, np.float32))
+    sequence_size = input_shape[0]
+    generator = partial(
+        iter_shard_sequences,
+        filepath=str(filepath),
+        set_type=set_type,
+        windows=windows,
+        features=features,
+        preprocessor=preprocessor,
+        input_shape=input_shape,
+        sample_size=sample_size,
+        shuffle_samples=shuffle_samples,
+        dtype=dtype,
+    )
+
+    def shard_dataset(shard):
+        return tf.data.Dataset.from_generator(
+            generator,
+            output_types=(output_dtype, output_dtype),
+            # Single samples are only reshaped once they are grouped into sequences
+            output_shapes=(
+                tf.TensorShape(None) if shuffle_samples else input_shape,
+                (1,),
+            ),
+            args=(shard,),
+        )
+
+    dataset = tf.data.Dataset.from_tensor_slices(shards)
+    if training:
+        dataset = dataset.shuffle(max(len(shards), 1))
+    # Shards are read and preprocessed in parallel, in no particular order
+    dataset = dataset.interleave(
+        shard_dataset,
+        cycle_length=AUTOTUNE,
+        num_parallel_calls=AUTOTUNE,
+        deterministic=not training,
+    )
+
+    if shuffle_samples:
+        if training:
+            dataset = dataset.shuffle(shuffle_buffer)
+        dataset = dataset.apply(
+            tf.data.experimental.group_by_window(
+                key_func=lambda x, y: tf.cast(y[0], tf.int64),
+                reduce_func=lambda _, window: window.batch(
+                    sequence_size, drop_remainder=True
+                ),
+                window_size=sequence_size,
+            )
+        )
+        dataset = dataset.map(
+            lambda x, y: (tf.reshape(x, input_shape), y[0]),
+            num_parallel_calls=AUTOTUNE,
+        )
+    if training:
+        dataset = dataset.shuffle(shuffle_buffer)
+    return dataset.batch(batch_size).prefetch(AUTOTUNE)
+
+
+def get_stream_datasets(
+    filepath,
+    sample_size,
+    sequence_size,
+    pre_window,
+    post_window,
+    preprocess,
+    extractors=None,
+    psd=PSD_MULTITAPER,
+    scaler=SCALER_ROBUST,
+    shuffle_samples=False,
+    stride=None,
+    batch_size=BATCH_SIZE_DEFAULT,
+    shuffle_buffer=SHUFFLE_BUFFER_DEFAULT,
+    fit_samples=FIT_SAMPLES_DEFAULT,
+    seed=None,
+    sample_rate=SAMPLE_RATE,
+    dtype=DTYPE_DEFAULT,
+):
+    logger.info(f"Streaming datasets from {filepath}...")
+    pre_window = tuple(int(ix * sample_rate) for ix in pre_window)
+    post_window = tuple(int(ix * sample_rate) for ix in post_window)
+
+    load_filter_plugins()
+    with h5py.File(filepath, "r") as hf:
+        windows, features = plan_samples(
+            hf,
+            [DATASET_TRAIN, DATASET_VAL],
+            sample_size,
+            1 if shuffle_samples else sequence_size,
+            pre_window,
+            post_window,
+            stride=stride,
+        )
+    features_raw = [feat for (feat, _) in sorted(features.items(), key=lambda x: x[1])]
+    for set_type, set_windows in windows.items():
+        num_samples = sum(len(starts) for epoch in set_windows for starts, _ in epoch)
+        logger.info(f"{num_samples} samples in {set_type} set")
+
+    X_fit = read_fit_samples(
+        filepath,
+        DATASET_TRAIN,
+        windows[DATASET_TRAIN],
+        features,
+        sample_size,
+        fit_samples,
+        seed,
+        dtype,
+    )
+    _, preprocessor, features_out, is_flattened = preprocess_data_train(
+        X_fit, preprocess, features_raw, extractors=extractors, psd=psd, scaler=scaler
+    )
+    input_shape = (
+        sequence_size,
+        len(features_out) * (1 if is_flattened else sample_size),
+    )
+
+    datasets = {
+        set_type: make_dataset(
+            filepath,
+            set_type,
+            windows[set_type],
+            features,
+            preprocessor,
+            input_shape,
+            sample_size,
+            shuffle_samples=shuffle_samples,
+            batch_size=batch_size,
+            shuffle_buffer=shuffle_buffer,
+            training=training,
+            dtype=dtype,
+        )
+        for set_type, training in [(DATASET_TRAIN, True), (DATASET_VAL, False)]
+    }
+    return datasets, preprocessor, features_raw, features_out, input_shape
@@ -1,8 +1,21 @@
+import json
 import logging
 import numpy as np
+import os
 import pandas as pd
+import shutil
+from collections import Counter
+from itertools import islice
+from multiprocessing import current_process, Pool
 from pathlib import PurePath
-from .datasets import save_epochs
+from .cache import (
+    CACHE_SIZE_DEFAULT,
+    evict_entries,
+    get_file_hash,
+    get_file_key,
+    touch_entry,
+)
+from .datasets import EpochWriter, get_epoch_name
 from .constants import (
     COL_MARKER_DEFAULT,
     COL_MARKER_PREFIX,
@@ -10,6 +23,7 @@ from .constants import (
     DATASET_TEST,
     DATASET_TRAIN,
     DATASET_VAL,
+    DIR_CACHE,
     DIR_EPOCHS,
     DIR_FAILED,
     DIR_PROCESSED,
@@ -19,10 +33,12 @@ from .constants import (
     SOURCE_EEG,
 )
 
+DATASET_PARTIAL = ".partial"
 DEBOUNCE_SECONDS = 1
 EPOCH_SIZE_SECONDS = 10
 EPOCH_SIZE_SAMPLES = SAMPLE_RATE * EPOCH_SIZE_SECONDS
 EVENT_RECOVERY = "Recovery"
+MANIFEST_FILENAME = "manifest.json"
 WINDOW_POST_RECOVERY = "WINDOW_POST_RECOVERY"
 WINDOW_PRE_RECOVERY = "WINDOW_PRE_RECOVERY"
 
@@ -62,14 +78,57 @@ def get_renamer(s, i):
     )
 
 
-def load_session_data(files, aux_channel=None, rename=True):
+def read_csv_cached(datafile, cache_dir, cache_size=CACHE_SIZE_DEFAULT):
+    cache_file = cache_dir / f"{get_file_key(datafile)}.npz"
+    try:
+        with np.load(cache_file, allow_pickle=False) as cached:
+            df = pd.DataFrame(
+                cached["values"],
+                index=pd.Index(cached["index"], name=str(cached["index_name"])),
+                columns=cached["columns"].tolist(),
+            )
+        logger.debug(f"Loaded {datafile} from cache {cache_file.name}")
+        touch_entry(cache_file)
+        return df
+    except FileNotFoundError:
+        pass
+
+    df = pd.read_csv(datafile, index_col=0)
+    try:
+        df = df.astype(np.float64)
+    except (TypeError, ValueError):
+        logger.warning(f"{datafile} has non-numeric columns. Not caching...")
+        return df
+
+    logger.debug(f"Caching {datafile} to {cache_file.name}...")
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_dir / f".{cache_file.name}.{os.getpid()}"
+    with open(tmp_file, "wb") as f:
+        np.savez(
+            f,
+            index=df.index.to_numpy(dtype=np.float64),
+            index_name=np.array(df.index.name or ""),
+            values=df.to_numpy(),
+            columns=np.array(df.columns, dtype=str),
+        )
+    os.replace(tmp_file, cache_file)
+    evict_entries(cache_dir, cache_size, keep=cache_file.name)
+    return df
+
+
+def load_session_data(
+    files, aux_channel=None, rename=True, cache_dir=None, cache_size=CACHE_SIZE_DEFAULT
+):
     logger.debug("Loading session data...")
     data = [None] * len(files)
     eeg_data = None
     for i, datafile in enumerate(files):
         logger.debug(f"Reading {datafile} to dataframe...")
         source = datafile.name.split(".")[-3]
-        df = pd.read_csv(datafile, index_col=0)
+        if cache_dir is None:
+            df = pd.read_csv(datafile, index_col=0)
+        else:
+            df = read_csv_cached(datafile, cache_dir, cache_size=cache_size)
         data[i] = df
 
         if source == SOURCE_EEG:
@@ -93,93 +152,256 @@ def load_session_data(files, aux_channel=None, rename=True):
     return data, eeg_data
 
 
+# Equivalent to pd.Series.interpolate(method="index") on the outer-joined frame:
+# timestamps before the first reading are NaN, after the last reading are held
+def interpolate_source(df, index):
+    xp = df.index.to_numpy(dtype=np.float64)
+    fp = df.to_numpy(dtype=np.float64)
+    x = np.asarray(index, dtype=np.float64)
+    if not np.all(xp[1:] > xp[:-1]):
+        order = np.argsort(xp, kind="stable")
+        xp, fp = xp[order], fp[order]
+
+    resampled = np.full((x.size, fp.shape[1]), np.nan)
+    if xp.size == 0:
+        return resampled
+
+    # Same arithmetic as np.interp so results are bit-for-bit identical
+    j = np.searchsorted(xp, x, side="right") - 1
+    inner = (j >= 0) & (j < xp.size - 1)
+    j_inner = j[inner]
+    dx = (x[inner] - xp[j_inner])[:, np.newaxis]
+    slope = (fp[j_inner + 1] - fp[j_inner]) / (xp[j_inner + 1] - xp[j_inner])[
+        :, np.newaxis
+    ]
+    resampled[inner] = slope * dx + fp[j_inner]
+    resampled[j == xp.size - 1] = fp[-1]
+
+    # Gaps inside a source column are interpolated across its valid readings only
+    for col in np.flatnonzero(np.isnan(fp).any(axis=0)):
+        valid = ~np.isnan(fp[:, col])
+        if not valid.any():
+            continue
+        resampled[:, col] = np.interp(
+            x, xp[valid], fp[valid, col], left=np.nan, right=fp[valid, col][-1]
+        )
+
+    return resampled
+
+
+def resample_source(df, index):
+    is_marker = df.columns.str.startswith(COL_MARKER_PREFIX)
+    resampled = np.zeros((len(index), len(df.columns)))
+    resampled[:, ~is_marker] = interpolate_source(df.loc[:, ~is_marker], index)
+
+    if is_marker.any():
+        # Markers are never interpolated, they only exist at their own timestamps
+        positions = df.index.get_indexer(index)
+        found = positions != -1
+        resampled[np.ix_(found, is_marker)] = (
+            df.loc[:, is_marker].fillna(0).to_numpy()[positions[found]]
+        )
+
+    return pd.DataFrame(resampled, index=index, columns=df.columns)
+
+
 def merge_sources(data, reindex=None):
     logger.debug("Merging multiple data sources...")
     if len(data) == 1:
         logger.debug("Only one data source. No merge needed. Skipping...")
         return data[0]
 
-    merged = pd.concat(data, axis=1, join="outer")
+    if type(reindex) is pd.DataFrame:
+        logger.debug("Resampling data sources onto reindex timestamps...")
+        target_index = reindex.index
+    else:
+        target_index = data[0].index
+        for df in data[1:]:
+            target_index = target_index.union(df.index)
+
+    merged = pd.concat([resample_source(df, target_index) for df in data], axis=1)
     marker_cols = [
         col for col in sorted(merged.columns) if col.startswith(COL_MARKER_PREFIX)
     ]
-    merged[marker_cols] = merged[marker_cols].fillna(0)
-    merged = merged.apply(pd.Series.interpolate, args=("index",))
-    if type(reindex) is pd.DataFrame:
-        logger.debug("Reindexing merged data sources...")
-        merged = merged.reindex(index=reindex.index)
     merged.dropna(axis=0, how="any", inplace=True)
 
-    last = 0
-    markers = []
-    for index in merged.index[(merged[marker_cols] == MARKER_USER_RECOVER).any(axis=1)]:
-        if index - last < DEBOUNCE_SECONDS:
-            logger.debug(
-                f"Debouncing recovery {index}, within {DEBOUNCE_SECONDS} sec of {last}"
-            )
-            continue
-        markers.append(index)
-        last = index
+    recoveries = np.flatnonzero(
+        (merged[marker_cols].to_numpy() == MARKER_USER_RECOVER).any(axis=1)
+    )
+    markers = recoveries[debounce_recoveries(merged.index.to_numpy()[recoveries])]
+    logger.debug(
+        f"Debounced {recoveries.size - markers.size} recoveries"
+        f" within {DEBOUNCE_SECONDS} sec of a previous one"
+    )
 
     logger.debug("Consolidating marker columns...")
     merged.drop(columns=marker_cols, inplace=True)
-    merged[COL_MARKER_DEFAULT] = 0
-    merged.loc[markers, COL_MARKER_DEFAULT] = 1
+    marker = np.zeros(merged.shape[0], dtype=int)
+    marker[markers] = 1
+    merged[COL_MARKER_DEFAULT] = marker
 
     return merged
 
 
-def get_session_epochs(merged_df, session):
-    logger.debug("Splitting merged data into epochs...")
-    session_epochs = []
-    recoveries = merged_df.iloc[:, -1] == 1
-    if not recoveries.any():
-        logger.debug("No recoveries, skipping...")
-        return session_epochs
-
-    num_readings = merged_df.shape[0]
-    recoveries = np.arange(num_readings)[recoveries]
-    num_recoveries = len(recoveries)
-    last_max = 0
-    for i in range(num_recoveries):
-        logger.debug(f"Extracting epoch {i + 1} of {num_recoveries}...")
-        recovery_ix = recoveries[i]
-        min_ix = max(last_max, recovery_ix - EPOCH_SIZE_SAMPLES)
-        max_ix = min(num_readings, recovery_ix + EPOCH_SIZE_SAMPLES)
-
-        if i < num_recoveries - 1:
-            next_pre = recoveries[i + 1] - EPOCH_SIZE_SAMPLES
-            if next_pre < recovery_ix + 0.5 * EPOCH_SIZE_SAMPLES:
-                logger.debug("Recovery point is too close to next epoch. Discarding...")
-                last_max = recovery_ix
-                continue
-            elif next_pre < max_ix:
-                logger.debug("Post-recovery window overlaps next epoch. Shortening...")
-                max_ix = next_pre
-
-        session_epochs.append(
-            (merged_df.iloc[min_ix:max_ix], recovery_ix - min_ix, session)
-        )
-        last_max = max_ix
-        logger.debug(f"Epoch {i + 1} has {max_ix - min_ix} timestamps")
+def debounce_recoveries(timestamps, debounce=DEBOUNCE_SECONDS):
+    # A recovery is kept if it is at least debounce seconds after the last *kept*
+    # recovery, so jump straight to the next candidate instead of visiting each one
+    keep = []
+    last = 0
+    num_recoveries = timestamps.size
+    i = 0
+    while i < num_recoveries:
+        i = np.searchsorted(timestamps, last + debounce, side="left")
+        # Nudge for rounding so the test is exactly timestamp - last >= debounce
+        while i > 0 and timestamps[i - 1] - last >= debounce:
+            i -= 1
+        while i < num_recoveries and timestamps[i] - last < debounce:
+            i += 1
+        if i == num_recoveries:
+            break
+        keep.append(i)
+        last = timestamps[i]
+        i += 1
+
+    return np.array(keep, dtype=int)
+
 
-    return session_epochs
+def plan_epochs(recoveries, num_readings, epoch_size=EPOCH_SIZE_SAMPLES):
+    # Returns (start, stop, recovery offset) rows for the epochs around recoveries.
+    # A recovery whose next recovery's pre-window starts less than half an epoch
+    # after it is discarded, and post-recovery windows stop where the next
+    # pre-recovery window starts.
+    recoveries = np.asarray(recoveries, dtype=int)
+    if not recoveries.size:
+        return np.zeros((0, 3), dtype=int)
+
+    next_pre = recoveries[1:] - epoch_size
+    is_discarded = np.zeros(recoveries.size, dtype=bool)
+    is_discarded[:-1] = next_pre < recoveries[:-1] + 0.5 * epoch_size
+
+    stops = np.minimum(num_readings, recoveries + epoch_size)
+    stops[:-1] = np.minimum(stops[:-1], next_pre)
+
+    # Each epoch starts no earlier than the end of the previous one, or the
+    # previous recovery if that one was discarded
+    previous_ends = np.zeros(recoveries.size, dtype=int)
+    previous_ends[1:] = np.where(is_discarded, recoveries, stops)[:-1]
+    starts = np.maximum(previous_ends, recoveries - epoch_size)
+
+    plan = np.stack([starts, stops, recoveries - starts], axis=-1)
+    return plan[~is_discarded]
+
+
+def get_session_epochs(merged_df):
+    logger.debug("Splitting merged data into epochs...")
+    recoveries = np.flatnonzero(merged_df.iloc[:, -1].to_numpy() == 1)
+    data = merged_df.iloc[:, :-1]
+    plan = plan_epochs(recoveries, merged_df.shape[0])
+    logger.debug(
+        f"Extracted {len(plan)} epochs from {recoveries.size} recoveries"
+        f" ({recoveries.size - len(plan)} discarded)"
+    )
+    # Epochs are (start, stop) slices of the one array, not copies
+    return plan, data.to_numpy(), data.index.to_numpy(), list(data.columns)
 
 
 # TODO: Support splitting by subject or session
-def split_epochs(epochs, val_split, test_split):
-    num_epochs = len(epochs)
-    test_ix = int((1 - test_split) * num_epochs)
-    val_ix = int((1 - test_split - val_split) * num_epochs)
+def get_epoch_splits(rng, num_epochs, counts, val_split, test_split):
+    # Each epoch goes to the set furthest below its share of all epochs so far,
+    # rounded as if they were split at once, so even small runs get val and test
+    # epochs. Splits are shuffled within the chunk.
+    splits = []
+    for _ in range(num_epochs):
+        total = sum(counts.values()) + 1
+        train_ix = int((1 - test_split - val_split) * total)
+        test_ix = int((1 - test_split) * total)
+        deficits = {
+            DATASET_TEST: total - test_ix - counts[DATASET_TEST],
+            DATASET_VAL: test_ix - train_ix - counts[DATASET_VAL],
+            DATASET_TRAIN: train_ix - counts[DATASET_TRAIN],
+        }
+        split = max(deficits, key=deficits.get)
+        counts[split] += 1
+        splits.append(split)
+    rng.shuffle(splits)
+    return splits
+
+
+def get_epoch_files(epochs_dir, dataset_name):
+    return {
+        DATASET_TRAIN: (
+            epochs_dir / f"{dataset_name}-{DATASET_TRAIN}.h5",
+            DATASET_TRAIN,
+        ),
+        DATASET_VAL: (epochs_dir / f"{dataset_name}-{DATASET_TRAIN}.h5", DATASET_VAL),
+        DATASET_TEST: (epochs_dir / f"{dataset_name}-{DATASET_TEST}.h5", None),
+    }
+
+
+def rename_epoch_files(epochs_dir, old_name, new_name, copy=False):
+    for filepath in {
+        filepath for filepath, _ in get_epoch_files(epochs_dir, old_name).values()
+    }:
+        new_filepath = filepath.with_name(filepath.name.replace(old_name, new_name, 1))
+        if copy:
+            logger.debug(f"Copying {filepath} to {new_filepath}...")
+            shutil.copyfile(filepath, new_filepath)
+        else:
+            logger.debug(f"Renaming {filepath} to {new_filepath}...")
+            filepath.replace(new_filepath)
+
+
+def remove_epoch_files(epochs_dir, dataset_name):
+    for filepath, _ in get_epoch_files(epochs_dir, dataset_name).values():
+        if filepath.exists():
+            logger.debug(f"Removing {filepath}...")
+            filepath.unlink()
+
+
+def get_manifest_file_key(filepath):
+    return f"{filepath.parent.name}/{filepath.name}"
+
+
+def load_manifest(manifest_path):
+    if not manifest_path.exists():
+        logger.debug(f"No manifest at {manifest_path}. Starting a new one...")
+        return {"dataset": None, "ts_range": [float("inf"), 0], "chunks": {}}
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path, manifest):
+    logger.info(f"Saving manifest to {manifest_path}...")
+    tmp_path = manifest_path.with_name(f".{manifest_path.name}")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def filter_new_sessions(raw_files, manifest):
+    new_files = {}
+    hashes = {}
+    seen_files = []
+    changed_files = []
+    for session, files in raw_files.items():
+        session_hashes = {get_manifest_file_key(f): get_file_hash(f) for f in files}
+        manifest_hashes = manifest["chunks"].get(session.name, None)
+        if manifest_hashes is None:
+            new_files[session] = files
+            hashes[session.name] = session_hashes
+        elif manifest_hashes == session_hashes:
+            logger.debug(f"Session chunk {session} already processed. Skipping...")
+            seen_files += files
+        else:
+            logger.error(
+                f"Session chunk {session} was already processed with different contents"
+            )
+            changed_files += files
+
     logger.info(
-        f"Splitting epochs: {val_ix} train/{test_ix - val_ix} val/{num_epochs - test_ix} test"
-    )
-    shuffled = np.random.permutation(epochs)
-    return (
-        shuffled[:val_ix],
-        shuffled[val_ix:test_ix],
-        shuffled[test_ix:],
+        f"{len(new_files)} new session chunks, {len(raw_files) - len(new_files)} already in manifest"
     )
+    return new_files, hashes, seen_files, changed_files
 
 
 def move_files(files, dest_dir):
@@ -194,8 +416,57 @@ def move_files(files, dest_dir):
         file.rename(file_dest / file.name)
 
 
+def process_session_chunk(session, files, aux_channel=None, **load_kwargs):
+    data, eeg_data = load_session_data(files, aux_channel=aux_channel, **load_kwargs)
+    merged_df = merge_sources(data, reindex=eeg_data)
+    if merged_df.empty:
+        # Nothing to split, but the chunk was still processed
+        logger.warning(f"Session chunk {session} has no readings after merging")
+        return (plan_epochs([], 0), None, None, []), None
+    session_epochs = get_session_epochs(merged_df)
+    return session_epochs, (merged_df.index[0], merged_df.index[-1])
+
+
+def process_session_chunk_worker(args):
+    session, files, load_kwargs = args
+    worker = current_process().name
+    logger.debug(f"{worker} processing session chunk {session}...")
+    try:
+        result = process_session_chunk(session, files, **load_kwargs)
+    except Exception as e:
+        logger.exception(e)
+        result = None
+    return session, files, result, worker
+
+
+def iter_session_chunks(raw_files, limit=None, workers=1, **load_kwargs):
+    tasks = islice(
+        ((session, files, load_kwargs) for session, files in raw_files.items()), limit
+    )
+    if workers <= 1:
+        yield from map(process_session_chunk_worker, tasks)
+        return
+
+    logger.info(f"Processing session chunks with {workers} workers...")
+    with Pool(workers) as pool:
+        # imap yields results in submission order, so epochs are collected
+        # deterministically regardless of which worker finishes first
+        yield from pool.imap(process_session_chunk_worker, tasks)
+
+
 def process_session_data(
-    raw_files, output_dir, aux_channel=None, limit=None, test_split=0.2, val_split=0.2,
+    raw_files,
+    output_dir,
+    aux_channel=None,
+    limit=None,
+    test_split=0.2,
+    val_split=0.2,
+    workers=1,
+    cache=False,
+    cache_size=CACHE_SIZE_DEFAULT,
+    incremental=False,
+    seed=None,
+    **writer_kwargs,
 ):
     if not len(raw_files):
         return
@@ -205,48 +476,110 @@ def process_session_data(
         logger.debug(f"{epochs_dir} does not exist. Creating...")
         epochs_dir.mkdir(parents=True)
 
-    epochs = []
     processed_files = []
+    processed_sessions = []
     ts_range = [float("inf"), 0]
-    num_chunks = len(raw_files)
+    # Epochs are streamed to files with a temporary name until the time range is
+    # known, so a failed run never leaves partly written epoch files behind
+    dataset_name = DATASET_PARTIAL
+    old_name = None
+    mode = "w"
+    if incremental:
+        manifest_path = epochs_dir / MANIFEST_FILENAME
+        manifest = load_manifest(manifest_path)
+        raw_files, hashes, seen_files, changed_files = filter_new_sessions(
+            raw_files, manifest
+        )
+        move_files(seen_files, output_dir / DIR_PROCESSED)
+        move_files(changed_files, output_dir / DIR_FAILED)
+        if not len(raw_files):
+            logger.info("No new session chunks. Done!")
+            return
+        ts_range = manifest["ts_range"]
+        old_name = manifest["dataset"]
+
+    rng = np.random.RandomState(seed)
+    split_counts = Counter()
+    num_chunks = len(raw_files) if limit is None else min(limit, len(raw_files))
     processed_chunks = 0
+    worker_chunks = Counter()
     logger.info(f"{num_chunks} session chunks to process. Starting...")
-    for session, files in raw_files.items():
-        logger.info(f"Processing session chunk {processed_chunks + 1}...")
-        logger.debug(f"Session chunk name: {session}...")
-        try:
-            data, eeg_data = load_session_data(files, aux_channel=aux_channel)
-            merged_df = merge_sources(data, reindex=eeg_data)
-            session_epochs = get_session_epochs(merged_df, session.name)
-            if len(session_epochs):
-                epochs += session_epochs
-                ts_range[0] = min(ts_range[0], merged_df.index[0])
-                ts_range[1] = max(ts_range[1], merged_df.index[-1])
-            processed_files += files
-        except Exception as e:
-            logger.exception(e)
-            move_files(files, output_dir / DIR_FAILED)
-
-        processed_chunks += 1
-        logger.debug(f"Finished processing session chunk {processed_chunks}!")
+    try:
+        if old_name is not None:
+            # Appends go to a copy, so the files keep matching the manifest on failure
+            rename_epoch_files(epochs_dir, old_name, dataset_name, copy=True)
+            mode = "a"
+        with EpochWriter(
+            get_epoch_files(epochs_dir, dataset_name), mode=mode, **writer_kwargs,
+        ) as writer:
+            for session, files, result, worker in iter_session_chunks(
+                raw_files,
+                limit=limit,
+                workers=workers,
+                aux_channel=aux_channel,
+                cache_dir=output_dir / DIR_CACHE if cache else None,
+                cache_size=cache_size,
+            ):
+                if result is None:
+                    move_files(files, output_dir / DIR_FAILED)
+                else:
+                    processed_files += files
+                    processed_sessions.append(session.name)
+                    session_epochs, chunk_range = result
+                    plan, values, timestamps, columns = session_epochs
+                    splits = get_epoch_splits(
+                        rng, len(plan), split_counts, val_split, test_split
+                    )
+                    for (start, stop, recovery_ix), split in zip(plan, splits):
+                        writer.write(
+                            split,
+                            values[start:stop],
+                            columns,
+                            get_epoch_name(timestamps[start:stop]),
+                            recovery_ix,
+                            session.name,
+                        )
+                    if len(plan):
+                        ts_range[0] = min(ts_range[0], chunk_range[0])
+                        ts_range[1] = max(ts_range[1], chunk_range[1])
+
+                processed_chunks += 1
+                worker_chunks[worker] += 1
+                logger.info(
+                    f"Finished session chunk {processed_chunks} of {num_chunks}"
+                    f" ({worker}: {worker_chunks[worker]} chunks)"
+                )
+                logger.debug(f"Session chunk name: {session}...")
+
         if limit is not None and processed_chunks >= limit:
-            logger.info(f"Limit of {limit} reached. Breaking...")
-            break
+            logger.info(f"Limit of {limit} reached.")
 
-    logger.info(f"Collected {len(epochs)} epochs across {processed_chunks} chunks!")
-    try:
-        dataset_name = "-".join([str(int(ts)) for ts in ts_range])
-        epochs_train, epochs_val, epochs_test = split_epochs(
-            epochs, val_split, test_split
+        counts = writer.counts
+        logger.info(
+            f"Saved {sum(counts.values())} epochs across {processed_chunks} chunks:"
+            f" {counts[DATASET_TRAIN]} train/{counts[DATASET_VAL]} val/{counts[DATASET_TEST]} test"
         )
-        for dataset, split in [
-            ({DATASET_TRAIN: epochs_train, DATASET_VAL: epochs_val}, DATASET_TRAIN),
-            (epochs_test, DATASET_TEST),
-        ]:
-            save_epochs(output_dir / DIR_EPOCHS / f"{dataset_name}-{split}.h5", dataset)
+        if ts_range[1] > 0:
+            new_name = "-".join([str(int(ts)) for ts in ts_range])
+            rename_epoch_files(epochs_dir, dataset_name, new_name)
+            if old_name is not None and old_name != new_name:
+                remove_epoch_files(epochs_dir, old_name)
+        else:
+            logger.info("No epochs collected")
+            new_name = None
+            remove_epoch_files(epochs_dir, dataset_name)
+
+        if incremental:
+            manifest["chunks"].update(
+                {session: hashes[session] for session in processed_sessions}
+            )
+            manifest["dataset"] = new_name
+            manifest["ts_range"] = ts_range
+            save_manifest(manifest_path, manifest)
         move_files(processed_files, output_dir / DIR_PROCESSED)
     except Exception as e:
         logger.exception(e)
+        remove_epoch_files(epochs_dir, dataset_name)
         move_files(processed_files, output_dir / DIR_FAILED)
 
     logger.info("Done!")
@@ -0,0 +1,118 @@
+import numpy as np
+
+SKETCH_SIZE_DEFAULT = 2048
+
+
+class QuantileSketch:
+    # KLL-style quantile sketch of every column at once. Level h holds sorted
+    # items that each stand for 2 ** h rows. NaNs sort last and are ignored
+    # when querying, so each column keeps its own count of valid values.
+    def __init__(self, size=SKETCH_SIZE_DEFAULT, seed=0):
+        self.size = size
+        self.levels = []
+        self.count = 0
+        self.rng = np.random.RandomState(seed)
+
+    def update(self, X):
+        X = np.asarray(X)
+        if len(X) == 0:
+            return self
+        if not self.levels:
+            self.levels.append(np.array(X, copy=True))
+        else:
+            self.levels[0] = np.concatenate([self.levels[0], X])
+        self.count += len(X)
+        self.compress()
+        return self
+
+    def merge(self, other):
+        for h, level in enumerate(other.levels):
+            if h < len(self.levels):
+                self.levels[h] = np.concatenate([self.levels[h], level])
+            else:
+                self.levels.append(np.array(level, copy=True))
+        self.count += other.count
+        self.compress()
+        return self
+
+    def compress(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self.size:
+                level = np.sort(level, axis=0)
+                # An odd item out stays on this level
+                num_left = len(level) % 2
+                promoted = level[num_left + self.rng.randint(2) :: 2]
+                self.levels[h] = level[:num_left]
+                if h + 1 == len(self.levels):
+                    self.levels.append(promoted)
+                else:
+                    self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+    def quantiles(self, q):
+        q = np.asarray(q, dtype=float)
+        if len(self.levels) == 1:
+            # Nothing has been compacted yet, so quantiles are exact
+            return np.nanpercentile(self.levels[0], q * 100, axis=0)
+
+        items = np.concatenate(self.levels)
+        weights = np.concatenate(
+            [np.full(len(level), 2 ** h) for h, level in enumerate(self.levels)]
+        )
+        order = np.argsort(items, axis=0)
+        items = np.take_along_axis(items, order, axis=0)
+        weights = np.where(np.isnan(items), 0, weights[order])
+        ranks = np.cumsum(weights, axis=0)
+
+        result = np.full((len(q), items.shape[1]), np.nan)
+        for i, target in enumerate(q[:, np.newaxis] * ranks[-1]):
+            index = np.minimum((ranks < target).sum(axis=0), len(items) - 1)
+            result[i] = np.take_along_axis(items, index[np.newaxis], axis=0)[0]
+        result[:, ranks[-1] == 0] = np.nan
+        return result
+
+
+class StreamingRobustScaler:
+    # Same scaling as sklearn's RobustScaler, fit one chunk of rows at a time
+    # from approximate quantiles
+    def __init__(self, quantile_range=(25.0, 75.0), sketch_size=SKETCH_SIZE_DEFAULT):
+        self.quantile_range = quantile_range
+        self.sketch_size = sketch_size
+        self.sketch = QuantileSketch(sketch_size)
+        self.params = None
+
+    def get_params(self):
+        # Querying sorts the whole sketch, so it's done once after fitting
+        if self.params is None:
+            q_min, q_max = self.quantile_range
+            median, lower, upper = self.sketch.quantiles(
+                [0.5, q_min / 100, q_max / 100]
+            )
+            scale = upper - lower
+            self.params = median, np.where(scale == 0, 1, scale)
+        return self.params
+
+    @property
+    def center_(self):
+        return self.get_params()[0]
+
+    @property
+    def scale_(self):
+        return self.get_params()[1]
+
+    def partial_fit(self, X):
+        self.sketch.update(X)
+        self.params = None
+        return self
+
+    def fit(self, X):
+        self.sketch = QuantileSketch(self.sketch_size)
+        return self.partial_fit(X)
+
+    def transform(self, X):
+        return (X - self.center_.astype(X.dtype)) / self.scale_.astype(X.dtype)
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
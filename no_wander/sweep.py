@@ -0,0 +1,422 @@
+import copy
+import csv
+import itertools
+import json
+import logging
+import numpy as np
+import os
+import traceback
+import multiprocessing
+from pathlib import Path
+from time import perf_counter
+from .train import prepare_data, train_prepared_model
+
+SEARCH_GRID = "grid"
+SEARCH_RANDOM = "random"
+SUMMARY_FILENAME = "summary.csv"
+CONFIGS_FILENAME = "configs.json"
+HALVING_STATE_FILENAME = "halving.json"
+DECISIONS_FILENAME = "decisions.jsonl"
+RESUME_CHECKPOINT = "rung_checkpoint"
+HALVING_ETA_DEFAULT = 3
+HALVING_MIN_EPOCHS_DEFAULT = 1
+# Params that change the prepared data. Configs that share them share one load.
+PREPARE_PARAMS = [
+    "sample_size",
+    "sequence_size",
+    "pre_window",
+    "post_window",
+    "preprocess",
+    "extractors",
+    "psd",
+    "scaler",
+    "shuffle_samples",
+    "lazy",
+    "store_dir",
+    "stride",
+    "dtype",
+    "cache",
+    "cache_size",
+    "workers",
+    "feature_store",
+    "extract_chunk_size",
+]
+RESULT_COLUMNS = ["status", "rung", "seconds", "epochs", "best_epoch"]
+
+logger = logging.getLogger(__name__)
+
+# Set in the parent before workers are forked, so they share the prepared data.
+# This relies on the fork start method, which train_configs asks for explicitly.
+_prepared = None
+
+
+def sample_param(values, rng):
+    if isinstance(values, dict):
+        low, high = values["min"], values["max"]
+        if values.get("log", False):
+            value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        else:
+            value = float(rng.uniform(low, high))
+        return int(round(value)) if values.get("int", False) else value
+    return values[rng.randint(len(values))]
+
+
+def get_configs(spec):
+    base = spec.get("base", {})
+    params = spec.get("params", {})
+    search = spec.get("search", SEARCH_GRID)
+    if search == SEARCH_GRID:
+        names = list(params)
+        combinations = itertools.product(*[params[name] for name in names])
+        swept = [dict(zip(names, values)) for values in combinations]
+    elif search == SEARCH_RANDOM:
+        rng = np.random.RandomState(spec.get("seed", None))
+        swept = [
+            {name: sample_param(values, rng) for name, values in params.items()}
+            for _ in range(spec["num_configs"])
+        ]
+    else:
+        raise ValueError(f"Unknown search type {search}")
+
+    configs = [{**base, **config} for config in swept]
+    for config in configs:
+        if config.get("stream", False):
+            raise ValueError("Streamed datasets can't be shared by a sweep")
+        for param in ["sample_size", "sequence_size", "layers"]:
+            if param not in config:
+                raise ValueError(f"Every config needs {param}")
+    return configs, list(params)
+
+
+def get_prepare_kwargs(config):
+    kwargs = {k: v for k, v in config.items() if k in PREPARE_PARAMS}
+    for window in ["pre_window", "post_window"]:
+        if window in kwargs:
+            kwargs[window] = tuple(kwargs[window])
+    if kwargs.get("shuffle_samples", False):
+        # Samples don't depend on the sequence size when they are shuffled
+        kwargs.pop("sequence_size")
+    return kwargs
+
+
+def group_configs(configs):
+    groups = {}
+    for i, config in enumerate(configs):
+        kwargs = get_prepare_kwargs(config)
+        key = json.dumps(kwargs, sort_keys=True, default=str)
+        groups.setdefault(key, (kwargs, []))[1].append(i)
+    return list(groups.values())
+
+
+def init_worker(threads):
+    import tensorflow as tf
+
+    # Workers share the machine, so each one gets a slice of the cores
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    except RuntimeError:
+        logger.warning("TensorFlow was already initialized, thread limits not set")
+
+
+def get_history_results(metrics):
+    if not metrics.get("loss"):
+        return {"epochs": 0}
+    monitor = "val_loss" if "val_loss" in metrics else "loss"
+    best_epoch = int(np.argmin(metrics[monitor]))
+    results = {"epochs": len(metrics["loss"]), "best_epoch": best_epoch + 1}
+    for metric, values in metrics.items():
+        results[metric] = float(values[best_epoch])
+    return results
+
+
+def train_config(args):
+    config_id, config, model_dir = args
+    datasets, preprocessor, features_raw, features, input_shape = _prepared
+    # Shuffled samples are shared across sequence sizes
+    input_shape = (config["sequence_size"], input_shape[1])
+    # Building the model pops keys from the layer specs, which configs share
+    kwargs = {
+        k: copy.deepcopy(v)
+        for k, v in config.items()
+        if k not in PREPARE_PARAMS and k != "stream"
+    }
+
+    start = perf_counter()
+    metrics = {}
+    try:
+        Path(model_dir).mkdir(parents=True, exist_ok=True)
+        history = train_prepared_model(
+            model_dir,
+            (datasets, preprocessor, features_raw, features, input_shape),
+            kwargs.pop("layers"),
+            shuffle_samples=config.get("shuffle_samples", False),
+            **kwargs,
+        )
+        if history is not None:
+            metrics = {
+                metric: [float(value) for value in values]
+                for metric, values in history.history.items()
+            }
+        results = {"status": "done", **get_history_results(metrics)}
+    except Exception as error:
+        logger.error(f"Config {config_id} failed:\n{traceback.format_exc()}")
+        results = {"status": f"failed: {error}"}
+    finally:
+        try:
+            from tensorflow.keras.backend import clear_session
+
+            clear_session()
+        except ImportError:
+            pass
+    results["seconds"] = round(perf_counter() - start, 3)
+    return config_id, results, metrics
+
+
+def write_summary(summary_path, configs, swept, results):
+    metrics = sorted(
+        {
+            key
+            for result in results.values()
+            for key in result
+            if key not in RESULT_COLUMNS
+        }
+    )
+    result_columns = [
+        column
+        for column in RESULT_COLUMNS
+        if any(column in result for result in results.values())
+    ]
+    columns = ["config"] + swept + result_columns + metrics
+    with open(summary_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, restval="")
+        writer.writeheader()
+        for config_id in sorted(results):
+            config = configs[config_id]
+            row = {
+                param: json.dumps(config[param])
+                if isinstance(config[param], (list, dict))
+                else config[param]
+                for param in swept
+            }
+            writer.writerow({"config": config_id, **row, **results[config_id]})
+
+
+def get_fork_context():
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError(
+            "Sweeping with more than one job needs the fork start method"
+        )
+    return multiprocessing.get_context("fork")
+
+
+def train_configs(data_file, tasks, jobs, threads):
+    global _prepared
+
+    groups = group_configs([config for _, config, _ in tasks])
+    logger.info(f"Training {len(tasks)} configs over {len(groups)} data variants")
+    for prepare_kwargs, task_ids in groups:
+        prepare_kwargs = dict(prepare_kwargs)
+        group_tasks = [tasks[i] for i in task_ids]
+        config_ids = [config_id for config_id, _, _ in group_tasks]
+        sample_size = prepare_kwargs.pop("sample_size")
+        sequence_size = prepare_kwargs.pop(
+            "sequence_size", group_tasks[0][1]["sequence_size"]
+        )
+        logger.info(f"Preparing data for configs {config_ids}...")
+        _prepared = prepare_data(
+            data_file, sample_size, sequence_size, **prepare_kwargs
+        )
+
+        if jobs <= 1:
+            yield from map(train_config, group_tasks)
+        else:
+            # Spawned workers would start without _prepared, so workers are always
+            # forked. TensorFlow is only imported in the workers, after the fork.
+            context = get_fork_context()
+            with context.Pool(
+                jobs, initializer=init_worker, initargs=(threads,)
+            ) as pool:
+                yield from pool.imap_unordered(train_config, group_tasks)
+        _prepared = None
+
+
+def get_rung_epochs(min_epochs, eta, max_epochs):
+    rung_epochs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rung_epochs.append(epochs)
+        epochs *= eta
+    return rung_epochs + [max_epochs]
+
+
+def get_halving_params(spec, configs):
+    halving = spec["halving"]
+    eta = halving.get("eta", HALVING_ETA_DEFAULT)
+    min_epochs = halving.get("min_epochs", HALVING_MIN_EPOCHS_DEFAULT)
+    max_epochs = halving.get("max_epochs", spec.get("base", {}).get("epochs", 0))
+    if eta < 2:
+        raise ValueError("halving eta must be at least 2")
+    if min_epochs < 1 or max_epochs < min_epochs:
+        raise ValueError("halving needs 1 <= min_epochs <= max_epochs")
+    if any("epochs" in config and config["epochs"] != max_epochs for config in configs):
+        raise ValueError("halving sets the epochs of each rung, don't sweep epochs")
+    return eta, get_rung_epochs(min_epochs, eta, max_epochs)
+
+
+def get_rung_scores(config_ids, histories):
+    scores = {}
+    for config_id in config_ids:
+        metrics = histories.get(str(config_id), {})
+        values = metrics.get("val_loss", metrics.get("loss", []))
+        # Failed configs have no loss, so they rank last and are never promoted
+        scores[config_id] = min(values) if values else np.inf
+    return scores
+
+
+def load_halving_state(state_path, configs_path, configs):
+    if not state_path.exists():
+        return {"rungs": [], "histories": {}}
+    with open(configs_path, "r") as f:
+        saved_configs = json.load(f)
+    if saved_configs != json.loads(json.dumps(configs)):
+        raise ValueError(
+            f"{state_path.parent} has a sweep with different configs, can't resume"
+        )
+    with open(state_path, "r") as f:
+        state = json.load(f)
+    logger.info(f"Resuming sweep after {len(state['rungs'])} started rungs")
+    return state
+
+
+def save_halving_state(state_path, state):
+    # Written to a temporary file first, so a stopped sweep never leaves half a state
+    tmp_path = state_path.with_name(f".{state_path.name}.{os.getpid()}")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def run_halving(data_file, sweep_dir, spec, configs, swept, jobs, threads):
+    eta, rung_epochs = get_halving_params(spec, configs)
+    state_path = sweep_dir / HALVING_STATE_FILENAME
+    state = load_halving_state(state_path, sweep_dir / CONFIGS_FILENAME, configs)
+    with open(sweep_dir / CONFIGS_FILENAME, "w") as f:
+        json.dump(configs, f, indent=2)
+    summary_path = sweep_dir / SUMMARY_FILENAME
+    histories = state["histories"]
+    results = {}
+    for rung in state["rungs"]:
+        results.update({int(k): v for k, v in rung["finished"].items()})
+
+    logger.info(f"Successive halving over rungs of {rung_epochs} epochs")
+    config_ids = list(range(len(configs)))
+    for rung_num, epochs in enumerate(rung_epochs):
+        if rung_num == len(state["rungs"]):
+            state["rungs"].append(
+                {"epochs": epochs, "configs": config_ids, "finished": {}}
+            )
+            save_halving_state(state_path, state)
+        rung = state["rungs"][rung_num]
+        config_ids = rung["configs"]
+
+        initial_epoch = rung_epochs[rung_num - 1] if rung_num > 0 else 0
+        tasks = []
+        for config_id in config_ids:
+            if str(config_id) in rung["finished"]:
+                continue
+            model_dir = sweep_dir / f"{config_id:03d}"
+            config = {
+                **configs[config_id],
+                "epochs": epochs,
+                "initial_epoch": initial_epoch,
+                "resume_checkpoint": str(model_dir / RESUME_CHECKPOINT / "weights"),
+            }
+            tasks.append((config_id, config, model_dir))
+
+        logger.info(
+            f"Rung {rung_num}: training {len(config_ids)} configs to {epochs} epochs"
+        )
+        for config_id, config_results, metrics in train_configs(
+            data_file, tasks, jobs, threads
+        ):
+            history = histories.setdefault(str(config_id), {})
+            for metric, values in metrics.items():
+                history.setdefault(metric, []).extend(values)
+            if config_results["status"] == "done":
+                config_results.update(get_history_results(history))
+            config_results["rung"] = rung_num
+            logger.info(f"Config {config_id}: {config_results}")
+            rung["finished"][str(config_id)] = config_results
+            results[config_id] = config_results
+            save_halving_state(state_path, state)
+            write_summary(summary_path, configs, swept, results)
+
+        if rung_num == len(rung_epochs) - 1:
+            break
+        if "promoted" not in rung:
+            scores = get_rung_scores(config_ids, histories)
+            ranked = sorted(config_ids, key=lambda c: (scores[c], c))
+            num_promoted = max(1, len(ranked) // eta)
+            rung["promoted"] = [
+                config_id
+                for config_id in ranked[:num_promoted]
+                if np.isfinite(scores[config_id])
+            ]
+            decision = {
+                "rung": rung_num,
+                "epochs": epochs,
+                "ranking": [
+                    {
+                        "config": config_id,
+                        "loss": scores[config_id]
+                        if np.isfinite(scores[config_id])
+                        else None,
+                    }
+                    for config_id in ranked
+                ],
+                "promoted": rung["promoted"],
+                "stopped": [c for c in ranked if c not in rung["promoted"]],
+            }
+            logger.info(
+                f"Rung {rung_num}: promoted configs {decision['promoted']}, "
+                f"stopped configs {decision['stopped']}"
+            )
+            with open(sweep_dir / DECISIONS_FILENAME, "a") as f:
+                f.write(json.dumps(decision) + "\n")
+            save_halving_state(state_path, state)
+        config_ids = rung["promoted"]
+        if not config_ids:
+            logger.warning("No configs left to promote, stopping sweep")
+            break
+
+    logger.info(f"Sweep summary saved to {summary_path}")
+    return results
+
+
+def run_sweep(data_file, sweep_dir, spec, jobs=1, threads=None):
+    configs, swept = get_configs(spec)
+    sweep_dir = Path(sweep_dir).resolve()
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    threads = threads or max(1, (os.cpu_count() or 1) // jobs)
+    if jobs <= 1:
+        init_worker(threads)
+    else:
+        # Fails before any data is prepared
+        get_fork_context()
+    if "halving" in spec:
+        return run_halving(data_file, sweep_dir, spec, configs, swept, jobs, threads)
+
+    with open(sweep_dir / CONFIGS_FILENAME, "w") as f:
+        json.dump(configs, f, indent=2)
+    summary_path = sweep_dir / SUMMARY_FILENAME
+    tasks = [(i, config, sweep_dir / f"{i:03d}") for i, config in enumerate(configs)]
+    results = {}
+    for config_id, config_results, _ in train_configs(data_file, tasks, jobs, threads):
+        logger.info(f"Config {config_id}: {config_results}")
+        results[config_id] = config_results
+        # Rewritten after every config, so a stopped sweep keeps its results
+        write_summary(summary_path, configs, swept, results)
+
+    logger.info(f"Sweep summary saved to {summary_path}")
+    return results
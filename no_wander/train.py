@@ -1,60 +1,99 @@
+import json
 import logging
 import numpy as np
+import os
 import pickle
+import shutil
 from pathlib import Path
 from sklearn.model_selection import train_test_split
-from .datasets import read_dataset, DATASET_TRAIN, DATASET_VAL
-from .features import preprocess_data_test, preprocess_data_train
-from .models import compile_model, fit_model, get_model_from_layers
-from .constants import PREPROCESS_NONE
+from .cache import (
+    CACHE_SIZE_DEFAULT,
+    evict_entries,
+    get_cache_key,
+    get_content_hash,
+    touch_entry,
+)
+from .datasets import get_store_dir, read_dataset, DATASET_TRAIN, DATASET_VAL
+from .feature_store import get_feature_store_path
+from .features import get_compute_dtype, preprocess_data_test, preprocess_data_train
+from .constants import (
+    DIR_CACHE,
+    DTYPE_FLOAT64,
+    PREPROCESS_NONE,
+    PSD_MULTITAPER,
+    SCALER_ROBUST,
+)
 
 LEARNING_RATE = 0.1
 BETA_ONE = 0.9
 BETA_TWO = 0.999
 DECAY = 0.01
 RANDOM_SEED = 42
+# Bump when changes to data prep would make cached tensors stale
+TENSOR_CACHE_VERSION = 1
+TENSOR_CACHE_CHUNK_SAMPLES = 1024
+TENSOR_CACHE_METADATA = "metadata.json"
+TENSOR_CACHE_PREPROCESSOR = "preprocess.pickle"
 WINDOW_POST_RECOVERY = (0, 3)
 WINDOW_PRE_RECOVERY = (-7, -1)
 
 logger = logging.getLogger(__name__)
 
 
-def get_sequences(samples, labels, input_shape, shuffle_samples):
-    sequence_size = input_shape[0]
+def get_sequence_index(labels, sequence_size, shuffle_samples, balance_classes=False):
+    # Sequences are rows of sample indices, so samples are only gathered in batches
     logger.info(f"Forming sequences of length {sequence_size}...")
+    index = np.arange(len(labels))
     if shuffle_samples:
         logger.debug("Shuffling samples...")
         np.random.seed(RANDOM_SEED)
-        shuffle = np.random.permutation(samples.shape[0])
-        samples = samples[shuffle]
-        labels = labels[shuffle]
+        index = np.random.permutation(len(labels))
+    labels = np.asarray(labels).flatten()[index]
 
-    X = []
+    sequences = []
     for label, label_name in [(0, "miss"), (1, "hit")]:
-        X_label = samples[(labels == label).flatten()]
-        num_samples = X_label.shape[0]
+        index_label = index[labels == label]
+        num_samples = index_label.shape[0]
         rem = num_samples % sequence_size
         if rem > 0:
             if shuffle_samples:
                 pad = np.random.choice(
                     num_samples, size=(sequence_size - rem), replace=False
                 )
-                X_label = np.concatenate([X_label, X_label[pad]], axis=0)
+                index_label = np.concatenate([index_label, index_label[pad]])
                 logger.debug(
                     f"Padded {label_name} with {len(pad)} samples for even sequences"
                 )
             else:
-                X_label = X_label[:-rem]
+                index_label = index_label[:-rem]
                 logger.debug(f"Dropped {rem} {label_name} samples for even sequences")
-        X.append(X_label.reshape((-1, *input_shape)))
+        sequences.append(index_label.reshape(-1, sequence_size))
 
-    miss_size = X[0].shape[0]
-    X = np.concatenate(X)
-    Y = np.ones((X.shape[0], 1))
+    if balance_classes and min(map(len, sequences)) > 0:
+        # The minority class is oversampled with replacement
+        rng = np.random.RandomState(RANDOM_SEED)
+        minority = int(len(sequences[1]) < len(sequences[0]))
+        num_extra = len(sequences[1 - minority]) - len(sequences[minority])
+        extra = rng.choice(len(sequences[minority]), size=num_extra, replace=True)
+        sequences[minority] = np.concatenate(
+            [sequences[minority], sequences[minority][extra]]
+        )
+        logger.debug(f"Oversampled {num_extra} sequences to balance classes")
+
+    miss_size = len(sequences[0])
+    index = np.concatenate(sequences)
+    Y = np.ones((len(index), 1), dtype=np.int8)
     Y[:miss_size] = 0
     logger.info(f"Formed {Y.size} sequences! {miss_size} miss / {int(Y.sum())} hit")
-    logger.debug(f"Sequences shape: {X.shape}")
-    return np.nan_to_num(X, 0), Y
+    return index, Y
+
+
+def gather_sequences(samples, index, input_shape, dtype=None):
+    # Gathering makes the only copy, so it can be cast and cleaned in place
+    X = np.asarray(samples[index.ravel()])
+    if dtype is not None:
+        X = X.astype(dtype, copy=False)
+    return np.nan_to_num(X.reshape((-1, *input_shape)), copy=False)
 
 
 def plot_training_history(history, model_dir):
@@ -91,6 +130,7 @@ def train_model(
     Y_val,
     input_shape,
     shuffle_samples=False,
+    balance_classes=False,
     # Optimizer params
     learning_rate=LEARNING_RATE,
     beta_one=BETA_ONE,
@@ -100,15 +140,57 @@ def train_model(
     checkpoint=True,
     gradient_metrics=False,
     tensorboard=False,
+    performance_metrics=False,
+    resume_checkpoint=None,
     **kwargs,
 ):
+    from .models import PerformanceCallback, compile_model, fit_model
+    from .pipeline import BATCH_SIZE_DEFAULT, SequenceBatches, time_input
+
     compile_model(model, learning_rate, beta_one, beta_two, decay)
+    if resume_checkpoint is not None and Path(f"{resume_checkpoint}.index").exists():
+        logger.info(f"Resuming from {resume_checkpoint}...")
+        model.load_weights(str(resume_checkpoint))
 
-    X, Y = get_sequences(X_train, Y_train, input_shape, shuffle_samples)
-    validation_data = get_sequences(X_val, Y_val, input_shape, False)
-    logger.info(
-        f"Train on {len(X)} samples, validate on {len(validation_data[0])} samples"
-    )
+    batch_size = kwargs.pop("batch_size", None) or BATCH_SIZE_DEFAULT
+    if Y_train is None:
+        # Streamed datasets are already cut into batches of labeled sequences
+        X, Y = X_train, None
+        validation_data = X_val
+        logger.info("Train and validate on streamed sequences")
+    else:
+        # Models train in at least float32, whatever the storage precision
+        dtype = get_compute_dtype(X_train)
+        sequence_size = input_shape[0]
+        index, labels = get_sequence_index(
+            Y_train, sequence_size, shuffle_samples, balance_classes=balance_classes
+        )
+        X = SequenceBatches(
+            X_train,
+            index,
+            labels,
+            input_shape,
+            batch_size=batch_size,
+            shuffle=True,
+            dtype=dtype,
+            seed=RANDOM_SEED,
+        )
+        Y = None
+        index, labels = get_sequence_index(Y_val, sequence_size, False)
+        validation_data = SequenceBatches(
+            X_val, index, labels, input_shape, batch_size=batch_size, dtype=dtype
+        )
+        logger.info(
+            f"Train on {len(X.index)} samples, validate on {len(index)} samples"
+        )
+
+    callbacks = []
+    if performance_metrics:
+        logger.debug(f"Performance metrics will be saved to {model_dir}")
+        X, input_timer = time_input(X)
+        callbacks.append(
+            PerformanceCallback(model_dir, batch_size, input_timer, gradient_metrics)
+        )
 
     try:
         history = fit_model(
@@ -118,6 +200,7 @@ def train_model(
             checkpoint_path=model_dir / "model_best" if checkpoint else None,
             gradient_metrics=gradient_metrics,
             tensorboard_path=model_dir / "tensorboard" if tensorboard else None,
+            callbacks=callbacks,
             validation_data=validation_data,
             **kwargs,
         )
@@ -125,10 +208,175 @@ def train_model(
         logger.info("\nTraining interrupted!")
         history = model.history
 
+    if resume_checkpoint is not None:
+        # TensorFlow-format weights include the optimizer state
+        model.save_weights(str(resume_checkpoint))
     plot_training_history(history, model_dir)
     return history
 
 
+def get_tensor_cache_dir(data_file):
+    return Path(data_file).resolve().parent / DIR_CACHE
+
+
+def save_array(filepath, X):
+    if isinstance(X, np.ndarray):
+        np.save(filepath, X)
+        return
+    # Lazy samples are copied in chunks, so they never have to fit in memory
+    out = np.lib.format.open_memmap(filepath, mode="w+", dtype=X.dtype, shape=X.shape)
+    for start in range(0, len(X), TENSOR_CACHE_CHUNK_SAMPLES):
+        stop = start + TENSOR_CACHE_CHUNK_SAMPLES
+        out[start:stop] = X[start:stop]
+    out.flush()
+    del out
+
+
+def save_cached_data(entry, datasets, preprocessor, metadata):
+    logger.info(f"Caching prepared data to {entry}...")
+    tmp_dir = entry.with_name(f".{entry.name}.{os.getpid()}")
+    tmp_dir.mkdir(parents=True)
+    for set_type, (X, Y) in datasets.items():
+        save_array(tmp_dir / f"{set_type}_X.npy", X)
+        save_array(tmp_dir / f"{set_type}_Y.npy", Y)
+    with open(tmp_dir / TENSOR_CACHE_PREPROCESSOR, "wb") as f:
+        pickle.dump(preprocessor, f)
+    with open(tmp_dir / TENSOR_CACHE_METADATA, "w") as f:
+        json.dump(metadata, f)
+
+    try:
+        os.replace(tmp_dir, entry)
+    except OSError:
+        # Another run cached the same data first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load_cached_data(entry):
+    logger.info(f"Loading prepared data from cache {entry}...")
+    with open(entry / TENSOR_CACHE_METADATA, "r") as f:
+        metadata = json.load(f)
+    with open(entry / TENSOR_CACHE_PREPROCESSOR, "rb") as f:
+        preprocessor = pickle.load(f)
+    datasets = {
+        set_type: tuple(
+            np.load(entry / f"{set_type}_{name}.npy", mmap_mode="r")
+            for name in ["X", "Y"]
+        )
+        for set_type in [DATASET_TRAIN, DATASET_VAL]
+    }
+    touch_entry(entry)
+    return datasets, preprocessor, metadata
+
+
+def prepare_data(
+    data_file,
+    sample_size,
+    sequence_size,
+    post_window=WINDOW_POST_RECOVERY,
+    pre_window=WINDOW_PRE_RECOVERY,
+    preprocess=PREPROCESS_NONE,
+    extractors=None,
+    psd=PSD_MULTITAPER,
+    scaler=SCALER_ROBUST,
+    shuffle_samples=False,
+    lazy=False,
+    store_dir=None,
+    stride=None,
+    dtype=DTYPE_FLOAT64,
+    cache=False,
+    cache_size=CACHE_SIZE_DEFAULT,
+    workers=1,
+    feature_store=False,
+    extract_chunk_size=None,
+):
+    consecutive_samples = 1 if shuffle_samples else sequence_size
+    cached = None
+    if cache:
+        cache_dir = get_tensor_cache_dir(data_file)
+        entry = cache_dir / get_cache_key(
+            TENSOR_CACHE_VERSION,
+            get_content_hash(data_file, cache_dir),
+            sample_size,
+            consecutive_samples,
+            pre_window,
+            post_window,
+            preprocess,
+            extractors,
+            psd,
+            scaler,
+            stride,
+            np.dtype(dtype).name,
+        )
+        if entry.exists():
+            cached = load_cached_data(entry)
+
+    if cached is not None:
+        datasets, preprocessor, metadata = cached
+    else:
+        if lazy:
+            # Extracted features are memory-mapped next to the samples
+            store_dir = get_store_dir(store_dir)
+        out_files = {
+            set_type: store_dir / f"{set_type}.features.npy" if lazy else None
+            for set_type in [DATASET_TRAIN, DATASET_VAL]
+        }
+        datasets, features_raw = read_dataset(
+            data_file,
+            sample_size,
+            consecutive_samples,
+            pre_window,
+            post_window,
+            lazy=lazy,
+            store_dir=store_dir,
+            stride=stride,
+            dtype=dtype,
+        )
+        samples_train, labels_train = datasets[DATASET_TRAIN]
+        logger.info(f"{len(samples_train)} samples in training set")
+
+        store_path = get_feature_store_path(data_file) if feature_store else None
+        samples_train, preprocessor, features, is_flattened = preprocess_data_train(
+            samples_train,
+            preprocess,
+            features_raw,
+            extractors=extractors,
+            psd=psd,
+            scaler=scaler,
+            workers=workers,
+            feature_store=store_path,
+            chunk_size=extract_chunk_size,
+            out_file=out_files[DATASET_TRAIN],
+        )
+        samples_val, labels_val = datasets[DATASET_VAL]
+        samples_val = preprocess_data_test(
+            samples_val,
+            preprocessor,
+            workers=workers,
+            feature_store=store_path,
+            chunk_size=extract_chunk_size,
+            out_file=out_files[DATASET_VAL],
+        )
+        datasets = {
+            DATASET_TRAIN: (samples_train, labels_train),
+            DATASET_VAL: (samples_val, labels_val),
+        }
+        metadata = {
+            "features_raw": features_raw,
+            "features": features,
+            "is_flattened": is_flattened,
+        }
+        if cache:
+            save_cached_data(entry, datasets, preprocessor, metadata)
+            evict_entries(cache_dir, cache_size, keep=entry.name)
+
+    features = metadata["features"]
+    input_shape = (
+        sequence_size,
+        len(features) * (1 if metadata["is_flattened"] else sample_size),
+    )
+    return datasets, preprocessor, metadata["features_raw"], features, input_shape
+
+
 def build_and_train_model(
     data_file,
     model_dir,
@@ -143,28 +391,101 @@ def build_and_train_model(
     post_window=WINDOW_POST_RECOVERY,
     pre_window=WINDOW_PRE_RECOVERY,
     preprocess=PREPROCESS_NONE,
+    extractors=None,
+    psd=PSD_MULTITAPER,
+    scaler=SCALER_ROBUST,
     shuffle_samples=False,
+    lazy=False,
+    store_dir=None,
+    stride=None,
+    dtype=DTYPE_FLOAT64,
+    cache=False,
+    cache_size=CACHE_SIZE_DEFAULT,
+    workers=1,
+    feature_store=False,
+    extract_chunk_size=None,
+    stream=False,
+    stream_kwargs={},
     **train_kwargs,
 ):
     model_dir = Path(model_dir).resolve()
     model_dir.mkdir(parents=True, exist_ok=True)
     logger.debug(f"Model files will be saved to {model_dir}")
 
-    datasets, features_raw = read_dataset(
-        data_file,
-        sample_size,
-        1 if shuffle_samples else sequence_size,
-        pre_window,
-        post_window,
-    )
-    samples_train, labels_train = datasets[DATASET_TRAIN]
-    logger.info(f"{len(samples_train)} samples in training set")
-    logger.info(f"Raw features: {', '.join(features_raw)}")
+    if stream:
+        from .pipeline import get_stream_datasets
+
+        if "batch_size" in train_kwargs:
+            # Still passed on to training, to count the samples per second
+            stream_kwargs = {**stream_kwargs, "batch_size": train_kwargs["batch_size"]}
+        stream_data = get_stream_datasets(
+            data_file,
+            sample_size,
+            sequence_size,
+            pre_window,
+            post_window,
+            preprocess,
+            extractors=extractors,
+            psd=psd,
+            scaler=scaler,
+            shuffle_samples=shuffle_samples,
+            stride=stride,
+            seed=RANDOM_SEED,
+            dtype=dtype,
+            **stream_kwargs,
+        )
+        streams, preprocessor, features_raw, features, input_shape = stream_data
+        datasets = {set_type: (stream, None) for set_type, stream in streams.items()}
+    else:
+        prepared = prepare_data(
+            data_file,
+            sample_size,
+            sequence_size,
+            post_window=post_window,
+            pre_window=pre_window,
+            preprocess=preprocess,
+            extractors=extractors,
+            psd=psd,
+            scaler=scaler,
+            shuffle_samples=shuffle_samples,
+            lazy=lazy,
+            store_dir=store_dir,
+            stride=stride,
+            dtype=dtype,
+            cache=cache,
+            cache_size=cache_size,
+            workers=workers,
+            feature_store=feature_store,
+            extract_chunk_size=extract_chunk_size,
+        )
+        datasets, preprocessor, features_raw, features, input_shape = prepared
 
-    samples_train, preprocessor, features, is_flattened = preprocess_data_train(
-        samples_train, preprocess, features_raw
+    return train_prepared_model(
+        model_dir,
+        (datasets, preprocessor, features_raw, features, input_shape),
+        layers,
+        dropout=dropout,
+        encode_position=encode_position,
+        output=output,
+        shuffle_samples=shuffle_samples,
+        **train_kwargs,
     )
-    input_shape = (sequence_size, len(features) * (1 if is_flattened else sample_size))
+
+
+def train_prepared_model(
+    model_dir,
+    prepared,
+    layers,
+    dropout=0,
+    encode_position=False,
+    output={},
+    shuffle_samples=False,
+    **train_kwargs,
+):
+    from .models import get_model_from_layers
+
+    datasets, preprocessor, features_raw, features, input_shape = prepared
+    logger.info(f"Raw features: {', '.join(features_raw)}")
     logger.info(f"Preprocessed features: {', '.join(features)}")
     logger.info(f"Input shape: {input_shape}")
 
@@ -184,10 +505,11 @@ def build_and_train_model(
     )
     model.summary()
 
+    history = None
     if train_kwargs.get("epochs", 0):
+        samples_train, labels_train = datasets[DATASET_TRAIN]
         samples_val, labels_val = datasets[DATASET_VAL]
-        samples_val = preprocess_data_test(samples_val, preprocessor)
-        train_model(
+        history = train_model(
             model,
             model_dir,
             samples_train,
@@ -203,3 +525,4 @@ def build_and_train_model(
     logger.info(f"Saving model to {model_path}...")
     model.save(model_path)
     logger.info("Done!")
+    return history
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+from no_wander.constants import COL_MARKER_DEFAULT
+from no_wander.datasets import save_epochs
+
+
+@pytest.fixture
+def epoch_file(tmp_path):
+    rng = np.random.RandomState(0)
+
+    def make_epoch(start):
+        df = pd.DataFrame(
+            rng.randn(60, 2),
+            index=start + np.arange(60) / 256,
+            columns=["EEG_TP9", "EEG_AF7"],
+        )
+        df[COL_MARKER_DEFAULT] = 0
+        return df
+
+    filepath = tmp_path / "epochs" / "epochs.h5"
+    filepath.parent.mkdir()
+    save_epochs(
+        filepath,
+        {
+            "train": [(make_epoch(100 * i), 30, f"1.2020-01-01.{i}") for i in range(4)],
+            "val": [(make_epoch(1000), 30, "1.2020-01-02.1")],
+        },
+    )
+    return filepath
@@ -0,0 +1,42 @@
+import numpy as np
+from no_wander.datasets import get_num_samples
+from no_wander.train import gather_sequences, get_sequence_index
+
+
+# Reference implementations replaced by faster ones, kept to test against
+
+
+def get_window_samples(data, sample_size, consecutive_samples, window, stride=None):
+    stride = stride or sample_size
+    start, stop = window
+    is_flip = stop <= 0
+    if is_flip:
+        start, stop = -stop, -start
+        data = data[::-1]
+
+    data = data[start:stop]
+    num_samples = get_num_samples(len(data), sample_size, consecutive_samples, stride)
+    drop = len(data) - ((num_samples - 1) * stride + sample_size if num_samples else 0)
+
+    # Samples are views into the window, overlapping if stride < sample_size
+    samples = np.lib.stride_tricks.as_strided(
+        data,
+        shape=(num_samples, sample_size, data.shape[1]),
+        strides=(data.strides[0] * stride, *data.strides),
+        writeable=False,
+    )
+    if is_flip:
+        samples = samples[::-1, ::-1]
+    return list(samples), drop
+
+
+def get_sequences(
+    samples, labels, input_shape, shuffle_samples, dtype=None, balance_classes=False
+):
+    # Every sequence gathered at once, as training did before batches were
+    # gathered by index
+    index, Y = get_sequence_index(
+        labels, input_shape[0], shuffle_samples, balance_classes=balance_classes
+    )
+    X = gather_sequences(samples, index, input_shape, dtype=dtype)
+    return X, Y.astype(X.dtype)
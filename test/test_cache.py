@@ -0,0 +1,38 @@
+import os
+import pandas as pd
+from no_wander.cache import evict_entries
+from no_wander.process import read_csv_cached
+
+
+def test_evict_entries_least_recently_used(tmp_path):
+    for i, name in enumerate(["old", "new", "newest"]):
+        entry = tmp_path / name
+        entry.write_bytes(b"0" * 100)
+        os.utime(entry, (i, i))
+
+    total_size = evict_entries(tmp_path, 250)
+
+    assert total_size == 200
+    assert sorted(f.name for f in tmp_path.iterdir()) == ["new", "newest"]
+
+
+def test_read_csv_cached(tmp_path):
+    datafile = tmp_path / "session.EEG.1.csv"
+    df = pd.DataFrame(
+        {"TP9": [1.5, 2.5], "Marker0": [0, 1]},
+        index=pd.Index([100.0, 100.5], name="timestamps"),
+    )
+    df.to_csv(datafile)
+    cache_dir = tmp_path / "cache"
+
+    parsed = read_csv_cached(datafile, cache_dir)
+    cached = read_csv_cached(datafile, cache_dir)
+
+    assert len(list(cache_dir.iterdir())) == 1
+    pd.testing.assert_frame_equal(parsed, df.astype(float))
+    pd.testing.assert_frame_equal(cached, parsed)
+
+    os.utime(datafile, ns=(0, 0))
+    read_csv_cached(datafile, cache_dir)
+
+    assert len(list(cache_dir.iterdir())) == 2
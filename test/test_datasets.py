@@ -1,6 +1,7 @@
 import numpy as np
 import pytest
-from no_wander.datasets import get_window_samples
+from no_wander.datasets import get_window_starts
+from . import helpers
 
 
 @pytest.fixture
@@ -14,6 +15,16 @@ def make_data():
     return _make_data
 
 
+def get_window_samples(data, sample_size, consecutive_samples, window, stride=None):
+    # Samples read at the start rows planned for a window of data, as if the
+    # recovery were at the end of data for pre windows and at the start for post
+    recovery_ix = len(data) if window[1] <= 0 else 0
+    starts, dropped = get_window_starts(
+        recovery_ix, len(data), sample_size, consecutive_samples, window, stride
+    )
+    return [data[start : start + sample_size] for start in starts], dropped
+
+
 def test_get_window_samples_post_not_consecutive(make_data):
     num_features = 5
     data = make_data(10, num_features)
@@ -127,3 +138,47 @@ def test_get_window_samples_short(num_readings, sample_size, window, make_data):
     assert dropped == num_readings - min(abs(ix) for ix in window)
     assert type(samples) is list
     assert len(samples) == 0
+
+
+@pytest.mark.parametrize("stride", [1, 3])
+@pytest.mark.parametrize("window", [(0, 8), (-8, -1)])
+def test_get_window_samples_stride(make_data, stride, window):
+    data = make_data(10, 2)
+    sample_size = 3
+    samples, dropped = get_window_samples(data, sample_size, 1, window, stride)
+
+    is_pre = window[1] <= 0
+    window_data = data[2:9] if is_pre else data[0:8]
+    num_samples = (len(window_data) - sample_size) // stride + 1
+    sample_starts = stride * np.arange(num_samples)
+    if is_pre:
+        # Pre-recovery samples are aligned to the end of the window
+        sample_starts = len(window_data) - sample_size - sample_starts[::-1]
+
+    assert dropped == len(window_data) - (num_samples - 1) * stride - sample_size
+    assert len(samples) == num_samples
+    for sample, start in zip(samples, sample_starts):
+        assert np.array_equal(sample, window_data[start : start + sample_size])
+        assert np.shares_memory(sample, data)
+
+
+@pytest.mark.parametrize("stride", [None, 1, 3])
+@pytest.mark.parametrize("consecutive_samples", [1, 2])
+@pytest.mark.parametrize("window", [(0, 8), (2, 20), (-8, -1), (-20, -3), (-3, 0)])
+def test_get_window_starts(make_data, consecutive_samples, window, stride):
+    data = make_data(16, 2)
+    recovery_ix = 7
+    sample_size = 2
+    window_data = data[:recovery_ix] if window[1] <= 0 else data[recovery_ix:]
+    samples, dropped = helpers.get_window_samples(
+        window_data, sample_size, consecutive_samples, window, stride
+    )
+
+    starts, starts_dropped = get_window_starts(
+        recovery_ix, len(data), sample_size, consecutive_samples, window, stride
+    )
+
+    assert starts_dropped == dropped
+    assert len(starts) == len(samples)
+    for start, sample in zip(starts, samples):
+        assert np.array_equal(data[start : start + sample_size], sample)
@@ -0,0 +1,259 @@
+import h5py
+import numpy as np
+import pickle
+import pandas as pd
+import pytest
+from no_wander.constants import COL_MARKER_DEFAULT
+from no_wander.datasets import (
+    convert_epochs,
+    EpochTable,
+    FORMAT_V1,
+    FORMAT_V2,
+    get_epoch_samples,
+    iter_epochs,
+    parse_dataset,
+    plan_samples,
+    read_dataset,
+    save_epochs,
+)
+from .helpers import get_window_samples
+
+
+@pytest.fixture
+def epochs():
+    rng = np.random.RandomState(0)
+
+    def make_epoch(start, num_readings, columns):
+        df = pd.DataFrame(
+            rng.randn(num_readings, len(columns)),
+            index=start + np.arange(num_readings) / 256,
+            columns=columns,
+        )
+        df[COL_MARKER_DEFAULT] = 0
+        return df
+
+    return {
+        "train": [
+            (make_epoch(100, 50, ["EEG_TP9", "EEG_AF7"]), 20, "1.2020-01-01.1"),
+            (
+                make_epoch(200, 40, ["ACC_X", "EEG_TP9", "EEG_AF7"]),
+                10,
+                "2.2020-01-02.3",
+            ),
+        ],
+        "val": [(make_epoch(300, 30, ["EEG_AF7", "EEG_TP9"]), 15, "1.2020-01-01.2")],
+    }
+
+
+def get_named_columns(epoch, column_numbers, features):
+    # The v2 layout stores each epoch's columns in the order of the shared table
+    return {features[col]: epoch[:, i] for i, col in enumerate(column_numbers)}
+
+
+def assert_parsed_equal(parsed, expected):
+    data, features = parsed
+    expected_data, expected_features = expected
+    for set_type in expected_data:
+        assert len(data[set_type]) == len(expected_data[set_type])
+        for (epoch, recovery, columns), (exp_epoch, exp_recovery, exp_columns) in zip(
+            data[set_type], expected_data[set_type]
+        ):
+            assert recovery == exp_recovery
+            named = get_named_columns(epoch, columns, features)
+            exp_named = get_named_columns(exp_epoch, exp_columns, expected_features)
+            assert named.keys() == exp_named.keys()
+            for col in named:
+                assert np.array_equal(named[col], exp_named[col])
+
+
+@pytest.mark.parametrize("format_version", [FORMAT_V1, FORMAT_V2])
+def test_save_epochs_parse_dataset(tmp_path, epochs, format_version):
+    filepath = tmp_path / "epochs.h5"
+    save_epochs(filepath, epochs, format_version=format_version)
+
+    data, features = parse_dataset(filepath, test_set="val")
+
+    assert features == ["EEG_TP9", "EEG_AF7", "ACC_X"]
+    assert [len(data[set_type]) for set_type in ["train", "val"]] == [2, 1]
+    epoch, recovery, columns = data["train"][1]
+    assert recovery == 10
+    named = get_named_columns(epoch, columns, features)
+    expected = epochs["train"][1][0]
+    assert sorted(named) == ["ACC_X", "EEG_AF7", "EEG_TP9"]
+    for col in named:
+        assert np.array_equal(named[col], expected[col])
+
+
+def test_convert_epochs_roundtrip(tmp_path, epochs):
+    v1_path = tmp_path / "v1.h5"
+    save_epochs(v1_path, epochs, format_version=FORMAT_V1)
+    expected = parse_dataset(v1_path, test_set="val")
+
+    convert_epochs(v1_path, tmp_path / "v2.h5", FORMAT_V2)
+    convert_epochs(tmp_path / "v2.h5", tmp_path / "v1-again.h5", FORMAT_V1)
+
+    assert_parsed_equal(parse_dataset(tmp_path / "v2.h5", test_set="val"), expected)
+    assert_parsed_equal(
+        parse_dataset(tmp_path / "v1-again.h5", test_set="val"), expected
+    )
+
+
+def test_epoch_table_buffered(tmp_path, epochs):
+    epoch_list = epochs["train"] + epochs["val"]
+    with h5py.File(tmp_path / "epochs.h5", "w") as hf:
+        table = EpochTable(hf, {}, buffer_rows=60)
+        for epoch, recovery, session in epoch_list:
+            data = epoch.drop(columns=[COL_MARKER_DEFAULT])
+            name = str(len(table.names))
+            table.append(data.to_numpy(), data.columns, name, recovery, session)
+            # The first epoch waits in the buffer, the second fills it
+            assert hf["index/name"].shape[0] == [0, 2, 2][int(name)]
+        table.flush()
+
+        saved = list(iter_epochs(hf, FORMAT_V2))
+    assert [name for name, *_ in saved] == ["0", "1", "2"]
+    for (_, data, columns, recovery, session), (epoch, *expected) in zip(
+        saved, epoch_list
+    ):
+        assert [recovery, session] == expected
+        expected_data = epoch.drop(columns=[COL_MARKER_DEFAULT])[columns]
+        assert np.array_equal(data, expected_data.to_numpy())
+
+
+def test_save_epochs_append(tmp_path, epochs):
+    filepath = tmp_path / "epochs.h5"
+    save_epochs(filepath, {"train": epochs["train"][:1]})
+    save_epochs(filepath, {"train": epochs["train"]}, mode="a")
+
+    data, features = parse_dataset(filepath, test_set=None)
+
+    assert len(data["train"]) == 2
+    assert features == ["EEG_TP9", "EEG_AF7", "ACC_X"]
+
+
+@pytest.mark.parametrize("format_version", [FORMAT_V1, FORMAT_V2])
+@pytest.mark.parametrize("consecutive_samples", [1, 2])
+def test_read_dataset_lazy(tmp_path, epochs, format_version, consecutive_samples):
+    filepath = tmp_path / "epochs.h5"
+    save_epochs(filepath, epochs, format_version=format_version)
+    read_kwargs = dict(
+        sample_size=3,
+        consecutive_samples=consecutive_samples,
+        pre_window=(-14, -1),
+        post_window=(0, 20),
+        sample_rate=1,
+    )
+
+    expected, expected_features = read_dataset(filepath, **read_kwargs)
+    datasets, features = read_dataset(
+        filepath, lazy=True, store_dir=tmp_path, **read_kwargs
+    )
+
+    assert features == expected_features
+    for set_type in ["train", "val"]:
+        X, Y = datasets[set_type]
+        X_expected, Y_expected = expected[set_type]
+        assert X.shape == X_expected.shape
+        assert np.array_equal(Y, Y_expected)
+        assert np.array_equal(np.asarray(X), X_expected, equal_nan=True)
+        assert np.array_equal(X[1], X_expected[1], equal_nan=True)
+        assert np.shares_memory(X[1], X.data)
+        assert np.array_equal(X[::-2], X_expected[::-2], equal_nan=True)
+        mask = Y.flatten() == 1
+        assert np.array_equal(X[mask], X_expected[mask], equal_nan=True)
+        assert X.memory_footprint()["mapped"] == X.data.nbytes
+
+    X_unpickled = pickle.loads(pickle.dumps(datasets["train"][0]))
+    assert np.array_equal(X_unpickled[:], expected["train"][0], equal_nan=True)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+@pytest.mark.parametrize("dtype", [np.float32, np.float16])
+def test_read_dataset_dtype(tmp_path, epochs, lazy, dtype):
+    filepath = tmp_path / "epochs.h5"
+    save_epochs(filepath, epochs)
+    read_kwargs = dict(
+        sample_size=3,
+        consecutive_samples=1,
+        pre_window=(-14, -1),
+        post_window=(0, 20),
+        sample_rate=1,
+        lazy=lazy,
+        store_dir=tmp_path,
+    )
+
+    expected, _ = read_dataset(filepath, **read_kwargs)
+    datasets, _ = read_dataset(filepath, dtype=dtype, **read_kwargs)
+
+    tolerance = np.finfo(dtype).resolution * 10
+    for set_type in ["train", "val"]:
+        X = np.asarray(datasets[set_type][0])
+        X_expected = np.asarray(expected[set_type][0])
+        assert X.dtype == dtype
+        assert X.nbytes < X_expected.nbytes
+        assert np.allclose(
+            X, X_expected, rtol=tolerance, atol=tolerance, equal_nan=True
+        )
+
+
+@pytest.mark.parametrize("format_version", [FORMAT_V1, FORMAT_V2])
+def test_get_epoch_samples(tmp_path, epochs, format_version):
+    filepath = tmp_path / "epochs.h5"
+    save_epochs(filepath, epochs, format_version=format_version)
+    windows = ((-14, -1), (0, 20))
+    expected, expected_features = read_dataset(filepath, 3, 2, *windows, sample_rate=1)
+
+    with h5py.File(filepath, "r") as hf:
+        plan, features = plan_samples(hf, ["train", "val"], 3, 2, *windows)
+        assert list(features) == expected_features
+        for set_type in ["train", "val"]:
+            # Epochs are read in reverse to check selection by position
+            selection = np.arange(len(plan[set_type]))[::-1]
+            samples = [
+                get_epoch_samples(epoch, columns, plan[set_type][i], features, 3)
+                for i, (_, epoch, columns, _, _) in zip(
+                    selection,
+                    iter_epochs(hf[set_type], format_version, epochs=selection),
+                )
+            ][::-1]
+            X = np.concatenate([X for X, _ in samples])
+            Y = np.concatenate([Y for _, Y in samples])
+            assert np.array_equal(X, expected[set_type][0], equal_nan=True)
+            assert np.array_equal(Y, expected[set_type][1])
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_read_dataset_stride(tmp_path, epochs, lazy):
+    filepath = tmp_path / "epochs.h5"
+    save_epochs(filepath, epochs)
+    windows = ((-14, -1), (0, 20))
+    data, features = parse_dataset(filepath, test_set="val")
+
+    datasets, _ = read_dataset(
+        filepath,
+        3,
+        2,
+        *windows,
+        sample_rate=1,
+        lazy=lazy,
+        store_dir=tmp_path,
+        stride=2,
+    )
+
+    for set_type in ["train", "val"]:
+        expected = []
+        for epoch, recovery, columns in data[set_type]:
+            for window_data, window in [
+                (epoch[:recovery], windows[0]),
+                (epoch[recovery:], windows[1]),
+            ]:
+                for sample in get_window_samples(window_data, 3, 2, window, 2)[0]:
+                    padded = np.full((3, len(features)), np.nan)
+                    padded[:, columns] = sample
+                    expected.append(padded)
+        X, Y = datasets[set_type]
+        assert len(X) == len(Y) == len(expected)
+        assert np.array_equal(np.asarray(X), np.array(expected), equal_nan=True)
+        # Overlapping samples share rows instead of copying them
+        assert np.shares_memory(X[0], X[1])
+        assert X.data.shape[0] < len(X) * 3
@@ -0,0 +1,350 @@
+import h5py
+import numpy as np
+import pytest
+from benchmarks.correlation import correlation_matrix_lagged_cov
+from multiprocessing import Pool
+from no_wander import features
+from no_wander.feature_store import (
+    get_sample_keys,
+    read_stored_features,
+    write_stored_features,
+)
+from no_wander.constants import (
+    EXTRACTOR_CORRELATION,
+    EXTRACTOR_GRAPH,
+    EXTRACTOR_TIME,
+    PREPROCESS_EXTRACT_EEG,
+    PREPROCESS_NORMALIZE,
+    PSD_PERIODOGRAM,
+    PSD_WELCH,
+    SCALER_STREAMING,
+)
+from no_wander.features import (
+    extract_bandpower_features,
+    extract_eeg_features,
+    extract_graph_features,
+    extract_time_features,
+    get_correlation_matrices,
+    get_eeg_data,
+    get_psd,
+    map_chunks,
+    preprocess_data_test,
+    preprocess_data_train,
+)
+
+
+def time_features_reference(X):
+    # Previous implementation: one reduction per feature
+    from scipy import stats
+
+    trapezoid = getattr(np, "trapezoid", None) or np.trapz
+    positive = X > 0
+    return np.concatenate(
+        [
+            X.mean(axis=-1),
+            X.var(axis=-1),
+            X.std(axis=-1),
+            stats.skew(X, axis=-1),
+            stats.kurtosis(X, axis=-1),
+            np.count_nonzero(
+                np.bitwise_xor(positive[:, :, 1:], positive[:, :, :-1]), axis=-1
+            ),
+            X.max(axis=-1) - X.min(axis=-1),
+            trapezoid(np.abs(X), axis=-1, dx=1 / 256),
+        ],
+        axis=-1,
+    )
+
+
+@pytest.fixture
+def samples():
+    rng = np.random.RandomState(0)
+    X = rng.randn(20, 8, 3) * [1, 50, 1000]
+    X[0, :2, 1] = np.nan
+    return X
+
+
+def test_get_eeg_data_dtype(samples):
+    features = ["EEG_TP9", "ACC_X", "EEG_AF7"]
+    for dtype, expected in [
+        (np.float64, np.float64),
+        (np.float32, np.float32),
+        (np.float16, np.float32),
+    ]:
+        X_eeg, channels = get_eeg_data(samples.astype(dtype), features)
+        assert X_eeg.dtype == expected
+        assert X_eeg.shape == (20, 2, 8)
+        assert channels == ["TP9", "AF7"]
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float16])
+def test_preprocess_normalize_dtype(samples, dtype):
+    features = ["EEG_TP9", "ACC_X", "EEG_AF7"]
+    expected, preprocessor, _, _ = preprocess_data_train(
+        samples, PREPROCESS_NORMALIZE, features
+    )
+    expected_test = preprocess_data_test(samples[:5], preprocessor)
+
+    X, preprocessor, _, _ = preprocess_data_train(
+        samples.astype(dtype), PREPROCESS_NORMALIZE, features
+    )
+    X_test = preprocess_data_test(samples[:5], preprocessor)
+
+    assert preprocessor["dtype"] == np.dtype(dtype).name
+    assert X.dtype == np.float32
+    assert X_test.dtype == np.float32
+    tolerance = {"rtol": 1e-5, "atol": 1e-5} if dtype == np.float32 else {"atol": 1e-2}
+    assert np.allclose(X, expected, equal_nan=True, **tolerance)
+    assert np.allclose(X_test, expected_test, equal_nan=True, **tolerance)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 4, 100])
+def test_extract_time_features(chunk_size):
+    rng = np.random.RandomState(0)
+    X = rng.randn(10, 4, 256) * [[1], [10], [100], [0.1]] + [[0], [5], [0], [-1]]
+    X[3, 1] = 0
+    X[4, 2] = 7
+    expected = time_features_reference(X[:3]).reshape(3, 8, 4)
+
+    X_time, extractor, names = extract_time_features(X, chunk_size=chunk_size)
+
+    assert X_time.shape == (10, 32)
+    assert extractor is None
+    assert names[3:5] == ["skew", "kurtosis"]
+    X_time = X_time.reshape(10, 8, 4)
+    assert np.allclose(X_time[:3], expected, rtol=1e-10, atol=1e-10)
+    # Constant channels have no skew and a kurtosis of -3, like older scipy
+    assert np.allclose(X_time[3, :, 1], [0, 0, 0, 0, -3, 0, 0, 0])
+    assert np.allclose(X_time[4, :, 2], [7, 0, 0, 0, -3, 0, 0, 7 * 255 / 256])
+    assert extract_time_features(X.astype(np.float32))[0].dtype == np.float32
+
+
+@pytest.mark.parametrize("psd", [PSD_WELCH, PSD_PERIODOGRAM])
+def test_extract_bandpower_features(psd):
+    rng = np.random.RandomState(0)
+    X = rng.randn(5, 3, 256)
+    X[2, 1] = 0
+
+    X_bands, extractor, names = extract_bandpower_features(X, psd=psd)
+
+    assert extractor == {"psd": psd}
+    assert names == ["delta", "theta", "alpha", "beta", "gamma1", "gamma2", "energy"]
+    assert X_bands.shape == (5, 21)
+    psds, freqs = get_psd(X, psd=psd)
+    assert freqs[-1] <= 110
+    bounds = [0, 4, 8, 14, 30, 65, freqs[-1] + 1]
+    for i, (fmin, fmax) in enumerate(zip(bounds[:-1], bounds[1:])):
+        power = psds[:, :, (freqs >= fmin) & (freqs < fmax)].sum(axis=-1)
+        total = psds.sum(axis=-1)
+        expected = power / np.where(total > 0, total, 1)
+        assert np.allclose(X_bands[:, i * 3 : (i + 1) * 3], expected)
+    assert np.allclose(X_bands[:, 18:], psds.sum(axis=-1))
+    assert np.allclose(X_bands[:, :18].reshape(5, 6, 3).sum(axis=1)[[0, 1, 3, 4]], 1)
+    assert np.all(X_bands[2, 1::3] == 0)
+
+    with pytest.raises(ValueError):
+        extract_bandpower_features(X, psd="fft")
+
+
+def test_preprocess_normalize_streaming(samples, tmp_path):
+    features = ["EEG_TP9", "ACC_X", "EEG_AF7"]
+    expected, _, _, _ = preprocess_data_train(samples, PREPROCESS_NORMALIZE, features)
+
+    X, preprocessor, _, _ = preprocess_data_train(
+        samples,
+        PREPROCESS_NORMALIZE,
+        features,
+        scaler=SCALER_STREAMING,
+        chunk_size=3,
+        out_file=tmp_path / "train.npy",
+    )
+    X_test = preprocess_data_test(samples[:5], preprocessor, chunk_size=2)
+
+    assert isinstance(X, np.memmap)
+    assert np.allclose(X, expected, equal_nan=True)
+    assert np.allclose(X_test, expected[:5], equal_nan=True)
+
+
+def test_get_correlation_matrices():
+    rng = np.random.RandomState(0)
+    X = rng.randn(6, 4, 128)
+    X[1, 2] = 0
+    X[2] += np.sin(np.arange(128) / 5)
+
+    corr = get_correlation_matrices(X)
+
+    assert corr.shape == (6, 4, 4)
+    for epoch, epoch_corr in zip(X, corr):
+        assert np.allclose(epoch_corr, correlation_matrix_lagged_cov(epoch))
+    assert np.all(corr[1, 2] == 0)
+
+
+def graph_features_stub(W):
+    # Same layout as the real graph features
+    return [
+        W.sum(axis=0),
+        W.max(axis=0),
+        W.min(axis=0),
+        W.mean(axis=0),
+        [W.sum(), W.min(), W.max(), W.mean()],
+    ]
+
+
+def test_extract_graph_features_workers(monkeypatch):
+    # Workers are forked, so they see the patched extractor
+    monkeypatch.setattr(features, "extract_epoch_graph_features", graph_features_stub)
+    monkeypatch.setattr(features, "GRAPH_CHUNK_SIZE", 4)
+    corr = get_correlation_matrices(np.random.RandomState(0).randn(30, 4, 64))
+
+    expected = extract_graph_features(corr)
+    with Pool(3) as pool:
+        graph = extract_graph_features(corr, pool=pool)
+
+    assert len(graph) == 30
+    assert np.array_equal(graph, expected)
+    assert np.array_equal(graph[7][:4], corr[7].sum(axis=0))
+
+
+def test_extract_eeg_features_shared_pool(monkeypatch, samples):
+    monkeypatch.setattr(features, "extract_epoch_graph_features", graph_features_stub)
+    monkeypatch.setattr(features, "GRAPH_CHUNK_SIZE", 2)
+    pools = []
+    corr_calls = []
+
+    def pool_spy(workers):
+        pools.append(Pool(workers))
+        return pools[-1]
+
+    def corr_spy(X):
+        corr_calls.append(len(X))
+        return get_correlation_matrices(X)
+
+    features_raw = ["EEG_TP9", "ACC_X", "EEG_AF7"]
+    extractors = [EXTRACTOR_CORRELATION, EXTRACTOR_GRAPH]
+    expected, _, expected_names = extract_eeg_features(
+        samples, features_raw, extractors=extractors
+    )
+    monkeypatch.setattr(features, "Pool", pool_spy)
+    monkeypatch.setattr(features, "get_correlation_matrices", corr_spy)
+
+    X, _, names = extract_eeg_features(
+        samples, features_raw, extractors=extractors, workers=2, chunk_size=8
+    )
+
+    assert np.array_equal(X, expected)
+    assert names == expected_names
+    # One pool for all chunks, and correlations computed once per chunk
+    assert len(pools) == 1
+    assert corr_calls == [8, 8, 4]
+
+
+def test_extract_eeg_features_store(monkeypatch, samples, tmp_path):
+    calls = []
+
+    def compute_stub(X_eeg, channels, extractors=None, pool=None):
+        calls.append(len(X_eeg))
+        X = np.concatenate([X_eeg.mean(axis=-1), X_eeg.max(axis=-1)], axis=-1)
+        features = [f"{ch}_{feat}" for feat in ["mean", "max"] for ch in channels]
+        return X, {"time": None}, features
+
+    monkeypatch.setattr(features, "compute_eeg_features", compute_stub)
+    features_raw = ["EEG_TP9", "ACC_X", "EEG_AF7"]
+    store_path = tmp_path / "epochs.features.h5"
+    expected, _, expected_features = extract_eeg_features(samples, features_raw)
+
+    X, extractor, names = extract_eeg_features(
+        samples[:12], features_raw, store_path=store_path
+    )
+    assert np.array_equal(X, expected[:12])
+    # Duplicated samples are only extracted once
+    X, extractor, names = extract_eeg_features(
+        np.concatenate([samples, samples[15:]]), features_raw, store_path=store_path
+    )
+    assert np.array_equal(X, np.concatenate([expected, expected[15:]]))
+    X, extractor, names = extract_eeg_features(
+        samples[::-1], features_raw, store_path=store_path
+    )
+
+    assert calls == [20, 12, 8]
+    assert np.array_equal(X, expected[::-1])
+    assert extractor == {"time": None}
+    assert names == expected_features
+
+    # A different precision is stored separately
+    extract_eeg_features(
+        samples.astype(np.float32), features_raw, store_path=store_path
+    )
+    assert calls[-1] == 20
+
+    # Chunks share the key index and only read the rows they need
+    X, _, _ = extract_eeg_features(
+        samples[::-1], features_raw, store_path=store_path, chunk_size=7
+    )
+    assert len(calls) == 4
+    assert np.array_equal(X, expected[::-1])
+
+
+def test_read_stored_features(tmp_path):
+    rng = np.random.RandomState(0)
+    keys = get_sample_keys(rng.randn(10, 2, 8))
+    X = rng.randn(10, 3)
+    key_index = {}
+
+    with h5py.File(tmp_path / "store.h5", "w") as hf:
+        grp = hf.create_group("features")
+        write_stored_features(grp, keys[:6], X[:6], {"time": None}, ["a", "b", "c"])
+        X_stored, found = read_stored_features(grp, keys[[5, 1, 1, 8]], key_index)
+
+        assert found.tolist() == [True, True, True, False]
+        assert np.array_equal(X_stored, X[[5, 1, 1]])
+        assert len(key_index) == 6
+
+        write_stored_features(grp, keys[6:], X[6:], {"time": None}, ["a", "b", "c"])
+        X_stored, found = read_stored_features(grp, keys[::-1], key_index)
+
+        assert found.all()
+        assert np.array_equal(X_stored, X[::-1])
+        assert key_index == {key: i for i, key in enumerate(keys.tolist())}
+
+
+def test_preprocess_extract_eeg_selected(samples):
+    features_raw = ["EEG_TP9", "ACC_X", "EEG_AF7"]
+    # Extractors always run in registry order
+    X, preprocessor, names, is_flattened = preprocess_data_train(
+        samples, PREPROCESS_EXTRACT_EEG, features_raw, [EXTRACTOR_CORRELATION, "time"]
+    )
+    X_test = preprocess_data_test(samples[:5], preprocessor)
+
+    assert is_flattened
+    assert preprocessor["extractors"] == [EXTRACTOR_TIME, EXTRACTOR_CORRELATION]
+    assert names[:4] == ["TP9_mean", "AF7_mean", "TP9_var", "AF7_var"]
+    assert names[16:] == ["TP9_AF7_corr", "TP9_decor_t", "AF7_decor_t"]
+    assert X.shape == (20, 19)
+    assert np.array_equal(X_test, X[:5])
+
+    with pytest.raises(ValueError):
+        preprocess_data_train(samples, PREPROCESS_EXTRACT_EEG, features_raw, ["fft"])
+
+
+def test_map_chunks_lazy(monkeypatch, tmp_path):
+    monkeypatch.setattr(features, "CHUNK_SIZE_DEFAULT", 4)
+    X_raw = np.lib.format.open_memmap(
+        tmp_path / "samples.npy", mode="w+", dtype=np.float64, shape=(10, 2, 3)
+    )
+    X_raw[:] = np.arange(X_raw.size).reshape(X_raw.shape)
+    chunk_sizes = []
+
+    def double(X):
+        chunk_sizes.append(len(X))
+        return X * 2, "details"
+
+    X, details = map_chunks(double, X_raw)
+
+    # Memory-mapped samples are chunked even without a chunk size
+    assert chunk_sizes == [4, 4, 2]
+    assert details == "details"
+    assert np.array_equal(X, X_raw * 2)
+
+    chunk_sizes.clear()
+    map_chunks(double, np.array(X_raw))
+    assert chunk_sizes == [10]
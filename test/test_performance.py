@@ -0,0 +1,61 @@
+import csv
+import json
+import logging
+import pytest
+from no_wander import performance
+from no_wander.performance import InputTimer, PerformanceRecorder
+
+
+def test_input_timer(monkeypatch):
+    monkeypatch.setattr(performance, "time", lambda: 100.0)
+    ready_time = [0.0]
+    input_timer = InputTimer(lambda: ready_time[0])
+
+    input_timer.step_begin()
+    ready_time[0] = 100.5
+    assert input_timer.step_end() == pytest.approx(0.5)
+
+    # Batches already queued when the step starts are not waited on
+    input_timer.step_begin()
+    ready_time[0] = 99.0
+    assert input_timer.step_end() == 0
+
+
+def test_performance_recorder(tmp_path, monkeypatch, caplog):
+    clock = [0.0]
+    monkeypatch.setattr(performance, "perf_counter", lambda: clock[0])
+    monkeypatch.setattr(performance, "time", lambda: clock[0])
+    ready_time = [0.0]
+    recorder = PerformanceRecorder(tmp_path, 4, InputTimer(lambda: ready_time[0]))
+
+    recorder.train_begin()
+    for epoch, waits in enumerate([(0.6, 0.2), (0.9, 0.9)]):
+        recorder.epoch_begin()
+        for batch, wait in enumerate(waits):
+            recorder.batch_begin()
+            ready_time[0] = clock[0] + wait
+            clock[0] += 1
+            recorder.batch_end(batch)
+        with caplog.at_level(logging.WARNING):
+            metrics = recorder.epoch_end(epoch)
+        assert ("input-bound" in caplog.text) == bool(epoch)
+
+    with open(tmp_path / performance.PERFORMANCE_BATCHES_FILENAME) as f:
+        rows = list(csv.reader(f))
+    assert rows[0][:4] == ["epoch", "batch", "step_seconds", "input_wait_seconds"]
+    assert [row[:2] for row in rows[1:]] == [
+        ["0", "0"],
+        ["0", "1"],
+        ["1", "0"],
+        ["1", "1"],
+    ]
+    assert [float(row[3]) for row in rows[1:]] == pytest.approx([0.6, 0.2, 0.9, 0.9])
+
+    with open(tmp_path / performance.PERFORMANCE_EPOCHS_FILENAME) as f:
+        epochs = json.load(f)
+    assert [epoch["epoch"] for epoch in epochs] == [0, 1]
+    assert epochs[0]["step_seconds"] == pytest.approx(1)
+    assert epochs[0]["samples_per_second"] == pytest.approx(4)
+    assert epochs[0]["input_wait_seconds"] == pytest.approx(0.4)
+    assert epochs[0]["input_fraction"] == pytest.approx(0.4)
+    assert metrics["input_fraction"] == pytest.approx(0.9)
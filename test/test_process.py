@@ -0,0 +1,365 @@
+import h5py
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from collections import Counter
+from no_wander import process
+from no_wander.constants import (
+    COL_MARKER_DEFAULT,
+    COL_MARKER_PREFIX,
+    COL_RIGHT_AUX,
+    DIR_EPOCHS,
+    DIR_FAILED,
+    DIR_PROCESSED,
+    DIR_SUBJECT_PREFIX,
+    SAMPLE_RATE,
+    SOURCE_EEG,
+)
+from no_wander.datasets import (
+    get_epoch_groups,
+    get_epoch_name,
+    iter_epoch_metadata,
+    iter_epochs,
+)
+from no_wander.process import (
+    EPOCH_SIZE_SAMPLES,
+    MANIFEST_FILENAME,
+    debounce_recoveries,
+    get_epoch_splits,
+    get_files_by_session,
+    iter_session_chunks,
+    merge_sources,
+    plan_epochs,
+    process_session_data,
+)
+
+
+def merge_sources_outer_join(data, reindex):
+    # pandas<1.0 sorted the union of indices, later versions need sort=True
+    merged = pd.concat(data, axis=1, join="outer", sort=True)
+    marker_cols = [col for col in merged.columns if col.startswith(COL_MARKER_PREFIX)]
+    merged[marker_cols] = merged[marker_cols].fillna(0)
+    merged = merged.apply(pd.Series.interpolate, args=("index",))
+    merged = merged.reindex(index=reindex.index)
+    merged.dropna(axis=0, how="any", inplace=True)
+    return merged
+
+
+@pytest.fixture
+def make_source():
+    rng = np.random.RandomState(42)
+
+    def _make_source(name, marker_num, start, rate, num_readings, num_cols=3):
+        index = start + np.arange(num_readings) / rate
+        index += rng.uniform(0, 0.1 / rate, num_readings)
+        df = pd.DataFrame(
+            rng.randn(num_readings, num_cols),
+            index=pd.Index(index, name="timestamps"),
+            columns=[f"{name}_{i}" for i in range(num_cols)],
+        )
+        df[f"{COL_MARKER_PREFIX}{marker_num}"] = 0.0
+        return df
+
+    return _make_source
+
+
+@pytest.fixture
+def write_chunk(tmp_path):
+    input_dir = tmp_path / "input"
+
+    def _write_chunk(chunk, start, recoveries, num_readings=None, seed=0):
+        if num_readings is None:
+            num_readings = 3 * EPOCH_SIZE_SAMPLES
+        rng = np.random.RandomState(seed)
+        df = pd.DataFrame(
+            rng.randn(num_readings, 4),
+            index=pd.Index(
+                start + np.arange(num_readings) / SAMPLE_RATE, name="timestamps"
+            ),
+            columns=["TP9", "AF7", "AF8", "TP10"],
+        )
+        df[COL_MARKER_DEFAULT] = 0
+        df.iloc[recoveries, -1] = 1
+        subject_dir = input_dir / f"{DIR_SUBJECT_PREFIX}test"
+        subject_dir.mkdir(parents=True, exist_ok=True)
+        filepath = subject_dir / f"{start}.{SOURCE_EEG}.{chunk}.csv"
+        df.to_csv(filepath)
+        return filepath
+
+    _write_chunk.input_dir = input_dir
+    return _write_chunk
+
+
+def test_merge_sources_matches_outer_join(make_source):
+    eeg = make_source("EEG", 0, 100, 256, 2560, num_cols=4)
+    eeg.iloc[[300, 310, 1500], -1] = 1
+    acc = make_source("ACC", 1, 100.5, 52, 400)
+    acc.iloc[[10, 11], -1] = 1
+    # Gaps inside a source are interpolated across
+    acc.iloc[50:60, 0] = np.nan
+    ppg = make_source("PPG", 2, 99, 64, 500)
+
+    data = [eeg, acc, ppg]
+    expected = merge_sources_outer_join(data, eeg)
+    merged = merge_sources(data, reindex=eeg)
+
+    assert list(merged.columns) == [
+        col for col in expected.columns if not col.startswith(COL_MARKER_PREFIX)
+    ] + [COL_MARKER_DEFAULT]
+    assert np.array_equal(merged.index, expected.index)
+    assert np.array_equal(
+        merged.iloc[:, :-1].to_numpy(), expected[merged.columns[:-1]].to_numpy()
+    )
+    assert merged[COL_MARKER_DEFAULT].sum() == 2
+
+
+def plan_epochs_loop(recoveries, num_readings, epoch_size):
+    plan = []
+    last_max = 0
+    num_recoveries = len(recoveries)
+    for i in range(num_recoveries):
+        recovery_ix = recoveries[i]
+        min_ix = max(last_max, recovery_ix - epoch_size)
+        max_ix = min(num_readings, recovery_ix + epoch_size)
+        if i < num_recoveries - 1:
+            next_pre = recoveries[i + 1] - epoch_size
+            if next_pre < recovery_ix + 0.5 * epoch_size:
+                last_max = recovery_ix
+                continue
+            elif next_pre < max_ix:
+                max_ix = next_pre
+        plan.append((min_ix, max_ix, recovery_ix - min_ix))
+        last_max = max_ix
+    return plan
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_plan_epochs_matches_loop(seed):
+    rng = np.random.RandomState(seed)
+    num_readings = 20000
+    epoch_size = 1000
+    recoveries = np.sort(rng.choice(num_readings, size=25, replace=False))
+
+    plan = plan_epochs(recoveries, num_readings, epoch_size=epoch_size)
+
+    assert plan.tolist() == [
+        list(epoch) for epoch in plan_epochs_loop(recoveries, num_readings, epoch_size)
+    ]
+
+
+def test_plan_epochs_no_recoveries():
+    assert plan_epochs([], 100).shape == (0, 3)
+
+
+def test_debounce_recoveries():
+    timestamps = np.array([10.0, 10.5, 10.99, 11.0, 11.2, 12.0, 12.5, 13.1])
+
+    keep = debounce_recoveries(timestamps, debounce=1)
+
+    assert keep.tolist() == [0, 3, 5, 7]
+
+
+def test_iter_session_chunks_workers(write_chunk):
+    for chunk in range(4):
+        write_chunk(chunk, 1000 + 100 * chunk, [EPOCH_SIZE_SAMPLES], seed=chunk)
+    # Header only, so the merged frame is empty
+    write_chunk(4, 1400, [], num_readings=0)
+    raw_files = get_files_by_session(write_chunk.input_dir)
+
+    expected = list(iter_session_chunks(raw_files, workers=1))
+    results = list(iter_session_chunks(raw_files, workers=2))
+
+    assert [session for session, _, _, _ in results] == list(raw_files)
+    for (_, _, result, _), (_, _, expected_result, _) in zip(results, expected):
+        (plan, values, _, columns), chunk_range = result
+        (expected_plan, expected_values, _, _), expected_range = expected_result
+        assert np.array_equal(plan, expected_plan)
+        assert chunk_range == expected_range
+        if values is not None:
+            assert np.array_equal(values, expected_values)
+    num_epochs = {session.name: len(result[0][0]) for session, _, result, _ in results}
+    assert num_epochs == {
+        **{f"test.{1000 + 100 * i}.{i}": 1 for i in range(4)},
+        "test.1400.4": 0,
+    }
+    # An empty chunk is processed, not failed
+    assert all(result is not None for _, _, result, _ in results)
+
+    limited = list(iter_session_chunks(raw_files, limit=3, workers=2))
+    assert [session for session, _, _, _ in limited] == list(raw_files)[:3]
+
+
+def count_epochs(epochs_dir):
+    counts = {}
+    for filepath in sorted(epochs_dir.glob("*.h5")):
+        with h5py.File(filepath, "r") as hf:
+            groups, format_version = get_epoch_groups(hf)
+            for name, grp in groups.items():
+                num_epochs = len(list(iter_epoch_metadata(grp, format_version)))
+                counts[f"{filepath.name}/{name}"] = num_epochs
+    return counts
+
+
+def get_split_names(epochs_dir):
+    names = {}
+    for filepath in sorted(epochs_dir.glob("*.h5")):
+        with h5py.File(filepath, "r") as hf:
+            groups, format_version = get_epoch_groups(hf)
+            for group_name, grp in groups.items():
+                split = group_name or "test"
+                names[split] = sorted(
+                    name for name, _, _, _, _ in iter_epochs(grp, format_version)
+                )
+    return names
+
+
+def list_files(data_dir):
+    return sorted(f.name for f in data_dir.glob("*/*.csv"))
+
+
+def test_process_session_data_incremental(write_chunk, tmp_path, monkeypatch):
+    epochs_dir = tmp_path / DIR_EPOCHS
+    input_dir = write_chunk.input_dir
+    for chunk in range(2):
+        write_chunk(chunk, 1000 * (chunk + 1), [EPOCH_SIZE_SAMPLES], seed=chunk)
+
+    process_session_data(
+        get_files_by_session(input_dir), tmp_path, incremental=True, seed=0
+    )
+
+    with open(epochs_dir / MANIFEST_FILENAME, "r") as f:
+        manifest = json.load(f)
+    assert sorted(manifest["chunks"]) == ["test.1000.0", "test.2000.1"]
+    assert manifest["dataset"] == "1000-2029"
+    assert manifest["ts_range"][0] == 1000
+    assert sum(count_epochs(epochs_dir).values()) == 2
+    assert list_files(tmp_path / DIR_PROCESSED) == ["1000.EEG.0.csv", "2000.EEG.1.csv"]
+
+    # Unchanged chunk 0 is skipped, changed chunk 1 and unreadable chunk 3 fail
+    write_chunk(0, 1000, [EPOCH_SIZE_SAMPLES], seed=0)
+    write_chunk(1, 2000, [EPOCH_SIZE_SAMPLES], seed=10)
+    write_chunk(2, 3000, [EPOCH_SIZE_SAMPLES], seed=2)
+    bad_file = write_chunk(3, 4000, [EPOCH_SIZE_SAMPLES], seed=3)
+    df = pd.read_csv(bad_file, index_col=0)
+    df[COL_RIGHT_AUX] = 1.0
+    df.to_csv(bad_file)
+
+    process_session_data(
+        get_files_by_session(input_dir), tmp_path, incremental=True, seed=0
+    )
+
+    with open(epochs_dir / MANIFEST_FILENAME, "r") as f:
+        manifest = json.load(f)
+    assert sorted(manifest["chunks"]) == ["test.1000.0", "test.2000.1", "test.3000.2"]
+    assert manifest["dataset"] == "1000-3029"
+    assert sorted(f.name for f in epochs_dir.glob("*.h5")) == [
+        "1000-3029-test.h5",
+        "1000-3029-train.h5",
+    ]
+    assert sum(count_epochs(epochs_dir).values()) == 3
+    assert list_files(tmp_path / DIR_FAILED) == ["2000.EEG.1.csv", "4000.EEG.3.csv"]
+    assert list_files(input_dir) == []
+
+    # A failed run leaves the epoch files and manifest as they were
+    counts = count_epochs(epochs_dir)
+    for chunk in range(4, 6):
+        write_chunk(chunk, 1000 * (chunk + 1), [EPOCH_SIZE_SAMPLES], seed=chunk)
+    splits = iter(["train"])
+    monkeypatch.setattr(
+        process,
+        "get_epoch_splits",
+        lambda rng, num_epochs, *args: [next(splits) for _ in range(num_epochs)],
+    )
+
+    process_session_data(
+        get_files_by_session(input_dir), tmp_path, incremental=True, seed=0
+    )
+
+    with open(epochs_dir / MANIFEST_FILENAME, "r") as f:
+        assert json.load(f) == manifest
+    assert count_epochs(epochs_dir) == counts
+    assert sorted(f.name for f in epochs_dir.glob("*.h5")) == [
+        "1000-3029-test.h5",
+        "1000-3029-train.h5",
+    ]
+    assert "5000.EEG.4.csv" in list_files(tmp_path / DIR_FAILED)
+
+
+@pytest.mark.parametrize("chunk_sizes", [[3], [1, 1, 1], [2, 5, 1, 4, 1, 7]])
+def test_get_epoch_splits(chunk_sizes):
+    rng = np.random.RandomState(0)
+    counts = Counter()
+    splits = []
+    for num_epochs in chunk_sizes:
+        splits += get_epoch_splits(rng, num_epochs, counts, 0.2, 0.2)
+
+    # Same counts as splitting every epoch at once
+    num_epochs = sum(chunk_sizes)
+    num_train = int(0.6 * num_epochs)
+    num_val = int(0.8 * num_epochs) - num_train
+    expected = {
+        "train": num_train,
+        "val": num_val,
+        "test": num_epochs - num_train - num_val,
+    }
+    assert Counter(splits) == counts == expected
+
+
+def test_process_session_data_seeded_split(write_chunk, tmp_path):
+    recoveries = [EPOCH_SIZE_SAMPLES, 4 * EPOCH_SIZE_SAMPLES + 100]
+    for chunk in range(6):
+        write_chunk(
+            chunk,
+            1000 * (chunk + 1),
+            recoveries,
+            num_readings=6 * EPOCH_SIZE_SAMPLES,
+            seed=chunk,
+        )
+    raw_files = get_files_by_session(write_chunk.input_dir)
+
+    # Epochs are assigned a split in the order chunks are submitted
+    rng = np.random.RandomState(3)
+    counts = Counter()
+    expected = {"train": [], "val": [], "test": []}
+    for _, _, result, _ in iter_session_chunks(raw_files):
+        (plan, _, timestamps, _), _ = result
+        splits = get_epoch_splits(rng, len(plan), counts, 0.3, 0.3)
+        for (start, stop, _), split in zip(plan, splits):
+            expected[split].append(get_epoch_name(timestamps[start:stop]))
+
+    process_session_data(
+        raw_files, tmp_path, test_split=0.3, val_split=0.3, workers=2, seed=3
+    )
+
+    epochs_dir = tmp_path / DIR_EPOCHS
+    assert get_split_names(epochs_dir) == {
+        split: sorted(names) for split, names in expected.items()
+    }
+    assert sum(len(names) for names in expected.values()) == 12
+    assert sorted(f.name for f in epochs_dir.iterdir()) == [
+        "1000-6059-test.h5",
+        "1000-6059-train.h5",
+    ]
+
+
+def test_process_session_data_failure_cleanup(write_chunk, tmp_path, monkeypatch):
+    for chunk in range(3):
+        write_chunk(chunk, 1000 * (chunk + 1), [EPOCH_SIZE_SAMPLES], seed=chunk)
+    splits = iter(["train", "val"])
+    monkeypatch.setattr(
+        process,
+        "get_epoch_splits",
+        lambda rng, num_epochs, *args: [next(splits) for _ in range(num_epochs)],
+    )
+
+    process_session_data(get_files_by_session(write_chunk.input_dir), tmp_path)
+
+    epochs_dir = tmp_path / DIR_EPOCHS
+    assert list(epochs_dir.iterdir()) == []
+    assert list_files(tmp_path / DIR_FAILED) == [
+        "1000.EEG.0.csv",
+        "2000.EEG.1.csv",
+        "3000.EEG.2.csv",
+    ]
+    assert not (tmp_path / DIR_PROCESSED).exists()
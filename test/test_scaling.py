@@ -0,0 +1,68 @@
+import numpy as np
+import pickle
+from sklearn.preprocessing import RobustScaler
+from no_wander.scaling import QuantileSketch, StreamingRobustScaler
+
+
+def test_streaming_robust_scaler_exact():
+    rng = np.random.RandomState(0)
+    X = rng.randn(500, 3) * [1, 10, 100]
+    X[::7, 1] = np.nan
+
+    scaler = StreamingRobustScaler()
+    for start in range(0, len(X), 100):
+        scaler.partial_fit(X[start : start + 100])
+    expected = RobustScaler().fit(X)
+
+    assert np.allclose(scaler.center_, expected.center_)
+    assert np.allclose(scaler.scale_, expected.scale_)
+    assert np.allclose(scaler.transform(X), expected.transform(X), equal_nan=True)
+
+
+def test_streaming_robust_scaler_approximate():
+    rng = np.random.RandomState(0)
+    X = np.concatenate(
+        [rng.randn(200000, 2) * [1, 100], rng.exponential(size=(200000, 1))], axis=1
+    )
+    X[rng.rand(len(X)) < 0.2, 0] = np.nan
+    X[:, 2] *= 0
+
+    scaler = StreamingRobustScaler(sketch_size=512)
+    queries = []
+    quantiles = scaler.sketch.quantiles
+    scaler.sketch.quantiles = lambda q: queries.append(q) or quantiles(q)
+    for start in range(0, len(X), 10000):
+        scaler.partial_fit(X[start : start + 10000])
+    expected = RobustScaler().fit(X)
+
+    # Quantiles are only queried once fitting is done
+    assert queries == []
+    scaler.transform(X[:10])
+    scaler.transform(X[10:20])
+    assert len(queries) == 1
+    del scaler.sketch.quantiles
+
+    assert sum(len(level) for level in scaler.sketch.levels) < 10000
+    assert np.allclose(scaler.center_, expected.center_, atol=0.05 * expected.scale_)
+    assert np.allclose(scaler.scale_, expected.scale_, rtol=0.05)
+    assert scaler.scale_[2] == 1
+
+    restored = pickle.loads(pickle.dumps(scaler))
+    assert np.array_equal(
+        restored.transform(X[:10]), scaler.transform(X[:10]), equal_nan=True
+    )
+
+
+def test_quantile_sketch_merge():
+    rng = np.random.RandomState(0)
+    X = rng.rand(40000, 2)
+    sketches = [
+        QuantileSketch(256, seed=i).update(x) for i, x in enumerate(np.split(X, 4))
+    ]
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+
+    assert merged.count == len(X)
+    quantiles = merged.quantiles([0.1, 0.5, 0.9])
+    assert np.allclose(quantiles, np.percentile(X, [10, 50, 90], axis=0), atol=0.02)
@@ -0,0 +1,223 @@
+import csv
+import json
+import multiprocessing
+import pytest
+from no_wander import sweep
+from no_wander.constants import PREPROCESS_NORMALIZE
+from no_wander.sweep import get_configs, get_rung_epochs, group_configs, run_sweep
+
+
+class HistoryStub:
+    def __init__(self, history):
+        self.history = history
+
+
+def test_get_configs_grid():
+    spec = {
+        "base": {"sample_size": 3, "sequence_size": 2, "layers": [], "epochs": 1},
+        "params": {"learning_rate": [0.1, 0.01], "pre_window": [[-1, 0], [-2, 0]]},
+    }
+    configs, swept = get_configs(spec)
+
+    assert swept == ["learning_rate", "pre_window"]
+    assert len(configs) == 4
+    assert configs[1] == {**spec["base"], "learning_rate": 0.1, "pre_window": [-2, 0]}
+    groups = group_configs(configs)
+    assert [config_ids for _, config_ids in groups] == [[0, 2], [1, 3]]
+    assert groups[1][0]["pre_window"] == (-2, 0)
+
+    with pytest.raises(ValueError):
+        get_configs({"base": {"sample_size": 3, "layers": []}})
+
+
+def test_get_configs_random():
+    spec = {
+        "search": "random",
+        "num_configs": 20,
+        "seed": 0,
+        "base": {"sample_size": 3, "layers": []},
+        "params": {
+            "sequence_size": [2, 4],
+            "learning_rate": {"min": 1e-4, "max": 1e-1, "log": True},
+            "dropout": {"min": 0, "max": 0.5},
+        },
+    }
+    configs, _ = get_configs(spec)
+
+    assert len(configs) == 20
+    assert configs == get_configs(spec)[0]
+    assert {config["sequence_size"] for config in configs} == {2, 4}
+    assert all(1e-4 <= config["learning_rate"] <= 1e-1 for config in configs)
+    # Shuffled samples don't depend on the sequence size
+    for config in configs:
+        config["shuffle_samples"] = True
+    assert len(group_configs(configs)) == 1
+
+
+def test_run_sweep(epoch_file, tmp_path, monkeypatch):
+    trained = []
+
+    def train_stub(model_dir, prepared, layers, **kwargs):
+        trained.append((prepared, kwargs))
+        if kwargs["learning_rate"] == 0:
+            raise ValueError("Bad learning rate")
+        return HistoryStub(
+            {
+                "loss": [0.7, 0.5, 0.6],
+                "val_loss": [0.8, 0.6, 0.7],
+                "val_accuracy": [0.5, 0.7, 0.6],
+            }
+        )
+
+    monkeypatch.setattr(sweep, "train_prepared_model", train_stub)
+    monkeypatch.setattr(sweep, "init_worker", lambda threads: None)
+    loads = []
+    prepare_data = sweep.prepare_data
+    monkeypatch.setattr(
+        sweep,
+        "prepare_data",
+        lambda *args, **kwargs: loads.append(args) or prepare_data(*args, **kwargs),
+    )
+    spec = {
+        "base": {
+            "sequence_size": 2,
+            "layers": [{"type": "lstm", "units": 4}],
+            "pre_window": [-14 / 256, -1 / 256],
+            "post_window": [0, 20 / 256],
+            "preprocess": PREPROCESS_NORMALIZE,
+            "epochs": 3,
+        },
+        "params": {"sample_size": [3, 4], "learning_rate": [0.1, 0.01, 0]},
+    }
+
+    results = run_sweep(epoch_file, tmp_path / "sweep", spec)
+
+    assert len(loads) == 2
+    assert len(trained) == 6
+    assert trained[0][1] == {
+        "epochs": 3,
+        "learning_rate": 0.1,
+        "shuffle_samples": False,
+    }
+    assert trained[0][0][4] == (2, 6)
+    assert results[0]["best_epoch"] == 2
+    assert results[2]["status"].startswith("failed")
+    with open(tmp_path / "sweep" / "summary.csv", "r") as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 6
+    assert rows[1]["learning_rate"] == "0.01"
+    assert rows[1]["val_accuracy"] == "0.7"
+    assert rows[2]["val_loss"] == ""
+    with open(tmp_path / "sweep" / "configs.json", "r") as f:
+        assert len(json.load(f)) == 6
+
+
+def test_get_rung_epochs():
+    assert get_rung_epochs(1, 3, 27) == [1, 3, 9, 27]
+    assert get_rung_epochs(2, 3, 10) == [2, 6, 10]
+    assert get_rung_epochs(4, 2, 4) == [4]
+
+
+def test_run_sweep_halving(epoch_file, tmp_path, monkeypatch):
+    trained = []
+
+    def train_stub(model_dir, prepared, layers, learning_rate, **kwargs):
+        trained.append((learning_rate, kwargs))
+        if learning_rate == 0:
+            raise ValueError("Bad learning rate")
+        num_epochs = kwargs["epochs"] - kwargs["initial_epoch"]
+        losses = [
+            learning_rate / (kwargs["initial_epoch"] + i + 1) for i in range(num_epochs)
+        ]
+        return HistoryStub({"loss": losses, "val_loss": losses})
+
+    monkeypatch.setattr(sweep, "train_prepared_model", train_stub)
+    monkeypatch.setattr(sweep, "init_worker", lambda threads: None)
+    spec = {
+        "base": {
+            "sample_size": 3,
+            "sequence_size": 2,
+            "layers": [{"type": "lstm", "units": 4}],
+            "pre_window": [-14 / 256, -1 / 256],
+            "post_window": [0, 20 / 256],
+            "preprocess": PREPROCESS_NORMALIZE,
+        },
+        "params": {"learning_rate": [0.5, 0.4, 0.3, 0.2, 0.1, 0]},
+        "halving": {"min_epochs": 1, "eta": 2, "max_epochs": 4},
+    }
+    sweep_dir = tmp_path / "sweep"
+
+    results = run_sweep(epoch_file, sweep_dir, spec)
+
+    # Rungs of 1, 2 and 4 epochs keep the best half of the configs each time
+    assert [
+        (lr, kwargs["initial_epoch"], kwargs["epochs"]) for lr, kwargs in trained
+    ] == [
+        (0.5, 0, 1),
+        (0.4, 0, 1),
+        (0.3, 0, 1),
+        (0.2, 0, 1),
+        (0.1, 0, 1),
+        (0, 0, 1),
+        (0.1, 1, 2),
+        (0.2, 1, 2),
+        (0.3, 1, 2),
+        (0.1, 2, 4),
+    ]
+    assert trained[-1][1]["resume_checkpoint"] == str(
+        sweep_dir / "004" / "rung_checkpoint" / "weights"
+    )
+    assert results[4] == {
+        "status": "done",
+        "rung": 2,
+        "seconds": results[4]["seconds"],
+        "epochs": 4,
+        "best_epoch": 4,
+        "loss": 0.025,
+        "val_loss": 0.025,
+    }
+    assert results[0]["rung"] == 0
+    assert results[5]["status"].startswith("failed")
+    with open(sweep_dir / "decisions.jsonl", "r") as f:
+        decisions = [json.loads(line) for line in f]
+    assert [decision["promoted"] for decision in decisions] == [[4, 3, 2], [4]]
+    assert decisions[0]["stopped"] == [1, 0, 5]
+    assert decisions[0]["ranking"][-1] == {"config": 5, "loss": None}
+
+    # Finished rungs are skipped when the sweep is run again
+    trained.clear()
+    assert run_sweep(epoch_file, sweep_dir, spec) == results
+    assert trained == []
+    with pytest.raises(ValueError):
+        run_sweep(epoch_file, sweep_dir, {**spec, "params": {"learning_rate": [1]}})
+
+
+def test_run_sweep_jobs_fork(epoch_file, tmp_path, monkeypatch):
+    def train_stub(model_dir, prepared, layers, learning_rate, **kwargs):
+        # Forked workers see the data prepared in the parent
+        return HistoryStub({"loss": [learning_rate], "val_loss": [prepared[4][1]]})
+
+    monkeypatch.setattr(sweep, "train_prepared_model", train_stub)
+    monkeypatch.setattr(sweep, "init_worker", lambda threads: None)
+    spec = {
+        "base": {
+            "sample_size": 3,
+            "sequence_size": 2,
+            "layers": [],
+            "pre_window": [-14 / 256, -1 / 256],
+            "post_window": [0, 20 / 256],
+            "epochs": 1,
+        },
+        "params": {"learning_rate": [0.1, 0.2, 0.3]},
+    }
+    start_method = multiprocessing.get_start_method()
+    # Workers are forked even when the default start method is spawn
+    multiprocessing.set_start_method("spawn", force=True)
+    try:
+        results = run_sweep(epoch_file, tmp_path / "sweep", spec, jobs=2)
+    finally:
+        multiprocessing.set_start_method(start_method, force=True)
+
+    assert sorted(results) == [0, 1, 2]
+    assert [results[i]["loss"] for i in range(3)] == [0.1, 0.2, 0.3]
+    assert all(result["val_loss"] == 6 for result in results.values())
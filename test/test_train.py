@@ -0,0 +1,177 @@
+import numpy as np
+import pytest
+from no_wander import train
+from no_wander.constants import (
+    EXTRACTOR_CORRELATION,
+    EXTRACTOR_TIME,
+    PREPROCESS_EXTRACT_EEG,
+    PREPROCESS_NORMALIZE,
+)
+from no_wander.train import (
+    gather_sequences,
+    get_sequence_index,
+    get_tensor_cache_dir,
+    prepare_data,
+    RANDOM_SEED,
+)
+from .helpers import get_sequences
+
+
+def get_sequences_reference(samples, labels, input_shape, shuffle_samples):
+    # Previous implementation, which copied the samples at every step
+    sequence_size = input_shape[0]
+    if shuffle_samples:
+        np.random.seed(RANDOM_SEED)
+        shuffle = np.random.permutation(samples.shape[0])
+        samples = samples[shuffle]
+        labels = labels[shuffle]
+
+    X = []
+    for label in [0, 1]:
+        X_label = samples[(labels == label).flatten()]
+        num_samples = X_label.shape[0]
+        rem = num_samples % sequence_size
+        if rem > 0:
+            if shuffle_samples:
+                pad = np.random.choice(
+                    num_samples, size=(sequence_size - rem), replace=False
+                )
+                X_label = np.concatenate([X_label, X_label[pad]], axis=0)
+            else:
+                X_label = X_label[:-rem]
+        X.append(X_label.reshape((-1, *input_shape)))
+
+    miss_size = X[0].shape[0]
+    X = np.concatenate(X)
+    Y = np.ones((X.shape[0], 1), dtype=X.dtype)
+    Y[:miss_size] = 0
+    return np.nan_to_num(X), Y
+
+
+@pytest.mark.parametrize("shuffle_samples", [False, True])
+def test_get_sequences_dtype(shuffle_samples):
+    rng = np.random.RandomState(0)
+    samples = rng.randn(30, 4, 2)
+    samples[3, 0, 0] = np.nan
+    labels = (rng.rand(30, 1) > 0.5).astype(float)
+    input_shape = (3, 8)
+
+    expected_X, expected_Y = get_sequences(
+        samples, labels, input_shape, shuffle_samples
+    )
+    X, Y = get_sequences(
+        samples.astype(np.float32), labels, input_shape, shuffle_samples, np.float32
+    )
+
+    assert X.dtype == Y.dtype == np.float32
+    assert expected_X.dtype == np.float64
+    assert not np.isnan(X).any()
+    assert np.array_equal(Y, expected_Y)
+    assert np.allclose(X, expected_X, rtol=1e-6, atol=1e-6)
+
+
+@pytest.mark.parametrize("shuffle_samples", [False, True])
+def test_get_sequences_reference(shuffle_samples):
+    rng = np.random.RandomState(1)
+    samples = rng.randn(41, 4, 2)
+    samples[5, 1, 1] = np.nan
+    labels = (rng.rand(41, 1) > 0.6).astype(float)
+
+    expected_X, expected_Y = get_sequences_reference(
+        samples, labels, (3, 8), shuffle_samples
+    )
+    X, Y = get_sequences(samples, labels, (3, 8), shuffle_samples)
+
+    assert np.array_equal(X, expected_X)
+    assert np.array_equal(Y, expected_Y)
+    # Samples are only gathered, never modified
+    assert np.isnan(samples[5, 1, 1])
+
+
+def test_get_sequence_index_balanced():
+    labels = np.array([0] * 20 + [1] * 7)
+    index, Y = get_sequence_index(labels, 2, False, balance_classes=True)
+
+    assert index.shape == (20, 2)
+    assert Y.sum() == 10
+    # Oversampled hit sequences repeat existing ones
+    hits = {tuple(row) for row in index[Y.flatten() == 1]}
+    assert hits == {(20, 21), (22, 23), (24, 25)}
+    assert np.all(labels[index] == Y)
+
+    X = gather_sequences(np.arange(27.0)[:, np.newaxis], index[:3], (2, 1))
+    assert X.shape == (3, 2, 1)
+    assert np.array_equal(X[:, :, 0], index[:3])
+
+
+def test_prepare_data_cache(epoch_file, monkeypatch):
+    prepare_kwargs = dict(
+        pre_window=(-14 / 256, -1 / 256),
+        post_window=(0, 20 / 256),
+        preprocess=PREPROCESS_NORMALIZE,
+        cache=True,
+    )
+    expected = prepare_data(epoch_file, 3, 2, **prepare_kwargs)
+    cache_dir = get_tensor_cache_dir(epoch_file)
+    assert len([entry for entry in cache_dir.iterdir() if entry.is_dir()]) == 1
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Data should be loaded from cache")
+
+    monkeypatch.setattr(train, "read_dataset", fail)
+    datasets, preprocessor, features_raw, features, input_shape = prepare_data(
+        epoch_file, 3, 2, **prepare_kwargs
+    )
+
+    assert features_raw == expected[2]
+    assert features == expected[3]
+    assert input_shape == expected[4] == (2, 6)
+    assert preprocessor["preprocess"] == PREPROCESS_NORMALIZE
+    for set_type in ["train", "val"]:
+        for actual, exp in zip(datasets[set_type], expected[0][set_type]):
+            assert isinstance(actual, np.memmap)
+            assert np.array_equal(actual, exp, equal_nan=True)
+
+    with pytest.raises(AssertionError):
+        prepare_data(epoch_file, 4, 2, **prepare_kwargs)
+
+
+def test_prepare_data_cache_eviction(epoch_file):
+    prepare_kwargs = dict(
+        pre_window=(-14 / 256, -1 / 256), post_window=(0, 20 / 256), cache=True
+    )
+    prepare_data(epoch_file, 3, 2, **prepare_kwargs)
+    prepare_data(epoch_file, 2, 2, cache_size=1, **prepare_kwargs)
+
+    entries = [
+        entry for entry in get_tensor_cache_dir(epoch_file).iterdir() if entry.is_dir()
+    ]
+    assert len(entries) == 1
+
+
+def test_prepare_data_extract_chunks(epoch_file, tmp_path):
+    prepare_kwargs = dict(
+        pre_window=(-14 / 256, -1 / 256),
+        post_window=(0, 20 / 256),
+        preprocess=PREPROCESS_EXTRACT_EEG,
+        extractors=[EXTRACTOR_TIME, EXTRACTOR_CORRELATION],
+    )
+    expected = prepare_data(epoch_file, 3, 2, **prepare_kwargs)
+    datasets, _, _, features, input_shape = prepare_data(
+        epoch_file,
+        3,
+        2,
+        lazy=True,
+        store_dir=tmp_path / "store",
+        extract_chunk_size=4,
+        **prepare_kwargs,
+    )
+
+    assert features == expected[3]
+    assert input_shape == expected[4] == (2, 19)
+    for set_type in ["train", "val"]:
+        X, Y = datasets[set_type]
+        assert isinstance(X, np.memmap)
+        assert (tmp_path / "store" / f"{set_type}.features.npy").exists()
+        assert np.array_equal(X, expected[0][set_type][0])
+        assert np.array_equal(Y, expected[0][set_type][1])